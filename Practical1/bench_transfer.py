@@ -0,0 +1,124 @@
+"""Compare the old 1 KiB send()/recv() copy loop with the transfer engine.
+
+Streams a test file over a loopback TCP connection with each path and
+prints the throughput:
+
+    python bench_transfer.py --size 4G --buffer-size 256K
+"""
+import argparse
+import os
+import socket
+import tempfile
+import sys
+import threading
+import time
+from pathlib import Path
+
+import transfer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import parse_size
+
+
+def make_file(path, size):
+    block = os.urandom(1 << 20)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            n = min(remaining, len(block))
+            f.write(block[:n])
+            remaining -= n
+
+
+def legacy_send(sock, path, size):
+    with open(path, "rb") as f:
+        chunk = f.read(1024)
+        while chunk:
+            sock.send(chunk)
+            chunk = f.read(1024)
+
+
+def legacy_recv(sock, sink, size):
+    with open(sink, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def engine_send(sock, path, size):
+    with open(path, "rb") as f:
+        transfer.send_file(sock, f, size)
+
+
+def make_engine_recv(buffer_size):
+    receiver = transfer.Receiver(buffer_size)
+
+    def engine_recv(sock, sink, size):
+        receiver.recv_file(sock, sink, size)
+    return engine_recv
+
+
+def run(send, recv, path, size, sink):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    def sender():
+        conn, _ = listener.accept()
+        send(conn, path, size)
+        conn.close()
+
+    t = threading.Thread(target=sender)
+    t.start()
+    sock = socket.create_connection(("127.0.0.1", port))
+    start = time.perf_counter()
+    recv(sock, sink, size)
+    elapsed = time.perf_counter() - start
+    sock.close()
+    t.join()
+    listener.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", default="2G", help="test file size (e.g. 512M, 4G)")
+    parser.add_argument("--buffer-size", default="256K", help="engine receive buffer")
+    parser.add_argument("--file", help="existing file to send instead of a generated one")
+    parser.add_argument("--sink", default=os.devnull, help="where received data is written")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.file:
+        path = args.file
+        size = os.path.getsize(path)
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "bench.bin")
+        size = parse_size(args.size)
+        print(f"Creating {size:,} byte test file...")
+        make_file(path, size)
+
+    paths = [
+        ("legacy 1 KiB send/recv", legacy_send, legacy_recv),
+        ("sendfile + recv_into", engine_send, make_engine_recv(parse_size(args.buffer_size))),
+    ]
+
+    print(f"{'path':<24} {'seconds':>9} {'MB/s':>9}")
+    for name, send, recv in paths:
+        for _ in range(args.repeat):
+            elapsed = run(send, recv, path, size, args.sink)
+            print(f"{name:<24} {elapsed:9.2f} {size / elapsed / 1e6:9.1f}")
+
+    if tmpdir:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
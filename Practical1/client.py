@@ -1,25 +1,295 @@
 import socket
+import hashlib
 import os
+import sys
+import threading
+import argparse
+from contextlib import redirect_stdout
 
-def send_text(sock, text):
-    sock.send((text + "\n").encode())
+import protocol
+import transfer
 
-def send_file(sock, filename):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import cli, compression, delta
+
+def hello(sock):
+    """Ask the server which of our codecs it accepts."""
+    protocol.send_frame(sock, protocol.OP_HELLO, ",".join(compression.supported()).encode())
+    opcode, flags, payload = recv_reply(sock)
+    if opcode != protocol.OP_OK or not payload:
+        return []
+    return payload.decode().split(",")
+
+def send_upload(sock, filename, codec=None):
+    """Write one UPLOAD frame; the reply is read separately.
+
+    The file is compressed with codec unless it looks incompressible.
+    Returns the TransferStats for a compressed upload, else None."""
+    name = protocol.pack_name(os.path.basename(filename))
+    with open(filename, "rb") as f:
+        size = transfer.file_size(f)
+        if codec and compression.is_compressible(transfer.sample(f, 0)):
+            flags = protocol.FLAG_CHUNKED | protocol.codec_bits(codec)
+            protocol.send_header(sock, protocol.OP_UPLOAD, len(name), flags)
+            sock.sendall(name)
+            return transfer.send_compressed(sock, f, size, 0, codec)
+        protocol.send_header(sock, protocol.OP_UPLOAD, len(name) + size)
+        sock.sendall(name)
+        transfer.send_file(sock, f, size)
+
+def delta_upload(sock, filename):
+    """Update the server's copy of filename by sending only what changed.
+
+    Returns the delta.Encoder on success, None if the server has no copy
+    and False if the rebuilt file did not match (then upload it whole)."""
+    name = os.path.basename(filename)
+    protocol.send_frame(sock, protocol.OP_SIGNATURE, name.encode())
+    header = protocol.recv_header(sock)
+    if header is None:
+        raise ConnectionError("server closed the connection")
+    opcode, flags, length = header
+    if opcode != protocol.OP_DATA:
+        protocol.skip_payload(sock, length)
+        return None
+    signature = delta.Signature.unpack(protocol.recv_exact(sock, length))
+
+    hasher = hashlib.sha256()
+    packed = protocol.pack_name(name)
     with open(filename, "rb") as f:
-        chunk = f.read(1024)
-        while chunk:
-            sock.send(chunk)
-            chunk = f.read(1024)
-
-def recv_file(sock, filename):
-    with open(filename, "wb") as f:
-        while True:
-            chunk = sock.recv(1024)
-            if not chunk:
-                break
-            f.write(chunk)
+        protocol.send_header(sock, protocol.OP_UPLOAD, len(packed), protocol.FLAG_DELTA)
+        sock.sendall(packed)
+        encoder = transfer.send_delta(sock, signature, f, hasher)
+    opcode, flags, response = recv_reply(sock)
+    if opcode == protocol.OP_NOTFOUND:
+        return None
+    if opcode != protocol.OP_OK or response.decode() != hasher.hexdigest():
+        return False
+    return encoder
+
+def recv_reply(sock):
+    reply = protocol.recv_frame(sock)
+    if reply is None:
+        raise ConnectionError("server closed the connection")
+    return reply
+
+def stat_remote(sock, filename):
+    """Return the size of server_<filename>, or None if it does not exist."""
+    protocol.send_frame(sock, protocol.OP_STAT, filename.encode())
+    opcode, flags, payload = recv_reply(sock)
+    if opcode != protocol.OP_OK:
+        return None
+    return protocol.SIZE.unpack(payload)[0]
+
+def fetch_range(sock, filename, fd, offset, count, rx, codec=None):
+    """Download count bytes at offset into fd at the same offset.
+
+    rx is the transfer.Receiver whose buffer the data passes through; one
+    thread's at a time, never shared.  Returns the number of bytes written, or None if the file is not found."""
+    payload = protocol.RANGE.pack(offset, count) + filename.encode()
+    flags = protocol.FLAG_RANGE | protocol.codec_bits(codec)
+    protocol.send_frame(sock, protocol.OP_DOWNLOAD, payload, flags)
+    header = protocol.recv_header(sock)
+    if header is None:
+        raise ConnectionError("server closed the connection")
+    opcode, flags, length = header
+    if opcode != protocol.OP_DATA:
+        protocol.skip_payload(sock, length)
+        return None
+    if flags & protocol.FLAG_CHUNKED:
+        stats = rx.recv_chunks_into_fd(sock, fd, offset, protocol.flags_codec(flags))
+        print(f"  bytes {offset:,}+{count:,}", stats.report())
+        return stats.raw_bytes
+    rx.recv_into_fd(sock, fd, offset, length)
+    return length
+
+def download(sock, filename, rx, codec=None):
+    """Download into downloaded_<filename>, resuming a partial copy if there is one.
+
+    Returns False if the file is not on the server."""
+    total = stat_remote(sock, filename)
+    if total is None:
+        return False
+    outname = "downloaded_" + filename
+    have = os.path.getsize(outname) if os.path.exists(outname) else 0
+    if have > total:
+        have = 0
+    if have:
+        print(f"Resuming from byte {have:,} of {total:,}")
+
+    with open(outname, "r+b" if have else "wb") as f:
+        length = fetch_range(sock, filename, f.fileno(), have, total - have, rx, codec)
+        if length is None:
+            return False
+        f.truncate(have + length)
+    return True
+
+def parallel_download(host, port, filename, connections, codec=None, progress=None):
+    """Fetch disjoint ranges of a file over several connections at once.
+
+    progress(done, total) is called as each range completes."""
+    if connections < 1:
+        raise ValueError(f"connections must be at least 1, not {connections}")
+    with socket.create_connection((host, port)) as sock:
+        total = stat_remote(sock, filename)
+    if total is None:
+        return False
+
+    outname = "downloaded_" + filename
+    fd = os.open(outname, os.O_WRONLY | os.O_CREAT, 0o644)
+    errors = []
+    done = [0]
+    lock = threading.Lock()
+    try:
+        os.ftruncate(fd, total)
+        part = -(-total // connections) if total else 0
+
+        def fetch(offset, count):
+            try:
+                with socket.create_connection((host, port)) as conn:
+                    got = fetch_range(conn, filename, fd, offset, count, transfer.Receiver(), codec)
+                    if got != count:
+                        raise ConnectionError(f"short range at {offset}")
+                if progress:
+                    with lock:
+                        done[0] += count
+                        progress(done[0], total)
+            except (OSError, protocol.ProtocolError) as e:
+                errors.append(e)
+
+        threads = []
+        for offset in range(0, total, part or 1):
+            t = threading.Thread(target=fetch, args=(offset, min(part, total - offset)))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+    finally:
+        os.close(fd)
+    if errors:
+        raise errors[0]
+    return True
+
+class Client:
+    """One connection to the server, for driving it from other programs.
+
+    Methods raise instead of printing what went wrong.  A Client is not
+    thread-safe; give each thread its own."""
+
+    def __init__(self, host, port, compress=True):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port))
+        self.receiver = transfer.Receiver()
+        self.codec = compression.negotiate(hello(self.sock)) if compress else None
+
+    def _reply(self):
+        opcode, flags, response = recv_reply(self.sock)
+        if opcode != protocol.OP_OK:
+            raise RuntimeError(f"server replied {protocol.OP_NAMES.get(opcode, opcode)}: "
+                               f"{response.decode(errors='replace')}")
+        return response.decode()
+
+    def upload(self, filename):
+        """Upload filename as server_<basename>; returns the bytes sent"""
+        stats = send_upload(self.sock, filename, self.codec)
+        self._reply()
+        return stats.wire_bytes if stats else os.path.getsize(filename)
+
+    def update(self, filename):
+        """Send only what changed, or the whole file if the server has no
+        usable copy; returns the bytes of file data sent"""
+        encoder = delta_upload(self.sock, filename)
+        if encoder:
+            return encoder.literal
+        return self.upload(filename)
+
+    def download(self, filename, connections=1, progress=None):
+        """Fetch server_<filename> into downloaded_<filename>; returns its size"""
+        if connections < 1:
+            raise ValueError(f"connections must be at least 1, not {connections}")
+        if connections > 1:
+            found = parallel_download(self.host, self.port, filename, connections,
+                                      self.codec, progress)
+        else:
+            found = download(self.sock, filename, self.receiver, self.codec)
+        if not found:
+            raise FileNotFoundError(filename)
+        return os.path.getsize("downloaded_" + filename)
+
+    def stat(self, filename):
+        return stat_remote(self.sock, filename)
+
+    def add(self, filename, content):
+        protocol.send_frame(self.sock, protocol.OP_ADDFILE, protocol.pack_name(filename) + content)
+        return self._reply()
+
+    def message(self, text):
+        protocol.send_frame(self.sock, protocol.OP_MESSAGE, text.encode())
+        return self._reply()
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+COMMANDS = ("upload", "update", "download", "message")
+
+def operation(command, arg, connections=1, reporter=None):
+    """(op, name, fn) for cli.run_operations; fn runs the command on a Client."""
+    if command == "upload":
+        return command, arg, lambda c: {'bytes': os.path.getsize(arg), 'wire_bytes': c.upload(arg)}
+    if command == "update":
+        return command, arg, lambda c: {'bytes': os.path.getsize(arg), 'wire_bytes': c.update(arg)}
+    if command == "download":
+        progress = reporter.callback(command, arg) if reporter else None
+        return command, arg, lambda c: {'bytes': c.download(arg, connections, progress)}
+    return command, arg, lambda c: {'reply': c.message(arg)}
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Practical1 file client (run without arguments for the menu)")
+    parser.add_argument("command", choices=COMMANDS + ("batch",))
+    parser.add_argument("args", nargs="*", help="files to move, or the message text")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--manifest", help="batch: file with one command per line, e.g. 'upload a.bin'")
+    parser.add_argument("--jobs", type=int, default=cli.DEFAULT_JOBS,
+                        help="operations run at once, each thread on its own connection")
+    parser.add_argument("--connections", type=int, default=1, help="connections per download")
+    parser.add_argument("--no-compress", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print progress as JSON lines")
+    args = parser.parse_intermixed_args(argv)
+    if args.connections < 1:
+        parser.error("--connections must be at least 1")
+
+    if args.command == "batch":
+        if not args.manifest:
+            parser.error("batch needs --manifest")
+        commands = cli.read_manifest(args.manifest)
+    else:
+        commands = [[args.command] + args.args]
+    reporter = cli.Reporter(args.json)
+    operations = []
+    for command, *rest in commands:
+        if command not in COMMANDS:
+            parser.error(f"unknown command {command!r}")
+        for arg in [" ".join(rest)] if command == "message" else rest:
+            operations.append(operation(command, arg, args.connections, reporter))
+
+    host = socket.gethostbyname(args.host)
+    # Events own stdout; the transfer functions' own messages go to stderr
+    with redirect_stdout(sys.stderr):
+        failed = cli.run_operations(operations, reporter, args.jobs,
+                                    lambda: Client(host, args.port, not args.no_compress))
+    return 1 if failed else 0
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
 
     hostname = input("Enter server hostname/IP: ")
     port = int(input("Enter server port: "))
@@ -30,6 +300,10 @@ if __name__ == '__main__':
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.connect((host, port))
 
+    codec = compression.negotiate(hello(sock))
+    receiver = transfer.Receiver()
+    print("Compression:", codec or "off")
+
     while True:
         print("\n=== MENU ===")
         print("1. Upload file")
@@ -37,29 +311,22 @@ if __name__ == '__main__':
         print("3. Send message")
         print("4. Add file on server")
         print("5. Exit")
+        print("6. Upload several files")
+        print("7. Parallel download")
+        print("8. Update file on server (send changes only)")
 
         choice = input("Choose option: ")
 
-    
+
         if choice == "4":
             filename = input("Enter new file name: ")
             data = input("Enter file content: ")
 
-            send_text(sock, "addfile")
-
-            send_text(sock, filename)
+            protocol.send_frame(sock, protocol.OP_ADDFILE,
+                                protocol.pack_name(filename) + data.encode())
 
-            response = sock.recv(1024).decode().strip()
-            print("Server:", response)
-
-            if response != "file recv":
-                print("Server error. Stopping.")
-                continue
-
-            sock.send(data.encode())
-
-            response2 = sock.recv(1024).decode().strip()
-            print("Server:", response2)
+            opcode, flags, response = recv_reply(sock)
+            print("Server:", response.decode())
 
         elif choice == "1":
             filename = input("Enter filename: ")
@@ -68,36 +335,70 @@ if __name__ == '__main__':
                 print("File does not exist!")
                 continue
 
-            send_text(sock, "UPLOAD")
-            send_text(sock, filename)
-            send_file(sock, filename)
+            stats = send_upload(sock, filename, codec)
+            if stats:
+                print(stats.report())
+
+            opcode, flags, response = recv_reply(sock)
+            print("Server:", response.decode())
 
-            response = sock.recv(1024).decode().strip()
-            print("Server:", response)
+        elif choice == "6":
+            filenames = input("Enter filenames (space separated): ").split()
+            filenames = [name for name in filenames if os.path.exists(name)]
 
+            # Send every upload first, then collect the replies in order.
+            for filename in filenames:
+                send_upload(sock, filename, codec)
+            for filename in filenames:
+                opcode, flags, response = recv_reply(sock)
+                print(filename + ":", response.decode())
 
         elif choice == "2":
             filename = input("Enter filename to download: ")
 
-            send_text(sock, "DOWNLOAD")
-            send_text(sock, filename)
+            if download(sock, filename, receiver, codec):
+                print("File downloaded successfully!")
+            else:
+                print("Server: File not found.")
+
+        elif choice == "7":
+            filename = input("Enter filename to download: ")
+            connections = input("Number of connections: ")
 
-            status = sock.recv(1024).decode().strip()
+            if not connections.isdigit() or int(connections) < 1:
+                print("Connections must be a whole number of at least 1!")
+                continue
 
-            if status == "FOUND":
-                recv_file(sock, "downloaded_" + filename)
+            if parallel_download(host, port, filename, int(connections), codec):
                 print("File downloaded successfully!")
             else:
                 print("Server: File not found.")
 
-    
+        elif choice == "8":
+            filename = input("Enter filename: ")
+
+            if not os.path.exists(filename):
+                print("File does not exist!")
+                continue
+
+            encoder = delta_upload(sock, filename)
+            if encoder:
+                total = encoder.literal + encoder.matched
+                print(f"Updated: sent {encoder.literal:,} of {total:,} bytes, "
+                      f"{encoder.matched:,} matched the server's copy")
+                continue
+
+            print("No usable copy on the server, uploading the whole file")
+            send_upload(sock, filename, codec)
+            opcode, flags, response = recv_reply(sock)
+            print("Server:", response.decode())
+
         elif choice == "3":
             msg = input("Enter message: ")
-            send_text(sock, "MESSAGE")
-            send_text(sock, msg)
+            protocol.send_frame(sock, protocol.OP_MESSAGE, msg.encode())
 
-            response = sock.recv(1024).decode().strip()
-            print("Server says:", response)
+            opcode, flags, response = recv_reply(sock)
+            print("Server says:", response.decode())
 
         elif choice == "5":
             break
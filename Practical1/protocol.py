@@ -0,0 +1,167 @@
+"""Framed binary protocol shared by the Practical1 client and server.
+
+Every message is a fixed 14-byte header followed by `length` payload bytes:
+
+    magic    2 bytes   b"P1"
+    version  1 byte
+    opcode   1 byte
+    flags    2 bytes
+    length   8 bytes   payload size (unsigned, big endian)
+
+Requests that carry a file (ADDFILE, UPLOAD) start their payload with a
+length-prefixed file name; the rest of the payload is the file content.
+A DOWNLOAD with FLAG_RANGE set starts its payload with a RANGE (offset,
+length) pair so a client can resume or fetch a file in parallel pieces.
+
+A sender may instead compress a file: the frame then has FLAG_CHUNKED and
+a codec id in its flags, its own payload is just the name (requests) or
+empty (replies), and the compressed data follows as CHUNK frames ending
+with an empty CHUNK.  HELLO tells the client which codecs the server
+takes; a DOWNLOAD carrying codec bits lets the server compress the reply.
+
+To update a file the server already has, a client asks for its
+SIGNATURE (block checksums, see common/delta.py) and sends an UPLOAD with
+FLAG_DELTA whose payload is just the name; CHUNK frames of packed delta
+ops follow, ending with an empty CHUNK.  The server rebuilds the file
+beside its old copy and replies OK with the new file's SHA-256 in hex,
+which the client checks before trusting the update.
+
+Because every payload has an exact length, several requests can be sent
+back to back on one connection and the replies come back in order.
+"""
+import struct
+
+MAGIC = b"P1"
+VERSION = 1
+HEADER = struct.Struct("!2sBBHQ")
+NAME_LEN = struct.Struct("!H")
+RANGE = struct.Struct("!QQ")
+SIZE = struct.Struct("!Q")
+
+# Largest payload read into memory in one piece (names, messages, replies).
+MAX_INLINE = 1 << 20
+
+# Requests
+OP_ADDFILE = 0x01
+OP_UPLOAD = 0x02
+OP_DOWNLOAD = 0x03
+OP_MESSAGE = 0x04
+OP_STAT = 0x05
+OP_HELLO = 0x06
+OP_CHUNK = 0x07
+OP_SIGNATURE = 0x08
+
+# Replies
+OP_OK = 0x81
+OP_DATA = 0x82
+OP_NOTFOUND = 0x83
+OP_ERROR = 0x84
+
+OP_NAMES = {v: k[3:] for k, v in list(globals().items()) if k.startswith("OP_")}
+
+# Flags
+FLAG_RANGE = 0x0001
+FLAG_CHUNKED = 0x0002
+FLAG_DELTA = 0x0004
+CODEC_SHIFT = 8
+CODEC_MASK = 0x0F00
+CODEC_IDS = {"zlib": 1, "bz2": 2, "lzma": 3}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exact(sock, n):
+    """Receive exactly n bytes or raise ConnectionError."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        r = sock.recv_into(view[got:], n - got)
+        if r == 0:
+            raise ConnectionError(f"connection closed after {got} of {n} bytes")
+        got += r
+    return bytes(buf)
+
+
+def pack_header(opcode, length, flags=0):
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, length)
+
+
+def send_header(sock, opcode, length, flags=0):
+    sock.sendall(pack_header(opcode, length, flags))
+
+
+def send_frame(sock, opcode, payload=b"", flags=0):
+    sock.sendall(pack_header(opcode, len(payload), flags) + payload)
+
+
+def recv_header(sock):
+    """Return (opcode, flags, length), or None if the peer closed cleanly."""
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    if len(first) < HEADER.size:
+        first += recv_exact(sock, HEADER.size - len(first))
+    magic, version, opcode, flags, length = HEADER.unpack(first)
+    if magic != MAGIC:
+        raise ProtocolError("bad frame magic")
+    if version != VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    return opcode, flags, length
+
+
+def recv_payload(sock, length):
+    if length > MAX_INLINE:
+        raise ProtocolError(f"payload of {length} bytes is too large to buffer")
+    return recv_exact(sock, length) if length else b""
+
+
+def recv_frame(sock):
+    """Return (opcode, flags, payload), or None if the peer closed cleanly."""
+    header = recv_header(sock)
+    if header is None:
+        return None
+    opcode, flags, length = header
+    return opcode, flags, recv_payload(sock, length)
+
+
+def skip_payload(sock, length):
+    """Discard a payload we are not going to use, keeping the stream in sync."""
+    while length:
+        n = min(length, 65536)
+        recv_exact(sock, n)
+        length -= n
+
+
+def codec_bits(codec):
+    """Flag bits naming codec (0 for no compression)."""
+    return CODEC_IDS[codec] << CODEC_SHIFT if codec else 0
+
+
+def flags_codec(flags):
+    """Codec named by a frame's flags, or None."""
+    return CODEC_NAMES.get((flags & CODEC_MASK) >> CODEC_SHIFT)
+
+
+def pack_name(name):
+    raw = name.encode()
+    return NAME_LEN.pack(len(raw)) + raw
+
+
+def recv_name(sock, limit=None):
+    """Read a length-prefixed name; return (name, bytes consumed).
+
+    limit is the payload length the name came in; a name that does not
+    fit in it raises ProtocolError, as does one that is not UTF-8."""
+    if limit is not None and limit < NAME_LEN.size:
+        raise ProtocolError(f"payload of {limit} bytes has no room for a name")
+    (n,) = NAME_LEN.unpack(recv_exact(sock, NAME_LEN.size))
+    if limit is not None and NAME_LEN.size + n > limit:
+        raise ProtocolError(f"name of {n} bytes does not fit a {limit}-byte payload")
+    try:
+        return recv_exact(sock, n).decode(), NAME_LEN.size + n
+    except UnicodeDecodeError:
+        raise ProtocolError("name is not UTF-8") from None
@@ -1,97 +1,316 @@
 import socket
+import hashlib
 import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def recv_text(conn):
-    """Receive a line of text ending with newline using recv()."""
-    data = conn.recv(1024).decode()
-    return data.strip()
-
-def recv_file(conn, filename):
-    """Receive a file using recv() until client stops sending."""
-    with open(filename, "wb") as f:
-        while True:
-            chunk = conn.recv(1024)
-            if not chunk:
-                break
-            f.write(chunk)
-
-def send_file(conn, filename):
-    """Send a file using send()."""
-    with open(filename, "rb") as f:
-        chunk = f.read(1024)
-        while chunk:
-            conn.send(chunk)
-            chunk = f.read(1024)
+import protocol
+import transfer
 
-if __name__ == '__main__':
-    hostname = input("Enter server hostname/IP: ")
-    port = int(input("Enter server port: "))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import compression, delta, metrics
 
-    host = socket.gethostbyname(hostname)
+DEFAULT_MAX_CONNECTIONS = 16
+ACCEPT_TIMEOUT = 0.5
+# Request events are appended here; kill -USR1 writes the .prom/.json snapshots
+METRICS_NAME = "server_metrics"
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind((host, port))
-    sock.listen(5)
+class ClientSession:
+    """State and command loop for one connected client."""
 
-    print("Server listening on", host, "port", port)
+    def __init__(self, conn, addr, stopping, buffer_size=transfer.DEFAULT_BUFFER_SIZE,
+                 registry=None, events=None):
+        self.conn = conn
+        self.addr = addr
+        self.stopping = stopping
+        self.receiver = transfer.Receiver(buffer_size)
+        self.busy = False
+        self.commands = 0
+        registry = registry or metrics.Registry()
+        self.events = events
+        self.requests = registry.histogram("tcp_request_seconds", "Time to serve one request")
+        self.bytes = registry.counter("tcp_bytes_total", "File bytes moved, by direction")
+        self.checksums = registry.histogram("tcp_checksum_seconds", "Time spent hashing files")
+        self.moved = 0
 
-    conn, addr = sock.accept()
-    print("Client connected:", addr)
+    def log(self, *args):
+        print(f"[{self.addr[0]}:{self.addr[1]}]", *args)
 
-    while True:
-        command = recv_text(conn)
-        if not command:
-            break
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                header = protocol.recv_header(self.conn)
+                if header is None:
+                    break
+                self.busy = True
+                self.commands += 1
+                self.moved = 0
+                start = time.perf_counter()
+                self.handle(*header)
+                elapsed = time.perf_counter() - start
+                op = protocol.OP_NAMES.get(header[0], str(header[0]))
+                self.requests.observe(elapsed, op=op)
+                if self.events:
+                    self.events.log("request", peer=f"{self.addr[0]}:{self.addr[1]}", op=op,
+                                    bytes=self.moved, seconds=round(elapsed, 6))
+                self.busy = False
+        except protocol.ProtocolError as e:
+            self.log("Protocol error:", e)
+            try:
+                protocol.send_frame(self.conn, protocol.OP_ERROR, str(e).encode())
+            except OSError:
+                pass
+        except OSError as e:
+            if not self.stopping.is_set():
+                self.log("Connection error:", e)
+        finally:
+            self.busy = False
+            self.conn.close()
+            self.log("Client disconnected after", self.commands, "commands")
 
-        print("Client command:", command)
+    def count(self, direction, n):
+        self.bytes.inc(n, direction=direction)
+        self.moved += n
 
-       
-        if command == "addfile":
-            filename = recv_text(conn)
-            print("Creating new file:", filename)
+    def handle(self, opcode, flags, length):
+        conn = self.conn
 
-            server_filename = "server_" + filename
-            with open(server_filename, "wb") as f:
-                pass  
+        if opcode == protocol.OP_ADDFILE:
+            filename, used = protocol.recv_name(conn, length)
+            self.log("Creating new file:", filename)
+            self.receiver.recv_file(conn, "server_" + filename, length - used)
+            self.count("in", length - used)
+            protocol.send_frame(conn, protocol.OP_OK, b"file data recv")
+            self.log("Sent: file data recv")
 
-            conn.send(b"file recv\n")
-            print("Sent: file recv")
-            print("Receiving file data for:", filename)
-            data = conn.recv(4096)
+        elif opcode == protocol.OP_SIGNATURE:
+            filename = protocol.recv_payload(conn, length).decode()
+            path = "server_" + filename
+            if os.path.isfile(path):
+                with self.checksums.time(kind="signature"):
+                    signature = delta.Signature.of_file(path).pack()
+                self.log("Sent signature of", filename, f"({len(signature):,} bytes)")
+                protocol.send_header(conn, protocol.OP_DATA, len(signature))
+                conn.sendall(signature)
+            else:
+                protocol.send_frame(conn, protocol.OP_NOTFOUND)
+
+        elif opcode == protocol.OP_UPLOAD and flags & protocol.FLAG_DELTA:
+            filename, used = protocol.recv_name(conn, length)
+            protocol.skip_payload(conn, length - used)
+            path = "server_" + filename
+            partial = path + ".delta"
+            self.log("Receiving delta update:", filename)
+            if not os.path.isfile(path):
+                # Drain the ops so the connection stays usable
+                self.receiver.recv_delta(conn, None)
+                protocol.send_frame(conn, protocol.OP_NOTFOUND)
+                return
+            hasher = hashlib.sha256()
+            try:
+                with open(path, "rb") as basis, open(partial, "wb") as out:
+                    # The signature was made with the same block size
+                    block_size = delta.block_size_for(transfer.file_size(basis))
+                    patcher = delta.Patcher(basis, out, block_size, hasher)
+                    self.receiver.recv_delta(conn, patcher)
+            except ValueError as e:
+                self.log("Delta update failed:", e)
+                protocol.send_frame(conn, protocol.OP_ERROR, str(e).encode())
+            else:
+                os.replace(partial, path)
+                self.count("in", patcher.literal)
+                self.log(f"Delta update complete: {patcher.written:,} bytes, "
+                         f"{patcher.literal:,} sent as literal data")
+                protocol.send_frame(conn, protocol.OP_OK, hasher.hexdigest().encode())
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
 
-            with open(server_filename, "ab") as f:
-                f.write(data)
+        elif opcode == protocol.OP_UPLOAD and flags & protocol.FLAG_CHUNKED:
+            filename, used = protocol.recv_name(conn, length)
+            protocol.skip_payload(conn, length - used)
+            codec = protocol.flags_codec(flags)
+            self.log("Receiving file:", filename, f"({codec} compressed)")
+            with open("server_" + filename, "wb") as f:
+                stats = self.receiver.recv_chunks_into_fd(conn, f.fileno(), 0, codec)
+            self.count("in", stats.wire_bytes)
+            self.log("Upload complete.", stats.report())
+            protocol.send_frame(conn, protocol.OP_OK, b"OK")
 
-            conn.send(b"file data recv\n")
-            print("Sent: file data recv")
+        elif opcode == protocol.OP_UPLOAD:
+            filename, used = protocol.recv_name(conn, length)
+            self.log("Receiving file:", filename, f"({length - used:,} bytes)")
+            self.receiver.recv_file(conn, "server_" + filename, length - used)
+            self.count("in", length - used)
+            self.log("Upload complete.")
+            protocol.send_frame(conn, protocol.OP_OK, b"OK")
 
-        elif command == "UPLOAD":
-            filename = recv_text(conn)
-            print("Receiving file:", filename)
-            recv_file(conn, "server_" + filename)
-            print("Upload complete.")
-            conn.send(b"OK\n")
+        elif opcode == protocol.OP_DOWNLOAD:
+            payload = protocol.recv_payload(conn, length)
+            if flags & protocol.FLAG_RANGE:
+                offset, count = protocol.RANGE.unpack_from(payload)
+                filename = payload[protocol.RANGE.size:].decode()
+                self.log("Client requests file:", filename, f"bytes {offset:,}+{count:,}")
+            else:
+                offset, count = 0, None
+                filename = payload.decode()
+                self.log("Client requests file:", filename)
 
-        elif command == "DOWNLOAD":
-            filename = recv_text(conn)
-            print("Client requests file:", filename)
+            path = "server_" + filename
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    size = transfer.file_size(f)
+                    offset = min(offset, size)
+                    count = size - offset if count is None else min(count, size - offset)
+                    codec = protocol.flags_codec(flags)
+                    if codec and compression.is_compressible(transfer.sample(f, offset)):
+                        reply_flags = (protocol.FLAG_CHUNKED | protocol.codec_bits(codec)
+                                       | flags & protocol.FLAG_RANGE)
+                        protocol.send_header(conn, protocol.OP_DATA, 0, reply_flags)
+                        stats = transfer.send_compressed(conn, f, count, offset, codec)
+                        self.count("out", stats.wire_bytes)
+                        self.log("Sent", filename, stats.report())
+                    else:
+                        protocol.send_header(conn, protocol.OP_DATA, count, flags & protocol.FLAG_RANGE)
+                        transfer.send_file(conn, f, count, offset)
+                        self.count("out", count)
+            else:
+                protocol.send_frame(conn, protocol.OP_NOTFOUND)
 
+        elif opcode == protocol.OP_STAT:
+            filename = protocol.recv_payload(conn, length).decode()
             path = "server_" + filename
-            if os.path.exists(path):
-                conn.send(b"FOUND\n")
-                send_file(conn, path)
+            if os.path.isfile(path):
+                protocol.send_frame(conn, protocol.OP_OK, protocol.SIZE.pack(os.path.getsize(path)))
             else:
-                conn.send(b"NOTFOUND\n")
+                protocol.send_frame(conn, protocol.OP_NOTFOUND)
 
-        elif command == "MESSAGE":
-            msg = recv_text(conn)
-            print("Client says:", msg)
-            response = "Server received: " + msg + "\n"
-            conn.send(response.encode())
+        elif opcode == protocol.OP_HELLO:
+            offered = protocol.recv_payload(conn, length).decode().split(",")
+            accepted = [codec for codec in compression.supported()
+                        if codec in offered and codec in protocol.CODEC_IDS]
+            protocol.send_frame(conn, protocol.OP_OK, ",".join(accepted).encode())
+
+        elif opcode == protocol.OP_MESSAGE:
+            msg = protocol.recv_payload(conn, length).decode()
+            self.log("Client says:", msg)
+            response = "Server received: " + msg
+            protocol.send_frame(conn, protocol.OP_OK, response.encode())
 
         else:
-            conn.send(b"INVALID\n")
+            self.log("Unknown opcode:", opcode)
+            protocol.skip_payload(conn, length)
+            protocol.send_frame(conn, protocol.OP_ERROR, b"INVALID")
+
+    def close_if_idle(self):
+        """Unblock an idle session so it exits; busy ones finish their command first."""
+        if not self.busy:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class FileServer:
+    """Serves many clients at once from a bounded thread pool."""
+
+    def __init__(self, host, port, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 buffer_size=transfer.DEFAULT_BUFFER_SIZE):
+        self.max_connections = max_connections
+        self.buffer_size = buffer_size
+        self.stopping = threading.Event()
+        self.dump_requested = threading.Event()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.metrics = metrics.Registry()
+        self.events = metrics.EventLog(METRICS_NAME + ".jsonl")
+        self.active = self.metrics.gauge("tcp_sessions_active", "Connected clients being served")
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(max(5, max_connections))
+        self.sock.settimeout(ACCEPT_TIMEOUT)
+
+    def serve_forever(self):
+        with ThreadPoolExecutor(max_workers=self.max_connections) as pool:
+            while not self.stopping.is_set():
+                if self.dump_requested.is_set():
+                    self.dump_requested.clear()
+                    self.dump_metrics()
+                # Connections beyond the limit wait in the listen backlog.
+                if not self.slots.acquire(timeout=ACCEPT_TIMEOUT):
+                    continue
+                try:
+                    conn, addr = self.sock.accept()
+                except (socket.timeout, OSError):
+                    self.slots.release()
+                    continue
+                conn.settimeout(None)
+                session = ClientSession(conn, addr, self.stopping, self.buffer_size,
+                                        self.metrics, self.events)
+                with self.lock:
+                    self.sessions.add(session)
+                session.log("Client connected")
+                self.active.inc()
+                pool.submit(self._run_session, session)
+
+            print("Server stopping: waiting for", len(self.sessions), "active session(s)")
+            with self.lock:
+                for session in list(self.sessions):
+                    session.close_if_idle()
+        self.sock.close()
+        self.dump_metrics()
+        self.events.close()
+        print("Server stopped.")
+
+    def _run_session(self, session):
+        try:
+            session.run()
+        finally:
+            with self.lock:
+                self.sessions.discard(session)
+            self.active.dec()
+            self.slots.release()
+
+    def dump_metrics(self, *args):
+        """Write the current metrics as Prometheus text and JSON."""
+        self.metrics.write(METRICS_NAME + ".prom")
+        self.metrics.write(METRICS_NAME + ".json")
+        print("Metrics written to", METRICS_NAME + ".prom/.json")
+
+    # Signal handlers run on the main thread, which may be holding self.lock
+    # or the registry's lock in the accept loop, so they only set a flag;
+    # the loop acts on it within ACCEPT_TIMEOUT.
+    def shutdown(self, *args):
+        """Stop accepting and close sessions once their current command ends."""
+        self.stopping.set()
+
+    def request_metrics(self, *args):
+        """Have the accept loop write the metrics, see dump_metrics."""
+        self.dump_requested.set()
+
+
+if __name__ == '__main__':
+    hostname = input("Enter server hostname/IP: ")
+    port = int(input("Enter server port: "))
+    limit = input(f"Max concurrent connections [{DEFAULT_MAX_CONNECTIONS}]: ").strip()
+    max_connections = int(limit) if limit else DEFAULT_MAX_CONNECTIONS
+    kib = input(f"Transfer buffer size in KiB [{transfer.DEFAULT_BUFFER_SIZE // 1024}]: ").strip()
+    buffer_size = int(kib) * 1024 if kib else transfer.DEFAULT_BUFFER_SIZE
+
+    host = socket.gethostbyname(hostname)
+
+    server = FileServer(host, port, max_connections, buffer_size)
+    signal.signal(signal.SIGINT, server.shutdown)
+    signal.signal(signal.SIGTERM, server.shutdown)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, server.request_metrics)
 
-    conn.close()
-    sock.close()
+    print("Server listening on", host, "port", port,
+          "(max", max_connections, "connections)")
+    server.serve_forever()
@@ -0,0 +1,163 @@
+"""File <-> socket copying used by the Practical1 client and server.
+
+Sending goes through socket.sendfile(), which uses os.sendfile() where the
+platform has it, so file data is copied by the kernel and never enters
+Python.  Receiving reuses one preallocated buffer per connection and
+recv_into()s it, so no bytes object is created per chunk.
+
+Compressed transfers go through userspace in COMPRESS_BLOCK pieces and are
+framed as CHUNK frames (see protocol.py), and so are delta updates.
+"""
+import os
+import sys
+
+import protocol
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import compression, delta
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+COMPRESS_BLOCK = 256 * 1024
+
+
+def send_file(sock, f, size, offset=None):
+    """Send size bytes of the open file f, starting at offset (default: current position)."""
+    if offset is None:
+        offset = f.tell()
+    if size == 0:
+        return
+    sent = sock.sendfile(f, offset, size)
+    if sent != size:
+        raise ConnectionError(f"sent {sent} of {size} bytes (file shrank?)")
+
+
+def send_compressed(sock, f, size, offset, codec):
+    """Send size bytes of f from offset as compressed CHUNK frames; returns TransferStats."""
+    stats = compression.TransferStats(codec)
+    compressor = compression.Compressor(codec)
+    f.seek(offset)
+    remaining = size
+    while remaining:
+        block = f.read(min(remaining, COMPRESS_BLOCK))
+        if not block:
+            raise ConnectionError(f"file shrank with {remaining} bytes left")
+        out = compressor.compress(block)
+        if out:
+            protocol.send_frame(sock, protocol.OP_CHUNK, out)
+        stats.add(len(block), len(out))
+        remaining -= len(block)
+    out = compressor.flush()
+    if out:
+        protocol.send_frame(sock, protocol.OP_CHUNK, out)
+    stats.add(0, len(out))
+    protocol.send_frame(sock, protocol.OP_CHUNK)
+    return stats
+
+
+def send_delta(sock, signature, f, hasher=None):
+    """Send the delta ops turning the peer's basis into f as CHUNK frames.
+
+    Returns the delta.Encoder, whose literal and matched counts say how
+    much was actually sent."""
+    encoder = delta.Encoder(signature, f, hasher)
+    for batch in encoder:
+        protocol.send_frame(sock, protocol.OP_CHUNK, batch)
+    protocol.send_frame(sock, protocol.OP_CHUNK)
+    return encoder
+
+
+def sample(f, offset):
+    """First bytes of f at offset, used to decide whether to compress."""
+    return os.pread(f.fileno(), compression.SAMPLE_SIZE, offset)
+
+
+class Receiver:
+    """Receives socket data into files through one reusable buffer."""
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def recv_into_file(self, sock, f, size):
+        """Copy exactly size bytes from sock to the open file f."""
+        view = self.view
+        limit = len(self.buffer)
+        remaining = size
+        while remaining:
+            n = sock.recv_into(view, min(remaining, limit))
+            if n == 0:
+                raise ConnectionError(f"connection closed with {remaining} bytes left")
+            f.write(view[:n])
+            remaining -= n
+
+    def recv_into_fd(self, sock, fd, offset, size):
+        """Copy exactly size bytes from sock to fd at offset with pwrite()."""
+        view = self.view
+        limit = len(self.buffer)
+        remaining = size
+        while remaining:
+            n = sock.recv_into(view, min(remaining, limit))
+            if n == 0:
+                raise ConnectionError(f"connection closed with {remaining} bytes left")
+            written = 0
+            while written < n:
+                written += os.pwrite(fd, view[written:n], offset + written)
+            offset += n
+            remaining -= n
+
+    def recv_chunks_into_fd(self, sock, fd, offset, codec):
+        """Decompress CHUNK frames up to the empty one into fd at offset.
+
+        Returns the TransferStats; stats.raw_bytes is the number of bytes written."""
+        stats = compression.TransferStats(codec)
+        decompressor = compression.Decompressor(codec, len(self.buffer))
+        while True:
+            header = protocol.recv_header(sock)
+            if header is None:
+                raise ConnectionError("connection closed inside a chunked transfer")
+            opcode, flags, length = header
+            if opcode != protocol.OP_CHUNK:
+                raise protocol.ProtocolError(f"expected CHUNK frame, got opcode {opcode}")
+            if length == 0:
+                return stats
+            data = protocol.recv_payload(sock, length)
+            raw = 0
+            for piece in decompressor.feed(data):
+                written = 0
+                while written < len(piece):
+                    written += os.pwrite(fd, piece[written:], offset + written)
+                offset += len(piece)
+                raw += len(piece)
+            stats.add(raw, length)
+
+    def recv_delta(self, sock, patcher):
+        """Feed CHUNK frames up to the empty one into a delta.Patcher (None: discard).
+
+        A bad op does not stop the reading, so the stream stays in sync;
+        the first error is raised once the transfer is over."""
+        error = None
+        while True:
+            header = protocol.recv_header(sock)
+            if header is None:
+                raise ConnectionError("connection closed inside a delta transfer")
+            opcode, flags, length = header
+            if opcode != protocol.OP_CHUNK:
+                raise protocol.ProtocolError(f"expected CHUNK frame, got opcode {opcode}")
+            if length == 0:
+                break
+            data = protocol.recv_payload(sock, length)
+            if patcher is not None and error is None:
+                try:
+                    patcher.feed(data)
+                except ValueError as e:
+                    error = e
+        if error is not None:
+            raise error
+
+    def recv_file(self, sock, filename, size):
+        with open(filename, "wb") as f:
+            self.recv_into_file(sock, f, size)
+
+
+def file_size(f):
+    return os.fstat(f.fileno()).st_size
@@ -0,0 +1,63 @@
+"""Byte-bounded LRU cache for marshalled download_file responses."""
+from collections import OrderedDict
+import threading
+
+
+class ResponseCache:
+    """LRU of response bodies keyed by (file name, mtime_ns, size).
+
+    A rewritten file gets a new key, so stale entries are never served;
+    writers also call invalidate() so the old bytes are freed at once."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, size) = self.entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+
+    def invalidate(self, name):
+        """Drop every cached version of a file"""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == name]:
+                self.bytes -= self.entries.pop(key)[1]
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
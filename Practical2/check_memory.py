@@ -0,0 +1,115 @@
+"""Check that chunked transfers keep peak memory flat as files grow.
+
+For each file size a fresh server is started, the file is uploaded and
+downloaded with stream_upload/stream_download, and the peak RSS of the
+server and the client is recorded.  Exits non-zero if the peak grows by
+more than --tolerance between the smallest and the largest file.  The
+default sizes go past 2 GiB, where offsets no longer fit an XML-RPC int:
+
+    python check_memory.py --sizes 32M 128M 512M
+"""
+import argparse
+import filecmp
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import parse_size
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CLIENT_SCRIPT = """
+import resource, sys, xmlrpc.client
+import client
+rpc = xmlrpc.client.ServerProxy(sys.argv[1], allow_none=True)
+client.stream_upload(rpc, 'data.bin', 'data.bin')
+client.stream_download(rpc, 'data.bin', 'downloaded_data.bin')
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+
+def peak_rss_kib(pid):
+    """VmHWM of a running process in KiB (Linux only)"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def run_size(size):
+    with tempfile.TemporaryDirectory() as tmp:
+        block = os.urandom(1 << 20)
+        with open(os.path.join(tmp, "data.bin"), "wb") as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:min(len(block), size - offset)])
+
+        port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"), "--port", str(port)],
+                                  cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            env = dict(os.environ, PYTHONPATH=HERE)
+            out = subprocess.run([sys.executable, "-c", CLIENT_SCRIPT, f"http://localhost:{port}"],
+                                 cwd=tmp, env=env, check=True, capture_output=True, text=True)
+            client_kib = int(out.stdout.split()[-1])
+            server_kib = peak_rss_kib(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+        same = filecmp.cmp(os.path.join(tmp, "data.bin"), os.path.join(tmp, "downloaded_data.bin"),
+                           shallow=False)
+        return server_kib, client_kib, same
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["16M", "256M", "3G"])
+    parser.add_argument("--tolerance", default="32M", help="allowed peak RSS growth")
+    args = parser.parse_args()
+
+    sizes = sorted(parse_size(s) for s in args.sizes)
+    tolerance_kib = parse_size(args.tolerance) // 1024
+
+    results = []
+    print(f"{'file size':>12} {'server peak':>12} {'client peak':>12}")
+    for size in sizes:
+        server_kib, client_kib, same = run_size(size)
+        results.append((server_kib, client_kib))
+        print(f"{size // (1 << 20):>10}MB {server_kib // 1024:>10}MB {client_kib // 1024:>10}MB"
+              + ("" if same else "  (download differs!)"))
+        if not same:
+            sys.exit(1)
+
+    growth = [max(r[i] for r in results) - results[0][i] for i in range(2)]
+    if max(growth) > tolerance_kib:
+        print(f"FAIL: peak RSS grew by {max(growth) // 1024}MB")
+        sys.exit(1)
+    print("OK: peak RSS stays flat")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Content-addressed chunk store for deduplicated uploads.
+
+Files are cut into content-defined chunks with a gear rolling hash
+(FastCDC style), so an insertion only moves the boundaries next to it and
+every other chunk keeps its hash.  Chunks are stored once under their
+sha256 and each file name maps to a manifest: the ordered list of
+[hash, size] pairs that make up the file.
+
+Layout under the store root:
+
+    .chunks/<first two hex digits>/<sha256>
+    .manifests/<quoted file name>.json
+"""
+from pathlib import Path
+from urllib.parse import quote, unquote
+import bisect
+import hashlib
+import json
+import os
+import random
+import uuid
+
+MIN_CHUNK = 16 * 1024
+AVG_BITS = 16                 # boundaries every ~64 KiB on average
+MAX_CHUNK = 256 * 1024
+READ_SIZE = 1024 * 1024
+
+# A 31-bit hash stays a single-digit Python int, which keeps the loop fast
+_HASH_BITS = 31
+_HASH_MASK = (1 << _HASH_BITS) - 1
+# Test the high bits: they depend on more of the window than the low ones
+_MASK = ((1 << AVG_BITS) - 1) << (_HASH_BITS - AVG_BITS)
+# Fixed seed: boundaries must be the same on every client and server
+_GEAR = [random.Random(0x5EED + i).getrandbits(_HASH_BITS) for i in range(256)]
+
+
+def cut_point(buf, start, end):
+    """Index of the first chunk boundary in buf[start:end].
+
+    Returns end if there is none before MAX_CHUNK bytes."""
+    limit = min(end, start + MAX_CHUNK)
+    if limit - start <= MIN_CHUNK:
+        return limit
+    gear = _GEAR
+    mask = _MASK
+    hash_mask = _HASH_MASK
+    h = 0
+    # The gear hash only depends on the last _HASH_BITS bytes, so hashing
+    # can start just before the minimum chunk size.
+    i = start + MIN_CHUNK - _HASH_BITS
+    for b in buf[i:limit]:
+        h = ((h << 1) + gear[b]) & hash_mask
+        i += 1
+        if not h & mask and i > start + MIN_CHUNK:
+            return i
+    return limit
+
+
+def iter_chunks(f):
+    """Yield the content-defined chunks of the open binary file f."""
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < MAX_CHUNK:
+            more = f.read(READ_SIZE)
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        if pos >= len(buf):
+            return
+        end = cut_point(buf, pos, len(buf))
+        yield buf[pos:end]
+        pos = end
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_manifest(path):
+    """[[hash, size], ...] for a local file"""
+    with open(path, 'rb') as f:
+        return [[chunk_hash(chunk), len(chunk)] for chunk in iter_chunks(f)]
+
+
+class ChunkStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self.chunk_dir = self.root / ".chunks"
+        self.manifest_dir = self.root / ".manifests"
+        self.chunk_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+
+    def _chunk_path(self, digest):
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError(f"bad chunk hash {digest!r}")
+        return self.chunk_dir / digest[:2] / digest
+
+    def _manifest_path(self, name):
+        return self.manifest_dir / (quote(name, safe="") + ".json")
+
+    def has(self, digest):
+        return self._chunk_path(digest).exists()
+
+    def missing(self, digests):
+        return [d for d in dict.fromkeys(digests) if not self.has(d)]
+
+    def put(self, data):
+        """Store a chunk and return its hash"""
+        digest = chunk_hash(data)
+        path = self._chunk_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f".{digest}.{uuid.uuid4().hex}")
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._chunk_path(digest), 'rb') as f:
+            return f.read()
+
+    def save_manifest(self, name, chunks):
+        absent = self.missing(digest for digest, size in chunks)
+        if absent:
+            raise ValueError(f"{len(absent)} chunks are not in the store")
+        path = self._manifest_path(name)
+        tmp = path.with_name(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(chunks, f)
+        os.replace(tmp, path)
+
+    def load_manifest(self, name):
+        try:
+            with open(self._manifest_path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def manifest_stat(self, name):
+        """os.stat() of a manifest, or None if name has none"""
+        try:
+            return os.stat(self._manifest_path(name))
+        except FileNotFoundError:
+            return None
+
+    def delete_manifest(self, name):
+        try:
+            os.remove(self._manifest_path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def names(self):
+        return [unquote(p.name[:-5]) for p in self.manifest_dir.glob("*.json")]
+
+    def size(self, chunks):
+        return sum(size for digest, size in chunks)
+
+    def read_at(self, chunks, offset, size):
+        """Read size bytes at offset of the file described by chunks"""
+        starts = [0]
+        for digest, length in chunks:
+            starts.append(starts[-1] + length)
+        out = bytearray()
+        i = bisect.bisect_right(starts, offset) - 1
+        while i < len(chunks) and len(out) < size:
+            data = self.get(chunks[i][0])
+            skip = offset + len(out) - starts[i]
+            out += data[skip:skip + size - len(out)]
+            i += 1
+        return bytes(out)
+
+    def read_all(self, chunks):
+        return b"".join(self.get(digest) for digest, size in chunks)
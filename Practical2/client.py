@@ -1,9 +1,288 @@
+import argparse
+import os
 import xmlrpc.client
+from contextlib import redirect_stdout
 from xmlrpc.client import Binary
 from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import cli, compression
+import chunkstore
 
 SERVER_URL = "http://localhost:8000"
-rpc = xmlrpc.client.ServerProxy(SERVER_URL, allow_none=True)
+CHUNK_SIZE = 1024 * 1024
+
+# A multicall request is sent once it holds this many calls or bytes
+BATCH_SIZE = 500
+BATCH_BYTES = 8 * 1024 * 1024
+
+rpc = None
+
+def wire_int(n):
+    """n as an XML-RPC value: ints are 32-bit, so larger ones go out as doubles"""
+    return n if n <= xmlrpc.client.MAXINT else float(n)
+
+def server_codecs(rpc):
+    """Codecs both sides support, or [] if the server predates compression"""
+    try:
+        offered = rpc.codecs()
+    except xmlrpc.client.Fault:
+        return []
+    return [codec for codec in compression.supported() if codec in offered]
+
+def stream_upload(rpc, path, remote_name, chunk_size=CHUNK_SIZE, compress=True, progress=None):
+    """Upload a file chunk by chunk; only one chunk is in memory at a time.
+
+    progress(done, total) is called after each chunk.  Returns the
+    TransferStats of the upload."""
+    offered = server_codecs(rpc) if compress else []
+    session_id = rpc.begin_upload(remote_name)
+    try:
+        with open(path, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            chunk = f.read(chunk_size)
+            codec = compression.choose_codec(chunk, offered)
+            stats = compression.TransferStats(codec)
+            offset = 0
+            while chunk:
+                if codec:
+                    packed = compression.compress_chunk(codec, chunk)
+                    rpc.put_chunk(session_id, wire_int(offset), Binary(packed), codec)
+                    stats.add(len(chunk), len(packed))
+                else:
+                    rpc.put_chunk(session_id, wire_int(offset), Binary(chunk))
+                    stats.add(len(chunk), len(chunk))
+                offset += len(chunk)
+                if progress:
+                    progress(offset, total)
+                chunk = f.read(chunk_size)
+    except BaseException:
+        # Best effort: the connection may be what failed, and the server
+        # expires abandoned sessions anyway
+        try:
+            rpc.abort_upload(session_id)
+        except Exception as e:
+            print(f"Could not abort upload of {remote_name}: {e}", file=sys.stderr)
+        raise
+    rpc.commit(session_id)
+    return stats
+
+def stream_download(rpc, remote_name, outname, chunk_size=CHUNK_SIZE, compress=True, progress=None):
+    """Download a file chunk by chunk.
+
+    progress(done, total) is called after each chunk.  Returns the
+    TransferStats of the download, or None if the file is not on the
+    server."""
+    total = int(rpc.file_size(remote_name))
+    if total < 0:
+        return None
+    offered = server_codecs(rpc) if compress else []
+    stats = compression.TransferStats()
+    with open(outname, 'wb') as f:
+        offset = 0
+        while True:
+            if offered:
+                reply = rpc.read_chunk(remote_name, wire_int(offset), chunk_size, offered)
+                packed = reply['data'].data
+                data = packed
+                if reply['codec']:
+                    data = compression.decompress_chunk(reply['codec'], packed, reply['size'])
+                    stats.codec = reply['codec']
+            else:
+                data = packed = rpc.read_chunk(remote_name, wire_int(offset), chunk_size).data
+            if not data:
+                break
+            f.write(data)
+            stats.add(len(data), len(packed))
+            offset += len(data)
+            if progress:
+                progress(offset, total)
+    return stats
+
+def dedup_upload(rpc, path, remote_name, batch_bytes=BATCH_BYTES):
+    """Upload only the chunks of a file the server does not have yet.
+
+    Returns (file bytes, bytes actually sent)."""
+    manifest = chunkstore.file_manifest(path)
+    missing = set(rpc.have_chunks([digest for digest, size in manifest]))
+    sent = 0
+    batch, batch_size = [], 0
+    with open(path, 'rb') as f:
+        for chunk in chunkstore.iter_chunks(f):
+            digest = chunkstore.chunk_hash(chunk)
+            if digest not in missing:
+                continue
+            missing.discard(digest)
+            batch.append(Binary(chunk))
+            batch_size += len(chunk)
+            if batch_size >= batch_bytes:
+                rpc.store_chunks(batch)
+                sent += batch_size
+                batch, batch_size = [], 0
+    if batch:
+        rpc.store_chunks(batch)
+        sent += batch_size
+    rpc.commit_manifest(remote_name, manifest)
+    return sum(size for digest, size in manifest), sent
+
+def batch_call(rpc, calls, batch_size=BATCH_SIZE, batch_bytes=BATCH_BYTES):
+    """Run (method, args, nbytes) calls through system.multicall.
+
+    Calls are grouped into requests of at most batch_size calls or about
+    batch_bytes of payload; results come back in call order."""
+    results = []
+    batch, pending_bytes = [], 0
+
+    def flush():
+        multi = xmlrpc.client.MultiCall(rpc)
+        for method, args in batch:
+            getattr(multi, method)(*args)
+        results.extend(multi())
+        batch.clear()
+
+    for method, args, nbytes in calls:
+        batch.append((method, args))
+        pending_bytes += nbytes
+        if len(batch) >= batch_size or pending_bytes >= batch_bytes:
+            flush()
+            pending_bytes = 0
+    if batch:
+        flush()
+    return results
+
+def batch_upload(rpc, paths, **kwargs):
+    """Upload many small files with a few multicall requests"""
+    def calls():
+        for path in paths:
+            data = Path(path).read_bytes()
+            yield 'upload_file', (Path(path).name, Binary(data)), len(data)
+    return batch_call(rpc, calls(), **kwargs)
+
+def batch_download(rpc, names, prefix="downloaded_", **kwargs):
+    """Download many small files with a few multicall requests.
+
+    Returns the names that were not found on the server."""
+    missing = []
+    calls = (('download_file', (name,), 0) for name in names)
+    for name, data in zip(names, batch_call(rpc, calls, **kwargs)):
+        if not data.data and rpc.file_size(name) < 0:
+            missing.append(name)
+            continue
+        with open(prefix + name, 'wb') as f:
+            f.write(data.data)
+    return missing
+
+def batch_add(rpc, files, **kwargs):
+    """Create many text files on the server from a {name: content} dict"""
+    return batch_call(rpc, (('add_file', (name, content), len(content))
+                            for name, content in files.items()), **kwargs)
+
+class Client:
+    """One connection to the server, for driving it from other programs.
+
+    A ServerProxy is not thread-safe, so neither is a Client; give each
+    thread its own."""
+
+    def __init__(self, url=SERVER_URL, compress=True, chunk_size=CHUNK_SIZE):
+        self.rpc = xmlrpc.client.ServerProxy(url, allow_none=True)
+        self.compress = compress
+        self.chunk_size = chunk_size
+
+    def upload(self, path, remote_name=None, progress=None):
+        """Stream a file to the server; returns the TransferStats"""
+        return stream_upload(self.rpc, path, remote_name or Path(path).name,
+                             self.chunk_size, self.compress, progress)
+
+    def download(self, remote_name, outname=None, progress=None):
+        """Stream a file into outname (default downloaded_<name>); returns the TransferStats"""
+        stats = stream_download(self.rpc, remote_name, outname or "downloaded_" + remote_name,
+                                self.chunk_size, self.compress, progress)
+        if stats is None:
+            raise FileNotFoundError(remote_name)
+        return stats
+
+    def dedup_upload(self, path, remote_name=None):
+        """Send only the chunks the server lacks; returns (file bytes, bytes sent)"""
+        return dedup_upload(self.rpc, path, remote_name or Path(path).name)
+
+    def upload_many(self, paths):
+        return batch_upload(self.rpc, paths)
+
+    def download_many(self, names):
+        """Returns the names that were not found"""
+        return batch_download(self.rpc, names)
+
+    def add(self, name, content):
+        return self.rpc.add_file(name, content)
+
+    def message(self, text):
+        return self.rpc.send_message(text)
+
+    def close(self):
+        self.rpc("close")()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+COMMANDS = ("upload", "download", "dedup", "message")
+
+def operation(command, arg, reporter=None):
+    """(op, name, fn) for cli.run_operations; fn runs the command on a Client"""
+    progress = reporter.callback(command, arg) if reporter else None
+    if command == "upload":
+        def run(client):
+            stats = client.upload(arg, progress=progress)
+            return {'bytes': stats.raw_bytes, 'wire_bytes': stats.wire_bytes}
+    elif command == "download":
+        def run(client):
+            stats = client.download(arg, progress=progress)
+            return {'bytes': stats.raw_bytes, 'wire_bytes': stats.wire_bytes}
+    elif command == "dedup":
+        def run(client):
+            total, sent = client.dedup_upload(arg)
+            return {'bytes': total, 'wire_bytes': sent}
+    else:
+        def run(client):
+            return {'reply': client.message(arg)}
+    return command, arg, run
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Practical2 XML-RPC file client (run without arguments for the menu)")
+    parser.add_argument("command", choices=COMMANDS + ("batch",))
+    parser.add_argument("args", nargs="*", help="files to move, or the message text")
+    parser.add_argument("--url", default=SERVER_URL)
+    parser.add_argument("--manifest", help="batch: file with one command per line, e.g. 'upload a.bin'")
+    parser.add_argument("--jobs", type=int, default=cli.DEFAULT_JOBS,
+                        help="operations run at once, each thread with its own proxy")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--no-compress", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print progress as JSON lines")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.command == "batch":
+        if not args.manifest:
+            parser.error("batch needs --manifest")
+        commands = cli.read_manifest(args.manifest)
+    else:
+        commands = [[args.command] + args.args]
+    reporter = cli.Reporter(args.json)
+    operations = []
+    for command, *rest in commands:
+        if command not in COMMANDS:
+            parser.error(f"unknown command {command!r}")
+        for arg in [" ".join(rest)] if command == "message" else rest:
+            operations.append(operation(command, arg, reporter))
+
+    # Events own stdout; anything else printed goes to stderr
+    with redirect_stdout(sys.stderr):
+        failed = cli.run_operations(operations, reporter, args.jobs,
+                                    lambda: Client(args.url, not args.no_compress, args.chunk_size))
+    return 1 if failed else 0
 
 def upload_file_client():
     filename = input("Enter file to upload: ")
@@ -11,21 +290,17 @@ def upload_file_client():
     if not path.exists():
         print("File not found")
         return
-    with open(path, 'rb') as f:
-        data = f.read()
-    rpc.upload_file(filename, Binary(data))
-    print("Upload complete")
+    stats = stream_upload(rpc, path, filename)
+    print("Upload complete:", stats.report())
 
 def download_file_client():
     filename = input("Enter file to download: ")
-    data = rpc.download_file(filename)
-    if not data.data:
+    outname = "downloaded_" + filename
+    stats = stream_download(rpc, filename, outname)
+    if stats is None:
         print("File not found on server")
         return
-    outname = "downloaded_" + filename
-    with open(outname, 'wb') as f:
-        f.write(data.data)
-    print("Downloaded:", outname)
+    print("Downloaded:", outname, "-", stats.report())
 
 def add_file_on_server_client():
     filename = input("Enter new file name on server: ")
@@ -33,24 +308,59 @@ def add_file_on_server_client():
     rpc.add_file(filename, content)
     print("File created on server")
 
+def batch_upload_client():
+    names = input("Enter files to upload (space separated): ").split()
+    paths = [name for name in names if Path(name).is_file()]
+    for name in set(names) - set(paths):
+        print("File not found:", name)
+    batch_upload(rpc, paths)
+    print(f"Uploaded {len(paths)} files")
+
+def batch_download_client():
+    names = input("Enter files to download (space separated): ").split()
+    missing = batch_download(rpc, names)
+    for name in missing:
+        print("File not found on server:", name)
+    print(f"Downloaded {len(names) - len(missing)} files")
+
+def dedup_upload_client():
+    filename = input("Enter file to upload: ")
+    if not Path(filename).is_file():
+        print("File not found")
+        return
+    total, sent = dedup_upload(rpc, filename, filename)
+    print(f"Upload complete: sent {sent:,} of {total:,} bytes")
+
 def send_message_client():
     msg = input("Enter message to server: ")
     response = rpc.send_message(msg)
     print("Server:", response)
 
 
-while True:
-    print("\n=== XML-RPC File Transfer Client ===")
-    print("1. Upload file")
-    print("2. Download file")
-    print("3. Add file on server")
-    print("4. Send message")
-    print("5. Exit")
-
-    choice = input("Choose option: ")
-    if choice == "1": upload_file_client()
-    elif choice == "2": download_file_client()
-    elif choice == "3": add_file_on_server_client()
-    elif choice == "4": send_message_client()
-    elif choice == "5": break
-    else: print("Invalid option!")
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv[1:]))
+
+    rpc = xmlrpc.client.ServerProxy(SERVER_URL, allow_none=True)
+
+    while True:
+        print("\n=== XML-RPC File Transfer Client ===")
+        print("1. Upload file")
+        print("2. Download file")
+        print("3. Add file on server")
+        print("4. Send message")
+        print("5. Exit")
+        print("6. Upload many files")
+        print("7. Download many files")
+        print("8. Upload file (deduplicated)")
+
+        choice = input("Choose option: ")
+        if choice == "1": upload_file_client()
+        elif choice == "2": download_file_client()
+        elif choice == "3": add_file_on_server_client()
+        elif choice == "4": send_message_client()
+        elif choice == "5": break
+        elif choice == "6": batch_upload_client()
+        elif choice == "7": batch_download_client()
+        elif choice == "8": dedup_upload_client()
+        else: print("Invalid option!")
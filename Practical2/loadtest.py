@@ -0,0 +1,119 @@
+"""Mixed small/large call load test for the XML-RPC server.
+
+Small callers loop on send_message and list_files while large callers
+loop on download_file of a big file.  Latency percentiles are printed
+per method at the end, with the slowest first reply and the fewest calls
+any one client got.  The run fails if a client waited longer than
+--max-wait for its first reply or got no calls through.  More clients
+than server workers checks that kept-alive connections do not starve the
+rest:
+
+    python server.py --workers 8 &
+    python loadtest.py --small-clients 16 --large-clients 2 --large-size 64M
+    python server.py --workers 2 &
+    python loadtest.py --small-clients 10 --large-clients 0
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.client import Binary
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import parse_size, percentile
+import client
+
+LARGE_NAME = "loadtest_large.bin"
+
+
+def small_caller(url, stop, results, lock):
+    rpc = xmlrpc.client.ServerProxy(url, allow_none=True)
+    local = {'send_message': [], 'list_files': []}
+    i = 0
+    begin = time.perf_counter()
+    first = None
+    while not stop.is_set():
+        start = time.perf_counter()
+        if i % 2:
+            rpc.list_files()
+            local['list_files'].append(time.perf_counter() - start)
+        else:
+            rpc.send_message(f"ping {i}")
+            local['send_message'].append(time.perf_counter() - start)
+        if first is None:
+            first = time.perf_counter() - begin
+        i += 1
+    with lock:
+        for method, values in local.items():
+            results.setdefault(method, []).extend(values)
+        results.setdefault('clients', []).append((first, i))
+
+
+def large_caller(url, stop, results, lock):
+    rpc = xmlrpc.client.ServerProxy(url, allow_none=True)
+    local = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        rpc.download_file(LARGE_NAME)
+        local.append(time.perf_counter() - start)
+    with lock:
+        results.setdefault('download_file', []).extend(local)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=client.SERVER_URL)
+    parser.add_argument("--small-clients", type=int, default=8)
+    parser.add_argument("--large-clients", type=int, default=2)
+    parser.add_argument("--large-size", default="32M")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--max-wait", type=float, default=2.0,
+                        help="longest acceptable wait for a small client's first reply, seconds")
+    args = parser.parse_args()
+
+    rpc = xmlrpc.client.ServerProxy(args.url, allow_none=True)
+    size = parse_size(args.large_size)
+    print(f"Uploading {size:,} byte test file...")
+    block = os.urandom(min(size, 1 << 20))
+    session = rpc.begin_upload(LARGE_NAME)
+    for offset in range(0, size, len(block)):
+        rpc.put_chunk(session, client.wire_int(offset), Binary(block[:size - offset]))
+    rpc.commit(session)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {}
+    threads = [threading.Thread(target=small_caller, args=(args.url, stop, results, lock))
+               for _ in range(args.small_clients)]
+    threads += [threading.Thread(target=large_caller, args=(args.url, stop, results, lock))
+                for _ in range(args.large_clients)]
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    clients = results.pop('clients', [])
+    print(f"\n{'method':<15} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for method, values in sorted(results.items()):
+        if values:
+            print(f"{method:<15} {len(values):>7} {percentile(values, 50) * 1000:9.1f} "
+                  f"{percentile(values, 99) * 1000:9.1f} {max(values) * 1000:9.1f}")
+    if clients:
+        starved = sum(1 for first, calls in clients if first is None)
+        slowest = max(first for first, calls in clients if first is not None) if starved < len(clients) else None
+        fewest = min(calls for first, calls in clients)
+        print(f"\n{len(clients)} small clients: slowest first reply "
+              f"{'-' if slowest is None else f'{slowest * 1000:.1f} ms'}, fewest calls {fewest}, "
+              f"starved {starved}")
+        if starved or slowest > args.max_wait:
+            print(f"FAIL: a client waited more than {args.max_wait:g}s for its first reply")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,295 @@
 import xmlrpc.server
 from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+import xmlrpc.client
 from xmlrpc.client import Binary
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
 import os
+import queue
+import selectors
+import socket
+import sys
 import threading
+import time
+import uuid
 import base64
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import compression, metrics
+import chunkstore
+from cache import ResponseCache
+
 # Directory to store server files
 SERVER_DIR = "server_files"
 os.makedirs(SERVER_DIR, exist_ok=True)
 
+# Deduplicated uploads: chunks and name -> manifest index under SERVER_DIR
+store = chunkstore.ChunkStore(SERVER_DIR)
+
+# Marshalled download_file responses, see CachedDownloads; resized by --cache-mb
+response_cache = ResponseCache(256 * 1024 * 1024)
+
+# Largest chunk read_chunk will return in one call
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Writers to the same file take its lock; one lock per file name
+file_locks = {}
+file_locks_guard = threading.Lock()
+
+# Open chunked uploads: session id -> {'filename', 'path', 'fd', 'used', 'active'}
+upload_sessions = {}
+sessions_lock = threading.Lock()
+# Sessions without a call for this long are dropped with their temp file
+UPLOAD_TIMEOUT = 300
+
+# Call counts and latencies, file bytes and queue depth; see metrics()
+registry = metrics.Registry()
+rpc_seconds = registry.histogram("rpc_call_seconds", "Time to serve one RPC call")
+rpc_errors = registry.counter("rpc_errors_total", "RPC calls that raised")
+file_bytes = registry.counter("rpc_bytes_total", "File bytes moved, by direction")
+chunk_seconds = registry.histogram("rpc_chunk_store_seconds", "Time to hash and store one chunk")
+requests_queued = registry.gauge("rpc_requests_pending", "Requests accepted and not yet finished")
+# Slow calls are also logged, one JSON line each
+SLOW_CALL = 0.5
+events = None
+
+
+def wire_int(n):
+    """n as an XML-RPC value: ints are 32-bit, so larger ones go out as doubles"""
+    return n if n <= xmlrpc.client.MAXINT else float(n)
+
+def file_lock(filename):
+    with file_locks_guard:
+        return file_locks.setdefault(filename, threading.Lock())
+
+def _replace_file(filename, data):
+    """Write data to a temp file and rename it over filename under its lock"""
+    path = Path(SERVER_DIR) / filename
+    tmp = Path(SERVER_DIR) / f".upload-{uuid.uuid4().hex}"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    with file_lock(filename):
+        os.replace(tmp, path)
+        store.delete_manifest(filename)
+    response_cache.invalidate(filename)
+
+def _read_range(filename, offset, size):
+    """Bytes of a plain or deduplicated server file; FileNotFoundError if neither"""
+    path = Path(SERVER_DIR) / filename
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+    except FileNotFoundError:
+        manifest = store.load_manifest(filename)
+        if manifest is None:
+            raise
+        return store.read_at(manifest, offset, size)
+
 
 def list_files():
-    return os.listdir(SERVER_DIR)
+    plain = [name for name in os.listdir(SERVER_DIR) if not name.startswith(".")]
+    return sorted(set(plain) | set(store.names()))
 
 def upload_file(filename, file_content):
     """Single-shot upload"""
-    path = Path(SERVER_DIR) / filename
-    with open(path, 'wb') as f:
-        f.write(file_content.data)
+    _replace_file(filename, file_content.data)
+    file_bytes.inc(len(file_content.data), direction="in")
     print(f"[Server] Uploaded file: {filename}")
     return True
 
+def _cache_key(filename):
+    """(name, mtime_ns, size) of the file or manifest that holds filename, or None"""
+    path = Path(SERVER_DIR) / filename
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        st = store.manifest_stat(filename)
+        if st is None:
+            return None
+    return (filename, st.st_mtime_ns, st.st_size)
+
 def download_file(filename):
-    """Single-shot download"""
+    """Single-shot download; direct calls are cached by CachedDownloads"""
     path = Path(SERVER_DIR) / filename
-    if not path.exists():
-        print(f"[Server] File {filename} not found")
-        return Binary(b"")
-    with open(path, 'rb') as f:
-        data = f.read()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        manifest = store.load_manifest(filename)
+        if manifest is None:
+            print(f"[Server] File {filename} not found")
+            return Binary(b"")
+        data = store.read_all(manifest)
+    file_bytes.inc(len(data), direction="out")
     print(f"[Server] Downloaded file: {filename}")
     return Binary(data)
 
+def cache_stats():
+    """Hit/miss/eviction counters of the download cache"""
+    return {k: wire_int(v) for k, v in response_cache.stats().items()}
+
+def begin_upload(filename):
+    """Start a chunked upload; returns the session id for put_chunk/commit"""
+    session_id = uuid.uuid4().hex
+    path = Path(SERVER_DIR) / f".upload-{session_id}"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with sessions_lock:
+        upload_sessions[session_id] = {'filename': filename, 'path': path, 'fd': fd,
+                                       'used': time.monotonic(), 'active': 0}
+    print(f"[Server] Upload started: {filename}")
+    return session_id
+
+def _get_session(session_id):
+    """The session, marked in use until _release_session so it cannot expire meanwhile"""
+    with sessions_lock:
+        session = upload_sessions.get(session_id)
+        if session is None:
+            raise ValueError(f"unknown upload session {session_id}")
+        session['active'] += 1
+    return session
+
+def _release_session(session):
+    with sessions_lock:
+        session['active'] -= 1
+        session['used'] = time.monotonic()
+
+def _discard_session(session):
+    os.close(session['fd'])
+    try:
+        os.remove(session['path'])
+    except FileNotFoundError:
+        pass
+
+def expire_uploads(timeout=UPLOAD_TIMEOUT):
+    """Drop upload sessions idle for timeout seconds; returns how many"""
+    now = time.monotonic()
+    with sessions_lock:
+        stale = [session_id for session_id, session in upload_sessions.items()
+                 if not session['active'] and now - session['used'] > timeout]
+        expired = [upload_sessions.pop(session_id) for session_id in stale]
+    for session in expired:
+        _discard_session(session)
+        print(f"[Server] Upload expired: {session['filename']}")
+    return len(expired)
+
+def _expire_uploads_forever(timeout):
+    while True:
+        time.sleep(max(1, timeout / 4))
+        expire_uploads(timeout)
+
+def put_chunk(session_id, offset, data, codec=""):
+    """Write one chunk of a chunked upload at offset (an uncompressed position).
+
+    Offsets past 2 GiB arrive as doubles, see wire_int."""
+    session = _get_session(session_id)
+    try:
+        offset = int(offset)
+        raw = data.data
+        if codec:
+            raw = compression.decompress_chunk(codec, raw, MAX_CHUNK_SIZE)
+        view = memoryview(raw)
+        written = 0
+        while written < len(view):
+            written += os.pwrite(session['fd'], view[written:], offset + written)
+    finally:
+        _release_session(session)
+    file_bytes.inc(written, direction="in")
+    return written
+
+def commit(session_id):
+    """Finish a chunked upload and move it into place"""
+    with sessions_lock:
+        session = upload_sessions.pop(session_id, None)
+    if session is None:
+        raise ValueError(f"unknown upload session {session_id}")
+    os.close(session['fd'])
+    with file_lock(session['filename']):
+        os.replace(session['path'], Path(SERVER_DIR) / session['filename'])
+        store.delete_manifest(session['filename'])
+    response_cache.invalidate(session['filename'])
+    print(f"[Server] Uploaded file: {session['filename']}")
+    return True
+
+def abort_upload(session_id):
+    """Drop a chunked upload without touching the target file"""
+    with sessions_lock:
+        session = upload_sessions.pop(session_id, None)
+    if session is None:
+        return False
+    _discard_session(session)
+    return True
+
+def file_size(filename):
+    """Size of a server file in bytes (a double past 2 GiB), or -1 if it does not exist"""
+    path = Path(SERVER_DIR) / filename
+    if path.is_file():
+        return wire_int(path.stat().st_size)
+    manifest = store.load_manifest(filename)
+    if manifest is None:
+        return -1
+    return wire_int(store.size(manifest))
+
+def read_chunk(filename, offset, size, codecs=None):
+    """Read up to size bytes at offset; an empty result means end of file.
+
+    If the client lists codecs it accepts, the chunk is compressed when
+    that pays off and a {'codec', 'size', 'data'} struct is returned.
+    Offsets past 2 GiB arrive as doubles, see wire_int."""
+    data = _read_range(filename, int(offset), min(int(size), MAX_CHUNK_SIZE))
+    file_bytes.inc(len(data), direction="out")
+    if codecs is None:
+        return Binary(data)
+    codec = compression.choose_codec(data, codecs)
+    if codec:
+        packed = compression.compress_chunk(codec, data)
+        if len(packed) < len(data):
+            return {'codec': codec, 'size': len(data), 'data': Binary(packed)}
+    return {'codec': '', 'size': len(data), 'data': Binary(data)}
+
+def codecs():
+    """Compression codecs this server accepts, most preferred first"""
+    return compression.supported()
+
+def have_chunks(hashes):
+    """Return the hashes the chunk store does not have yet"""
+    return store.missing(hashes)
+
+def store_chunks(blobs):
+    """Add chunks to the store; returns their hashes"""
+    hashes = []
+    for blob in blobs:
+        with chunk_seconds.time():
+            hashes.append(store.put(blob.data))
+        file_bytes.inc(len(blob.data), direction="in")
+    return hashes
+
+def commit_manifest(filename, chunks):
+    """Make filename the file made of chunks ([[hash, size], ...])"""
+    with file_lock(filename):
+        store.save_manifest(filename, chunks)
+        path = Path(SERVER_DIR) / filename
+        if path.exists():
+            os.remove(path)
+    response_cache.invalidate(filename)
+    print(f"[Server] Uploaded file: {filename} ({len(chunks)} chunks, deduplicated)")
+    return True
+
+def get_manifest(filename):
+    """Chunk list of a deduplicated file, or None"""
+    return store.load_manifest(filename)
+
+def metrics_snapshot(fmt="prometheus"):
+    """Current metrics as Prometheus text, or as a JSON string for fmt='json'"""
+    if fmt == "json":
+        return json.dumps(registry.snapshot())
+    return metrics.prometheus_text([({}, registry.snapshot())])
+
 def add_file(filename, content_str):
     """Add text file on server"""
-    path = Path(SERVER_DIR) / filename
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(content_str)
+    _replace_file(filename, content_str.encode('utf-8'))
     print(f"[Server] Created file: {filename}")
     return True
 
@@ -48,16 +300,216 @@ def send_message(msg):
 
 
 class RequestHandler(SimpleXMLRPCRequestHandler):
+    """Serves one request per call; the server decides what happens to the
+    connection afterwards (see PooledXMLRPCServer)"""
     rpc_paths = ('/RPC2',)
+    # Keep connections open between calls
+    protocol_version = "HTTP/1.1"
+    # Limit on reading a request once it has started
+    timeout = 10
+
+    def handle(self):
+        # parse_request sets close_connection from the request headers
+        self.close_connection = True
+        self.handle_one_request()
+
+
+class SingleRequestHandler(RequestHandler):
+    """For the one-thread server: HTTP/1.0 replies tell the client to close
+    the connection, so a kept-alive client cannot block everyone else"""
+    protocol_version = "HTTP/1.0"
+
+
+class MeteredDispatch:
+    """Times every call, multicall members included, and logs the slow ones"""
+
+    def _dispatch(self, method, params):
+        start = time.perf_counter()
+        try:
+            return super()._dispatch(method, params)
+        except Exception:
+            rpc_errors.inc(method=method)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            rpc_seconds.observe(elapsed, method=method)
+            if events and elapsed >= SLOW_CALL:
+                events.log("slow_call", method=method, seconds=round(elapsed, 6))
+
+
+class CachedDownloads:
+    """Answers direct download_file calls from response_cache.
+
+    Base64 and XML marshalling cost more than reading the file, so the
+    cache keeps the finished response body, keyed by (name, mtime_ns,
+    size).  download_file inside a multicall is marshalled as usual."""
+
+    DOWNLOAD_CALL = b"<methodName>download_file</methodName>"
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        key = None
+        # Only a small request can be a download; uploads are never parsed twice
+        if len(data) < 4096 and self.DOWNLOAD_CALL in data:
+            try:
+                (filename,), method = xmlrpc.client.loads(data)
+                key = _cache_key(filename)
+            except Exception:
+                pass            # malformed; the normal path reports it
+        if key is None:
+            return super()._marshaled_dispatch(data, dispatch_method, path)
+        start = time.perf_counter()
+        response = response_cache.get(key)
+        if response is not None:
+            file_bytes.inc(key[2], direction="out")
+            rpc_seconds.observe(time.perf_counter() - start, method="download_file")
+            return response
+        response = super()._marshaled_dispatch(data, dispatch_method, path)
+        if b"<fault>" not in response[:256]:
+            response_cache.put(key, response, len(response))
+        return response
+
+
+class MeteredXMLRPCServer(CachedDownloads, MeteredDispatch, SimpleXMLRPCServer):
+    pass
+
+
+class PooledXMLRPCServer(CachedDownloads, MeteredDispatch, SimpleXMLRPCServer):
+    """XML-RPC server that handles requests on a fixed-size thread pool.
+
+    A pool thread serves one request, not one connection.  Between
+    requests a kept-alive connection waits in a selector, and it goes back
+    on the pool queue when its next request arrives.  Idle clients hold no
+    thread, and clients beyond the pool size take turns instead of
+    starving.  Connections idle for IDLE_TIMEOUT seconds are closed.
+    Clients must not pipeline requests; xmlrpc.client never does."""
+
+    IDLE_TIMEOUT = 10
+
+    def __init__(self, addr, workers, **kwargs):
+        super().__init__(addr, **kwargs)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.idle = selectors.DefaultSelector()
+        self.parked = queue.SimpleQueue()
+        self.wakeup, self.waker = socket.socketpair()
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.closing = False
+        self.watcher = threading.Thread(target=self._watch_idle, name="idle-connections", daemon=True)
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        requests_queued.inc()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        keep = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            keep = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            requests_queued.dec()
+            if keep and not self.closing:
+                # Only the watcher thread touches the selector
+                self.parked.put((request, client_address))
+                self.waker.send(b"\0")
+            else:
+                self.shutdown_request(request)
+
+    def _watch_idle(self):
+        last_sweep = time.monotonic()
+        while not self.closing:
+            for key, _ in self.idle.select(timeout=1.0):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    continue
+                # The next request (or EOF) has arrived
+                self.idle.unregister(key.fileobj)
+                self.process_request(key.fileobj, key.data[0])
+            now = time.monotonic()
+            while True:
+                try:
+                    request, client_address = self.parked.get_nowait()
+                except queue.Empty:
+                    break
+                self.idle.register(request, selectors.EVENT_READ, (client_address, now))
+            if now - last_sweep >= 1.0:
+                last_sweep = now
+                for key in list(self.idle.get_map().values()):
+                    if key.data and now - key.data[1] > self.IDLE_TIMEOUT:
+                        self.idle.unregister(key.fileobj)
+                        self.shutdown_request(key.fileobj)
+
+    def server_close(self):
+        self.closing = True
+        self.waker.send(b"\0")
+        self.watcher.join()
+        for key in list(self.idle.get_map().values()):
+            if key.data:
+                self.shutdown_request(key.fileobj)
+        self.idle.close()
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XML-RPC file server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=8,
+                        help="request handler threads (0 = one request at a time)")
+    parser.add_argument("--cache-mb", type=int, default=256,
+                        help="memory for cached download_file response bodies")
+    parser.add_argument("--upload-timeout", type=float, default=UPLOAD_TIMEOUT,
+                        help="seconds before an idle chunked upload is dropped")
+    parser.add_argument("--metrics", default="server_metrics",
+                        help="event log <name>.jsonl; snapshots <name>.prom/.json on exit")
+    args = parser.parse_args()
+    response_cache.max_bytes = args.cache_mb * 1024 * 1024
+    global events
+    events = metrics.EventLog(args.metrics + ".jsonl")
+    threading.Thread(target=_expire_uploads_forever, args=(args.upload_timeout,),
+                     name="upload-expiry", daemon=True).start()
+
+    if args.workers > 0:
+        server = PooledXMLRPCServer((args.host, args.port), args.workers,
+                                    requestHandler=RequestHandler,
+                                    allow_none=True)
+    else:
+        server = MeteredXMLRPCServer((args.host, args.port),
+                                     requestHandler=SingleRequestHandler,
+                                     allow_none=True)
+    server.register_multicall_functions()
+    server.register_function(list_files, 'list_files')
+    server.register_function(upload_file, 'upload_file')
+    server.register_function(download_file, 'download_file')
+    server.register_function(add_file, 'add_file')
+    server.register_function(send_message, 'send_message')
+    server.register_function(begin_upload, 'begin_upload')
+    server.register_function(put_chunk, 'put_chunk')
+    server.register_function(commit, 'commit')
+    server.register_function(abort_upload, 'abort_upload')
+    server.register_function(file_size, 'file_size')
+    server.register_function(read_chunk, 'read_chunk')
+    server.register_function(codecs, 'codecs')
+    server.register_function(have_chunks, 'have_chunks')
+    server.register_function(store_chunks, 'store_chunks')
+    server.register_function(commit_manifest, 'commit_manifest')
+    server.register_function(get_manifest, 'get_manifest')
+    server.register_function(cache_stats, 'cache_stats')
+    server.register_function(metrics_snapshot, 'metrics')
+
+    print(f"[Server] XML-RPC Server running on port {args.port} ({args.workers} workers)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[Server] Shutting down")
+    finally:
+        server.server_close()
+        registry.write(args.metrics + ".prom")
+        registry.write(args.metrics + ".json")
+        events.close()
+
 
-server = SimpleXMLRPCServer(("localhost", 8000),
-                            requestHandler=RequestHandler,
-                            allow_none=True)
-server.register_function(list_files, 'list_files')
-server.register_function(upload_file, 'upload_file')
-server.register_function(download_file, 'download_file')
-server.register_function(add_file, 'add_file')
-server.register_function(send_message, 'send_message')
-
-print("[Server] XML-RPC Server running on port 8000")
-server.serve_forever()
+if __name__ == "__main__":
+    main()
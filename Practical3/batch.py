@@ -0,0 +1,296 @@
+"""Non-interactive batch mode for FileTransfer.
+
+    mpiexec -n 8 python file_transfer_mpi.py --batch jobs.txt
+
+A job file holds one job per line ('#' starts a comment):
+
+    put <file>              the master sends file to a worker
+    get <file>              a worker sends its copy of file to the master
+    copy <file> <worker>    a worker sends its copy of file to another worker
+    checksum <file>         a worker hashes file
+    wordcount <file>        a worker counts the words in file
+    longest <file>          a worker finds the longest line of file
+
+A trailing '@<worker>' pins a job to that worker.  The master keeps the
+central queue and gives each worker up to `prefetch` jobs, topping it up
+as results come back.  Once the queue is empty, a worker that runs dry
+makes the master steal half of the unstarted jobs of the worker with the
+longest backlog.  Failed jobs are retried up to MAX_RETRIES times, on any
+worker unless pinned.
+"""
+from collections import Counter, deque
+import os
+import time
+import hashing
+from longest_path_mpi import LongestLines, scan_split
+from mapreduce_mpi import map_split, read_split
+
+JOB_TAG = 5
+DEFAULT_PREFETCH = 4
+MAX_RETRIES = 2
+
+# kind -> number of arguments
+KINDS = {'put': 1, 'get': 1, 'copy': 2, 'checksum': 1, 'wordcount': 1, 'longest': 1}
+
+
+def parse_jobs(path, workers):
+    """List of job dicts from a job file; raises ValueError on a bad line"""
+    jobs = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            parts = line.split('#', 1)[0].split()
+            if not parts:
+                continue
+            pin = None
+            if parts[-1].startswith('@'):
+                pin = int(parts.pop()[1:])
+                if pin not in workers:
+                    raise ValueError(f"line {lineno}: no worker {pin}")
+            kind, args = parts[0].lower(), parts[1:]
+            if KINDS.get(kind) != len(args):
+                raise ValueError(f"line {lineno}: bad job {line.strip()!r}")
+            if kind == 'copy':
+                args[1] = int(args[1])
+                if args[1] not in workers:
+                    raise ValueError(f"line {lineno}: no worker {args[1]}")
+            jobs.append({'id': len(jobs), 'kind': kind, 'args': args, 'pin': pin, 'attempt': 0})
+    return jobs
+
+
+def run_task(kind, path, algo):
+    """Run a compute job on a local file; returns (result text, bytes read)"""
+    size = os.path.getsize(path)
+    if kind == 'checksum':
+        return f"{algo} {hashing.tree_hash(path, algo)[0][:16]}", size
+    if kind == 'wordcount':
+        counts = Counter()
+        map_split(read_split(path, 0, size), counts)
+        return f"{sum(counts.values())} words, {len(counts)} distinct", size
+    if kind == 'longest':
+        lines = LongestLines(1)
+        scan_split(path, 0, size, lines)
+        return f"longest line {lines.length} bytes", size
+    raise ValueError(f"unknown task {kind!r}")
+
+
+class BusyClock:
+    """Time during which at least one job was running"""
+
+    def __init__(self):
+        self.active = 0
+        self.since = 0.0
+        self.total = 0.0
+
+    def start(self):
+        if not self.active:
+            self.since = time.perf_counter()
+        self.active += 1
+
+    def stop(self):
+        self.active -= 1
+        if not self.active:
+            self.total += time.perf_counter() - self.since
+
+
+class WorkerJobs:
+    """Worker side: a local job queue run from the dispatcher loop"""
+
+    def __init__(self, ft):
+        self.ft = ft
+        self.queue = deque()
+        self.clock = BusyClock()
+        ft.dispatcher.on(JOB_TAG, self.on_message)
+        ft.dispatcher.add_task(self.run_next)
+
+    def on_message(self, src, msg):
+        m = msg.recv()
+        if m['op'] == 'job':
+            self.queue.append(m['job'])
+        elif m['op'] == 'steal':
+            # Give away the most recently queued jobs that may move
+            stolen, kept = deque(), deque()
+            while self.queue and len(stolen) < m['n']:
+                job = self.queue.pop()
+                (kept if job['pin'] else stolen).appendleft(job)
+            self.queue.extend(kept)
+            self.ft.comm.send({'op': 'stolen', 'jobs': list(stolen)}, dest=0, tag=JOB_TAG)
+
+    def run_next(self):
+        if not self.queue:
+            return False
+        job = self.queue.popleft()
+        self.clock.start()
+        kind, args = job['kind'], job['args']
+        try:
+            if kind in ('get', 'copy'):
+                dest = 0 if kind == 'get' else args[1]
+                if dest == self.ft.rank:
+                    raise ValueError("cannot send a file to self")
+                info = self.ft.get_file_info(args[0])
+                if info is None:
+                    raise FileNotFoundError(args[0])
+                flow = self.ft.scheduler.send(args[0], info, dest)
+                # Finished when the receiver has verified the file
+                self.ft.flow_callbacks[flow] = lambda flow: self.finish(
+                    job, flow.ok, f"sent to rank {dest}" if flow.ok else flow.error or "verification failed",
+                    info['size'])
+            else:
+                result, size = run_task(kind, args[0], self.ft.hash_algo)
+                self.finish(job, True, result, size)
+        except Exception as e:
+            self.finish(job, False, f"{type(e).__name__}: {e}", 0)
+        return True
+
+    def finish(self, job, ok, result, size):
+        self.clock.stop()
+        self.ft.comm.send({'op': 'done', 'id': job['id'], 'ok': ok, 'result': result,
+                           'bytes': size, 'busy': self.clock.total}, dest=0, tag=JOB_TAG)
+
+
+class BatchRunner:
+    """Master side: central queue, prefetch, stealing, retries and stats"""
+
+    def __init__(self, ft, jobs, prefetch=DEFAULT_PREFETCH):
+        self.ft = ft
+        self.jobs = {job['id']: job for job in jobs}
+        self.prefetch = prefetch
+        self.workers = list(range(1, ft.size))
+        self.pending = deque(job for job in jobs if job['pin'] is None)
+        self.pinned = {w: deque() for w in self.workers}
+        for job in jobs:
+            if job['pin'] is not None:
+                self.pinned[job['pin']].append(job)
+        self.outstanding = {w: set() for w in self.workers}
+        self.stealing = set()
+        self.dry = set()            # started everything they hold
+        self.busy = {w: 0.0 for w in self.workers}
+        self.master_busy = {w: 0.0 for w in self.workers}
+        self.done = {w: 0 for w in self.workers}
+        self.stolen = {w: 0 for w in self.workers}
+        self.failed = []
+        self.retries = 0
+        self.bytes = 0
+        self.finished = 0
+        ft.dispatcher.on(JOB_TAG, self.on_message)
+
+    def assign(self, worker, job):
+        self.outstanding[worker].add(job['id'])
+        if job['kind'] == 'put':
+            # The master itself sends; the worker only receives
+            start = time.perf_counter()
+            info = self.ft.get_file_info(job['args'][0])
+            if info is None:
+                # Only record it: fill() is the caller and takes up a retry in its own loop
+                self.record(worker, job['id'], False, f"FileNotFoundError: {job['args'][0]}", 0)
+                return
+            flow = self.ft.scheduler.send(job['args'][0], info, worker)
+            def done(flow):
+                self.master_busy[worker] += time.perf_counter() - start
+                self.complete(worker, job['id'], flow.ok,
+                              "verified" if flow.ok else flow.error or "verification failed", info['size'])
+            self.ft.flow_callbacks[flow] = done
+        else:
+            self.ft.comm.send({'op': 'job', 'job': job}, dest=worker, tag=JOB_TAG)
+
+    def next_job(self, worker):
+        """Pinned jobs first, then the oldest queued job the worker may run"""
+        if self.pinned[worker]:
+            return self.pinned[worker].popleft()
+        for i, job in enumerate(self.pending):
+            # A copy never goes to the worker it is meant for
+            if job['kind'] != 'copy' or job['args'][1] != worker:
+                del self.pending[i]
+                return job
+        return None
+
+    def fill(self):
+        """Top up every worker, least loaded first, then steal for idle ones"""
+        for worker in sorted(self.workers, key=lambda w: len(self.outstanding[w])):
+            while len(self.outstanding[worker]) < self.prefetch:
+                job = self.next_job(worker)
+                if job is None:
+                    break
+                self.assign(worker, job)
+        idle = [w for w in self.workers if not self.outstanding[w]]
+        if not idle:
+            return
+        candidates = [w for w in self.workers if w not in self.dry and w not in self.stealing]
+        if not candidates:
+            return
+        victim = max(candidates, key=lambda w: len(self.outstanding[w]))
+        if len(self.outstanding[victim]) > 1:
+            self.stealing.add(victim)
+            self.ft.comm.send({'op': 'steal', 'n': len(self.outstanding[victim]) // 2},
+                              dest=victim, tag=JOB_TAG)
+
+    def on_message(self, src, msg):
+        m = msg.recv()
+        if m['op'] == 'done':
+            self.busy[src] = m['busy']
+            self.complete(src, m['id'], m['ok'], m['result'], m['bytes'])
+        elif m['op'] == 'stolen':
+            self.stealing.discard(src)
+            if not m['jobs']:
+                self.dry.add(src)
+            for job in reversed(m['jobs']):
+                self.outstanding[src].discard(job['id'])
+                self.pending.appendleft(self.jobs[job['id']])
+            self.stolen[src] += len(m['jobs'])
+            self.fill()
+
+    def complete(self, worker, job_id, ok, result, size):
+        self.record(worker, job_id, ok, result, size)
+        self.fill()
+
+    def record(self, worker, job_id, ok, result, size):
+        """Count a finished attempt; a failed one is queued again or given up"""
+        job = self.jobs[job_id]
+        self.outstanding[worker].discard(job_id)
+        self.dry.discard(worker)
+        reporter = self.ft.reporter
+        if ok:
+            self.done[worker] += 1
+            self.bytes += size
+            self.finished += 1
+            if reporter:
+                reporter.emit("done", op=job['kind'], file=" ".join(map(str, job['args'])), job=job_id,
+                              worker=worker, bytes=size, result=result)
+        elif job['attempt'] < MAX_RETRIES:
+            job['attempt'] += 1
+            self.retries += 1
+            print(f"[Master] Job {job_id} ({job['kind']} {' '.join(map(str, job['args']))}) "
+                  f"failed on Worker {worker}: {result}; retrying")
+            if job['pin'] is None:
+                self.pending.append(job)
+            else:
+                self.pinned[worker].append(job)
+        else:
+            self.failed.append((job, result))
+            self.finished += 1
+            if reporter:
+                reporter.emit("error", op=job['kind'], file=" ".join(map(str, job['args'])), job=job_id,
+                              worker=worker, error=result)
+
+    def run(self):
+        """Run every job; returns when each has succeeded or run out of retries"""
+        print(f"\n[Master] Batch: {len(self.jobs)} jobs on {len(self.workers)} workers, "
+              f"prefetch {self.prefetch}")
+        start = time.perf_counter()
+        self.fill()
+        self.ft.dispatcher.run(lambda: self.finished < len(self.jobs))
+        self.makespan = time.perf_counter() - start
+        self.report()
+
+    def report(self):
+        span = max(self.makespan, 1e-9)
+        ok = len(self.jobs) - len(self.failed)
+        print(f"\n===== BATCH SUMMARY =====")
+        print(f"Jobs: {ok} ok, {len(self.failed)} failed, {self.retries} retries")
+        print(f"Makespan: {span:.3f}s, throughput {ok / span:.1f} jobs/s, "
+              f"{self.bytes / span / 1e6:.1f} MB/s")
+        print(f"  Worker   Jobs  Busy s   Util  Stolen")
+        for w in self.workers:
+            busy = self.busy[w] + self.master_busy[w]
+            print(f"  {w:6} {self.done[w]:6} {busy:7.2f} {busy / span:6.0%} {self.stolen[w]:7}")
+        for job, result in self.failed:
+            print(f"  FAILED job {job['id']}: {job['kind']} {' '.join(map(str, job['args']))} - {result}")
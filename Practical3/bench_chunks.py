@@ -0,0 +1,72 @@
+"""Compare pickled comm.send chunks with the buffer-based Send/Recv path.
+
+Rank 0 streams --total bytes to rank 1 in chunks of each size, once with
+lowercase send/recv of bytes objects (the old FileTransfer path) and once
+with Send/Recv on reused buffers, as FileTransfer does:
+
+    mpiexec -n 2 python bench_chunks.py --total 1G --sizes 4K 64K 1M 4M
+"""
+from mpi4py import MPI
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import parse_size
+
+TAG = 7
+
+
+def pickled(comm, data, chunk_size, total):
+    if comm.rank == 0:
+        for offset in range(0, total, chunk_size):
+            # A fresh bytes object per chunk, like f.read(chunk_size)
+            comm.send(bytes(data[:min(chunk_size, total - offset)]), dest=1, tag=TAG)
+    else:
+        for offset in range(0, total, chunk_size):
+            comm.recv(source=0, tag=TAG)
+
+
+def buffered(comm, data, chunk_size, total):
+    view = memoryview(data)
+    if comm.rank == 0:
+        for offset in range(0, total, chunk_size):
+            comm.Send([view[:min(chunk_size, total - offset)], MPI.BYTE], dest=1, tag=TAG)
+    else:
+        status = MPI.Status()
+        for offset in range(0, total, chunk_size):
+            comm.Recv([data, MPI.BYTE], source=0, tag=TAG, status=status)
+            status.Get_count(MPI.BYTE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--total", default="1G", help="bytes per measurement")
+    parser.add_argument("--sizes", nargs="+", default=["4K", "16K", "64K", "256K", "1M", "4M"])
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.size != 2:
+        if comm.rank == 0:
+            print("Run with exactly 2 processes: mpiexec -n 2 python bench_chunks.py")
+        return
+    total = parse_size(args.total)
+
+    if comm.rank == 0:
+        print(f"{'chunk':>8} {'pickled GB/s':>13} {'buffer GB/s':>12} {'speedup':>8}")
+    for chunk_size in map(parse_size, args.sizes):
+        data = bytearray(chunk_size)
+        rates = []
+        for path in (pickled, buffered):
+            comm.Barrier()
+            start = time.perf_counter()
+            path(comm, data, chunk_size, total)
+            comm.Barrier()
+            rates.append(total / (time.perf_counter() - start) / 1e9)
+        if comm.rank == 0:
+            print(f"{chunk_size // 1024:>7}K {rates[0]:13.2f} {rates[1]:12.2f} {rates[1] / rates[0]:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Control-message round-trip latency: polling loop vs Dispatcher.
+
+Rank 0 pings every worker in turn and times the reply.  Workers serve
+the pings either with the old FileTransfer loop (Iprobe each source, then
+sleep 0.1 s) or with the improbe-based Dispatcher; the CPU seconds each
+worker burned are reported as well.  Run it for several world sizes:
+
+    for n in 2 4 8 16 32 64; do mpiexec -n $n python bench_latency.py; done
+"""
+from mpi4py import MPI
+import argparse
+import sys
+import time
+from pathlib import Path
+from dispatcher import Dispatcher
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import percentile
+
+PING_TAG, PONG_TAG = 2, 3
+PING, STOP = 1, -1
+
+
+def poll_worker(comm):
+    """The loop FileTransfer workers used before the Dispatcher"""
+    while True:
+        for src in range(comm.size):
+            if src != comm.rank and comm.Iprobe(source=src, tag=PING_TAG):
+                sig = comm.recv(source=src, tag=PING_TAG)
+                if sig == STOP:
+                    return
+                comm.send(sig, dest=src, tag=PONG_TAG)
+        time.sleep(0.1)
+
+
+def dispatch_worker(comm):
+    state = {'running': True}
+
+    def on_ping(src, msg):
+        sig = msg.recv()
+        if sig == STOP:
+            state['running'] = False
+        else:
+            comm.send(sig, dest=src, tag=PONG_TAG)
+
+    dispatcher = Dispatcher(comm)
+    dispatcher.on(PING_TAG, on_ping)
+    dispatcher.run(lambda: state['running'])
+
+
+def master(comm, rounds):
+    samples = []
+    for _ in range(rounds):
+        for worker in range(1, comm.size):
+            start = time.perf_counter()
+            comm.send(PING, dest=worker, tag=PING_TAG)
+            comm.recv(source=worker, tag=PONG_TAG)
+            samples.append(time.perf_counter() - start)
+    for worker in range(1, comm.size):
+        comm.send(STOP, dest=worker, tag=PING_TAG)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5, help="pings per worker and mode")
+    parser.add_argument("--modes", nargs="+", default=["poll", "dispatch"], choices=["poll", "dispatch"])
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.size < 2:
+        print("Need at least 2 processes: mpiexec -n 4 python bench_latency.py")
+        return
+    if comm.rank == 0:
+        print(f"{'ranks':>5} {'mode':>9} {'p50 ms':>9} {'p99 ms':>9} {'worker cpu s':>13}")
+
+    for mode in args.modes:
+        comm.Barrier()
+        cpu = time.process_time()
+        if comm.rank == 0:
+            samples = master(comm, args.rounds)
+        elif mode == "poll":
+            poll_worker(comm)
+        else:
+            dispatch_worker(comm)
+        cpu = comm.gather(time.process_time() - cpu, root=0)
+        if comm.rank == 0:
+            p50 = percentile(samples, 50) * 1e3
+            p99 = percentile(samples, 99) * 1e3
+            print(f"{comm.size:5} {mode:>9} {p50:9.3f} {p99:9.3f} {sum(cpu[1:]) / (comm.size - 1):13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Scaling benchmark for mapreduce_mpi.word_count.
+
+Rank 0 writes synthetic text of each --sizes value (Zipf-like word
+frequencies) into --dir, then all ranks run the job and the slowest
+rank's phase times are printed.  Vary the rank count from the shell:
+
+    for n in 1 2 4 8; do mpiexec -n $n python bench_mapreduce.py --sizes 16M 64M 256M; done
+"""
+from mpi4py import MPI
+import argparse
+import os
+import random
+import sys
+from pathlib import Path
+from mapreduce_mpi import word_count
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common.bench import parse_size
+
+VOCABULARY = 50000
+
+
+def write_text(path, size):
+    rng = random.Random(size)
+    words = [''.join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10)))
+             for _ in range(VOCABULARY)]
+    weights = [1 / (i + 1) for i in range(VOCABULARY)]
+    with open(path, 'w') as f:
+        written = 0
+        while written < size:
+            line = " ".join(rng.choices(words, weights, k=1000)) + ".\n"
+            f.write(line)
+            written += len(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=["16M", "64M"])
+    parser.add_argument("--dir", default=".", help="shared directory for the generated input")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.rank == 0:
+        print(f"{'ranks':>5} {'input':>8} {'map s':>8} {'shuffle s':>10} {'reduce s':>9} {'total s':>8} {'MB/s':>8}")
+    for size in map(parse_size, args.sizes):
+        path = os.path.join(args.dir, f"bench_words_{size}.txt")
+        if comm.rank == 0 and not (os.path.exists(path) and os.path.getsize(path) >= size):
+            write_text(path, size)
+        comm.Barrier()
+        result, timings = word_count(comm, [path])
+        everyone = comm.gather(timings, root=0)
+        if comm.rank == 0:
+            worst = {k: max(t[k] for t in everyone) for k in timings}
+            mb = os.path.getsize(path) / 1e6
+            print(f"{comm.size:5} {mb:7.0f}M {worst['map']:8.3f} {worst['shuffle']:10.3f} "
+                  f"{worst['reduce']:9.3f} {worst['total']:8.3f} {mb / worst['total']:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
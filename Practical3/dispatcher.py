@@ -0,0 +1,115 @@
+"""Single-threaded event loop for MPI messages and console input.
+
+One improbe(ANY_SOURCE, ANY_TAG) finds the next message whatever rank or
+tag it comes from, so the cost of a poll does not grow with the world
+size.  The matched message is handed to the handler registered for its
+tag, which receives it with msg.recv() (mrecv), so no other probe can
+steal it in between.
+
+Console lines are read by a helper thread that never calls MPI; only the
+loop thread does, which needs no more than MPI_THREAD_FUNNELED.  While
+nothing happens the loop waits on the input queue, starting at zero and
+doubling up to MAX_IDLE, so a message waits at most a few milliseconds
+on an idle rank and not at all on a busy one.
+"""
+from mpi4py import MPI
+import queue
+import threading
+
+MIN_IDLE = 0.00005
+MAX_IDLE = 0.005
+# Messages handled before tasks get a turn, so a task cannot starve them
+MAX_BURST = 64
+
+
+class Dispatcher:
+    def __init__(self, comm):
+        self.comm = comm
+        self.handlers = {}
+        self.ranges = []
+        self.tasks = []
+        self.unexpected = None
+        self.inputs = queue.Queue()
+        self.input_handler = None
+        self.status = MPI.Status()
+        if MPI.Query_thread() < MPI.THREAD_FUNNELED:
+            raise RuntimeError("MPI must be initialised with at least MPI_THREAD_FUNNELED")
+
+    def on(self, tag, handler):
+        """Call handler(source, msg) for each message with tag"""
+        self.handlers[tag] = handler
+
+    def on_range(self, low, handler):
+        """Call handler(source, tag, msg) for tags >= low without their own handler.
+
+        If it returns False the message is discarded like an unclaimed one."""
+        self.ranges.append((low, handler))
+        self.ranges.sort(key=lambda r: -r[0])
+
+    def add_task(self, task):
+        """Call task() on every pass of the loop; it returns True when it did work"""
+        self.tasks.append(task)
+
+    def on_other(self, handler):
+        """Call handler(source, tag) after discarding a message no handler claims"""
+        self.unexpected = handler
+
+    def on_input(self, stream, handler):
+        """Call handler(line) from the loop thread for each line of stream"""
+        self.input_handler = handler
+
+        def reader():
+            for line in stream:
+                self.inputs.put(line)
+
+        threading.Thread(target=reader, daemon=True).start()
+
+    def poll(self):
+        """Dispatch one pending message; returns False if there was none"""
+        msg = self.comm.improbe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=self.status)
+        if msg is None:
+            return False
+        source, tag = self.status.Get_source(), self.status.Get_tag()
+        handler = self.handlers.get(tag)
+        if handler:
+            handler(source, msg)
+            return True
+        for low, handler in self.ranges:
+            if tag >= low:
+                if handler(source, tag, msg) is not False:
+                    return True
+                break
+        # Raw receive: stray data chunks are not pickles
+        msg.Recv([bytearray(self.status.Get_count(MPI.BYTE)), MPI.BYTE])
+        if self.unexpected:
+            self.unexpected(source, tag)
+        return True
+
+    def step(self):
+        """Drain pending messages (up to MAX_BURST), then give each task a turn.
+
+        Returns True if anything happened."""
+        busy = False
+        for _ in range(MAX_BURST):
+            if not self.poll():
+                break
+            busy = True
+        for task in self.tasks:
+            busy |= bool(task())
+        return busy
+
+    def run(self, running):
+        """Dispatch messages and input until running() is false"""
+        idle = 0
+        while running():
+            if self.step():
+                idle = 0
+                continue
+            try:
+                line = self.inputs.get(timeout=idle) if idle else self.inputs.get_nowait()
+            except queue.Empty:
+                idle = min(max(idle * 2, MIN_IDLE), MAX_IDLE)
+                continue
+            idle = 0
+            if self.input_handler:
+                self.input_handler(line)
@@ -1,53 +1,132 @@
 from mpi4py import MPI
+from pathlib import Path
+import json
 import os
 import sys
-import hashlib
-import threading
 import time
+import argparse
+from contextlib import redirect_stdout
+import hashing
+from batch import BatchRunner, WorkerJobs, parse_jobs, DEFAULT_PREFETCH
+from dispatcher import Dispatcher
+from scheduler import TransferScheduler, FLOW_TAG, DATA_TAG_BASE
+from transfer_engine import ChunkBroadcaster, StripedIO, stripe_range
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import cli, metrics
 
 CHUNK_SIZE = 65536
+# The master collects from every worker at once; each stream costs one chunk buffer
+MASTER_MAX_INCOMING = 16
+# A collect gives up on workers once no transfer message has arrived for this long
+COLLECT_TIMEOUT = 30.0
+# Worker-to-worker transfers not reported back in this long are given up on
+RELAY_TIMEOUT = 600.0
 METADATA_TAG, DATA_TAG, CONTROL_TAG, MESSAGE_TAG = 0, 1, 2, 3
-TERMINATE, TRANSFER, COMPLETE, WORKER_SEND, BROADCAST = -1, 1, 2, 3, 4
+TERMINATE, TRANSFER, COMPLETE, WORKER_SEND, BROADCAST, BCAST_FILE = -1, 1, 2, 3, 4, 5
+SCATTER_FILE, GATHER_FILE, METRICS = 6, 7, 8
 
 class FileTransfer:
-    def __init__(self):
+    def __init__(self, chunk_size=CHUNK_SIZE):
         self.comm = MPI.COMM_WORLD
+        self.chunk_size = chunk_size
         self.rank = self.comm.Get_rank()
         self.size = self.comm.Get_size()
         self.running = True
         self.is_master = (self.rank == 0)
         self.messages = []
-        
-        # Start message listener thread for workers
-        if not self.is_master:
-            self.msg_thread = threading.Thread(target=self.worker_message_listener, daemon=True)
-            self.msg_thread.start()
+        self.broadcaster = ChunkBroadcaster(self.comm)
+        self.striped = StripedIO(self.comm)
+        self.hash_algo = hashing.DEFAULT
+        self.delta = False          # offer delta updates of existing copies
+        self.log_file = None
+        self.reporter = None        # cli.Reporter when run from the command line
+        
+        # Counters and histograms per rank; transfer events as JSON lines
+        self.metrics = metrics.Registry()
+        self.events = metrics.EventLog(f"metrics_rank{self.rank}.jsonl")
+        self.checksum_seconds = self.metrics.histogram("mpi_checksum_seconds", "Time spent hashing files")
+        
+        # Point-to-point transfers run concurrently, driven by the dispatcher
+        self.scheduler = TransferScheduler(self.comm, chunk_size, self.incoming_name,
+                                           self.on_received, self.on_sent, registry=self.metrics)
+        if self.is_master:
+            self.scheduler.max_incoming = MASTER_MAX_INCOMING
+        self.dispatcher = Dispatcher(self.comm)
+        self.dispatcher.on(FLOW_TAG, self.scheduler.on_flow)
+        self.dispatcher.on_range(DATA_TAG_BASE, self.scheduler.on_data)
+        self.dispatcher.add_task(self.scheduler.pump)
+        self.flow_callbacks = {}    # OutgoingFlow -> called when it is done
+        self.collecting = {}        # (worker, file name) -> result, None while pending
+        self.relaying = {}          # (src, dst, file name) -> result, None while pending
+        if self.is_master:
+            self.dispatcher.on(MESSAGE_TAG, self.master_on_message)
+            self.dispatcher.on(CONTROL_TAG, self.master_on_control)
     
-    def checksum(self, filepath):
-        h = hashlib.md5()
-        with open(filepath, "rb") as f:
-            while chunk := f.read(8192):
-                h.update(chunk)
-        return h.hexdigest()
+    def checksum(self, filepath, algo=None):
+        """Tree hash of a file on disk, computed by a thread pool"""
+        with self.checksum_seconds.time(kind="file"):
+            return hashing.tree_hash(filepath, algo or self.hash_algo, self.chunk_size)[0]
     
-    def get_file_info(self, filepath):
+    def get_file_info(self, filepath, delta=False):
         if not os.path.exists(filepath):
             return None
         size = os.path.getsize(filepath)
-        chunks = size // CHUNK_SIZE
-        last = size % CHUNK_SIZE
+        chunks = size // self.chunk_size
+        last = size % self.chunk_size
         if last > 0:
             chunks += 1
         else:
-            last = CHUNK_SIZE
+            last = self.chunk_size
         return {
             'name': os.path.basename(filepath),
             'size': size,
-            'checksum': self.checksum(filepath),
+            'hash': self.hash_algo,
             'chunks': chunks,
-            'last': last
+            'last': last,
+            'chunk_size': self.chunk_size,
+            'delta': delta
         }
         
+    def log(self, message):
+        if self.is_master:
+            print(f"[Master] {message}")
+        else:
+            self.worker_log(message)
+    
+    def incoming_name(self, src, info):
+        if src == 0:
+            return f"from_master_{info['name']}"
+        return f"from_worker{src}_{info['name']}"
+    
+    def record(self, event, flow, peer):
+        seconds = time.perf_counter() - flow.started
+        fields = dict(rank=self.rank, peer=peer, file=flow.info['name'],
+                      size=flow.info['size'], wire_bytes=flow.wire_bytes,
+                      seconds=round(seconds, 6), mb_per_s=round(flow.wire_bytes / max(seconds, 1e-9) / 1e6, 2),
+                      delta=bool(flow.info.get('delta')), result=flow.result if event == "received" else flow.ok)
+        self.events.log(event, **fields)
+        if self.reporter:
+            self.reporter.emit(event, **fields)
+    
+    def on_received(self, flow):
+        self.record("received", flow, flow.source)
+        self.log(f"{'Saved' if flow.result.startswith('ok') else 'Failed'}: {flow.filename} ({flow.result})")
+        key = (flow.source, flow.info['name'])
+        if key in self.collecting:
+            self.collecting[key] = flow.result
+    
+    def on_sent(self, flow):
+        self.record("sent", flow, flow.dest)
+        peer = "Master" if flow.dest == 0 else f"Worker {flow.dest}"
+        if flow.ok:
+            self.log(f"File '{flow.info['name']}' sent to {peer}")
+        else:
+            self.log(f"Failed to send '{flow.info['name']}' to {peer}: {flow.error or 'verification failed'}")
+        callback = self.flow_callbacks.pop(flow, None)
+        if callback:
+            callback(flow)
+    
     def master_interface(self):
         print(f"\n{'='*60}")
         print(f"MPI FILE TRANSFER - MASTER (Rank {self.rank})")
@@ -63,9 +142,17 @@ class FileTransfer:
                 print(f"\nCommands:")
                 print("  send <file> <worker>        - Send file to worker")
                 print("  get <worker> <file>         - Request file from worker")
+                print("  getall <file>               - Collect file from every worker")
                 print("  w2w <src> <dst> <file>      - Worker to worker file transfer")
+                print("  shuffle <file>              - Every worker sends file to every other")
+                print("  bcastfile <file>            - Send file to all workers at once")
+                print("  scatterfile <file>          - Split shared file into worker stripes")
+                print("  gatherfile <file>           - Reassemble worker stripes into file")
                 print("  broadcast <message>         - Broadcast message to all workers")
                 print("  msg <worker> <message>      - Send message to specific worker")
+                print("  hash <algorithm>            - Checksum with blake2b, sha256 or crc32")
+                print("  delta <on|off>              - Send only changes to existing copies")
+                print("  metrics [file]              - Save every rank's metrics (.prom or .json)")
                 print("  list                        - List local files")
                 print("  status                      - Show system status")
                 print("  workers                     - Show worker status")
@@ -76,48 +163,7 @@ class FileTransfer:
                 if not cmd:
                     continue
                 
-                action = cmd[0].lower()
-                
-                if action == "send" and len(cmd) == 3:
-                    self.master_send(cmd[1], int(cmd[2]))
-                
-                elif action == "get" and len(cmd) == 3:
-                    self.master_request(int(cmd[1]), cmd[2])
-                
-                elif action == "w2w" and len(cmd) == 4:
-                    self.master_initiate_worker_transfer(int(cmd[1]), int(cmd[2]), cmd[3])
-                
-                elif action == "broadcast" and len(cmd) > 1:
-                    message = " ".join(cmd[1:])
-                    self.master_broadcast(message)
-                
-                elif action == "msg" and len(cmd) > 2:
-                    try:
-                        worker = int(cmd[1])
-                        message = " ".join(cmd[2:])
-                        self.master_send_message(worker, message)
-                    except:
-                        print("Error: Invalid worker number")
-                
-                elif action == "list":
-                    print(f"\n[Master] Files:")
-                    for f in os.listdir('.'):
-                        if os.path.isfile(f):
-                            size = os.path.getsize(f)
-                            print(f"  {f} ({size:,} bytes)")
-                
-                elif action == "status":
-                    self.master_show_status()
-                
-                elif action == "workers":
-                    self.master_show_workers()
-                
-                elif action == "quit":
-                    self.master_shutdown()
-                    break
-                
-                else:
-                    print("Unknown command")
+                self.master_command(cmd)
                     
             except KeyboardInterrupt:
                 print(f"\n[Master] Shutting down...")
@@ -125,15 +171,162 @@ class FileTransfer:
             except Exception as e:
                 print(f"[Master] Error: {e}")
     
+    def master_command(self, cmd):
+        """Run one console command given as words; returns False if it failed.
+        
+        Raises ValueError for an unknown command."""
+        action = cmd[0].lower()
+        ok = True
+        
+        if action == "send" and len(cmd) == 3:
+            ok = self.master_send(cmd[1], int(cmd[2]))
+        
+        elif action == "get" and len(cmd) == 3:
+            ok = self.master_request(int(cmd[1]), cmd[2])
+        
+        elif action == "getall" and len(cmd) == 2:
+            ok = self.master_collect(range(1, self.size), cmd[1])
+        
+        elif action == "w2w" and len(cmd) == 4:
+            key = self.master_initiate_worker_transfer(int(cmd[1]), int(cmd[2]), cmd[3])
+            ok = key is not None and self.master_await_relays([key])
+        
+        elif action == "shuffle" and len(cmd) == 2:
+            ok = self.master_shuffle(cmd[1])
+        
+        elif action == "bcastfile" and len(cmd) == 2:
+            ok = self.master_bcast_file(cmd[1])
+        
+        elif action == "scatterfile" and len(cmd) == 2:
+            self.master_scatter_file(cmd[1])
+        
+        elif action == "gatherfile" and len(cmd) == 2:
+            ok = self.master_gather_file(cmd[1])
+        
+        elif action == "broadcast" and len(cmd) > 1:
+            message = " ".join(cmd[1:])
+            self.master_broadcast(message)
+        
+        elif action == "msg" and len(cmd) > 2:
+            try:
+                worker = int(cmd[1])
+                message = " ".join(cmd[2:])
+                self.master_send_message(worker, message)
+            except:
+                print("Error: Invalid worker number")
+                ok = False
+        
+        elif action == "hash" and len(cmd) == 2:
+            if cmd[1] in hashing.ALGORITHMS:
+                self.hash_algo = cmd[1]
+                print(f"[Master] Checksums now use {self.hash_algo}")
+            else:
+                print(f"Error: Unknown hash, choose from {', '.join(hashing.ALGORITHMS)}")
+                ok = False
+        
+        elif action == "delta" and len(cmd) == 2 and cmd[1] in ("on", "off"):
+            self.delta = cmd[1] == "on"
+            print(f"[Master] Delta updates {cmd[1]} for send, get, getall and w2w")
+        
+        elif action == "metrics" and len(cmd) <= 2:
+            self.master_metrics(cmd[1] if len(cmd) == 2 else "metrics.prom")
+        
+        elif action == "list":
+            print(f"\n[Master] Files:")
+            for f in os.listdir('.'):
+                if os.path.isfile(f):
+                    size = os.path.getsize(f)
+                    print(f"  {f} ({size:,} bytes)")
+        
+        elif action == "status":
+            self.master_show_status()
+        
+        elif action == "workers":
+            self.master_show_workers()
+        
+        elif action == "quit":
+            self.master_shutdown()
+        
+        else:
+            raise ValueError("Unknown command")
+        return ok
+            
+    
+    def master_script(self, commands):
+        """Run console commands without the prompt, then shut everything down.
+        
+        Consecutive sends go to the transfer scheduler together and run
+        concurrently; any other command first waits for them.  Each
+        command is reported as start and done/error events; returns the
+        number that failed, a command failing when it raises or reports
+        failure."""
+        reporter = self.reporter
+        failed = 0
+        sending = []
+        
+        def finish_sends():
+            self.dispatcher.run(lambda: any(not flow.finished for flow in sending))
+            sending.clear()
+        
+        def sent(flow, name, start):
+            nonlocal failed
+            if flow.ok:
+                reporter.emit("done", op="send", file=name, seconds=round(time.perf_counter() - start, 6),
+                              bytes=flow.info['size'], wire_bytes=flow.wire_bytes, worker=flow.dest)
+            else:
+                failed += 1
+                reporter.emit("error", op="send", file=name,
+                              error=flow.error or f"Worker {flow.dest} rejected the copy")
+        
+        for cmd in commands:
+            self.master_check_messages()
+            name = " ".join(cmd[1:])
+            reporter.emit("start", op=cmd[0], file=name)
+            start = time.perf_counter()
+            try:
+                if cmd[0] == "send" and len(cmd) == 3:
+                    flow = self.master_queue_send(cmd[1], int(cmd[2]))
+                    if flow is None:
+                        raise ValueError(f"cannot send '{cmd[1]}' to {cmd[2]}")
+                    self.flow_callbacks[flow] = lambda flow, name=name, start=start: sent(flow, name, start)
+                    sending.append(flow)
+                    continue
+                finish_sends()
+                if cmd[0] == "quit":
+                    break
+                if not self.master_command(cmd):
+                    raise RuntimeError(f"{cmd[0]} failed")
+            except Exception as e:
+                failed += 1
+                reporter.emit("error", op=cmd[0], file=name, error=f"{type(e).__name__}: {e}")
+                continue
+            reporter.emit("done", op=cmd[0], file=name, seconds=round(time.perf_counter() - start, 6))
+        finish_sends()
+        self.master_shutdown()
+        return failed
+    
     def master_check_messages(self):
-        """Check for messages from workers"""
-        for src in range(1, self.size):
-            if self.comm.Iprobe(source=src, tag=MESSAGE_TAG):
-                msg = self.comm.recv(source=src, tag=MESSAGE_TAG)
-                print(f"\n[Master] Message from Worker {src}: {msg}")
+        """Handle whatever workers have sent since the last prompt"""
+        while self.dispatcher.step():
+            pass
+    
+    def master_on_message(self, src, msg):
+        print(f"\n[Master] Message from Worker {src}: {msg.recv()}")
     
     def master_send(self, filepath, worker_rank):
-        """Master sends file to worker"""
+        """Master sends file to worker; returns True if the worker verified it"""
+        flow = self.master_queue_send(filepath, worker_rank)
+        if flow is None:
+            return False
+        self.dispatcher.run(lambda: not flow.finished)
+        if flow.ok:
+            print(f"[Master] Transfer complete!")
+        else:
+            print(f"[Master] Transfer failed: {flow.error or 'verification failed'}")
+        return flow.ok
+    
+    def master_queue_send(self, filepath, worker_rank):
+        """Queue a file for a worker; returns the flow, None if it could not start"""
         if not 1 <= worker_rank < self.size:
             print(f"Error: Invalid worker rank")
             return
@@ -142,44 +335,210 @@ class FileTransfer:
             print(f"Error: File '{filepath}' not found")
             return
         
-        info = self.get_file_info(filepath)
+        info = self.get_file_info(filepath, self.delta)
         print(f"\n[Master] Sending '{info['name']}' to Worker {worker_rank}")
         
-        self.comm.send(TRANSFER, dest=worker_rank, tag=CONTROL_TAG)
-        self.comm.send({'from': 0, 'info': info}, dest=worker_rank, tag=METADATA_TAG)
+        def progress(done, total):
+            if self.reporter:
+                self.reporter.progress("send", info['name'], min(done * self.chunk_size, info['size']),
+                                       info['size'])
+            if done % 5 == 0:
+                print(f"  Progress: {done}/{total} chunks")
         
-        with open(filepath, 'rb') as f:
-            for i in range(info['chunks']):
-                chunk_size = info['last'] if i == info['chunks']-1 else CHUNK_SIZE
-                self.comm.send(f.read(chunk_size), dest=worker_rank, tag=DATA_TAG)
-                if (i+1) % 5 == 0:
-                    print(f"  Progress: {i+1}/{info['chunks']} chunks")
-        
-        self.comm.send(COMPLETE, dest=worker_rank, tag=CONTROL_TAG)
-        print(f"[Master] Transfer complete!")
+        return self.scheduler.send(filepath, info, worker_rank, progress)
+    
+    def master_on_control(self, src, msg):
+        """A worker could not serve a request, or reports a worker-to-worker transfer"""
+        reply = msg.recv()
+        if 'relayed' in reply:
+            key = (src, reply['to'], reply['relayed'])
+            if key in self.relaying:
+                self.relaying[key] = reply['result']
+            return
+        key = (src, os.path.basename(reply['missing']))
+        if key in self.collecting:
+            self.collecting[key] = "not found"
+        print(f"[Master] Worker {src} has no '{reply['missing']}'")
     
     def master_request(self, worker_rank, filename):
-        """Master requests file from worker"""
-        print(f"\n[Master] Requesting '{filename}' from Worker {worker_rank}")
-        self.comm.send(TRANSFER, dest=worker_rank, tag=CONTROL_TAG)
-        self.comm.send({'request': True, 'filename': filename, 'to': 0}, dest=worker_rank, tag=METADATA_TAG)
+        """Master requests file from worker; returns True if it arrived intact"""
+        if not 1 <= worker_rank < self.size:
+            print(f"Error: Invalid worker rank")
+            return False
+        return self.master_collect([worker_rank], filename)
+    
+    def master_collect(self, workers, filename, timeout=COLLECT_TIMEOUT):
+        """Fetch filename from each worker in parallel and wait for all of them.
+        
+        Streams go straight to disk through the transfer scheduler, which
+        admits MASTER_MAX_INCOMING at a time, so memory stays bounded.
+        Workers still pending after timeout seconds without any transfer
+        traffic are given up on, so a large file keeps the wait alive
+        while its data arrives.  Returns True if every copy verified."""
+        name = os.path.basename(filename)
+        print(f"\n[Master] Requesting '{filename}' from {len(workers)} worker(s)")
+        start = time.time()
+        for w in workers:
+            self.collecting[(w, name)] = None
+            self.comm.send(TRANSFER, dest=w, tag=CONTROL_TAG)
+            self.comm.send({'request': True, 'filename': filename, 'to': 0, 'delta': self.delta},
+                           dest=w, tag=METADATA_TAG)
+        
+        self.scheduler.last_activity = time.monotonic()
+        self.dispatcher.run(lambda: any(self.collecting[(w, name)] is None for w in workers)
+                            and time.monotonic() - self.scheduler.last_activity < timeout)
+        
+        elapsed = time.time() - start
+        results = {w: self.collecting.pop((w, name)) or f"no reply in {timeout:g}s" for w in workers}
+        received = [w for w, r in results.items() if r.startswith("ok")]
+        total = sum(os.path.getsize(self.incoming_name(w, {'name': name})) for w in received)
+        print(f"[Master] Collected {len(received)}/{len(workers)} copies, {total:,} bytes in "
+              f"{elapsed:.2f}s ({total / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+        for w, result in results.items():
+            if not result.startswith("ok"):
+                print(f"  Worker {w}: {result}")
+        return len(received) == len(workers)
     
-    def master_initiate_worker_transfer(self, src_worker, dst_worker, filename):
-        """Master initiates worker-to-worker file transfer"""
+    def master_initiate_worker_transfer(self, src_worker, dst_worker, filename, quiet=False):
+        """Master initiates worker-to-worker file transfer.
+        
+        Returns the key to pass to master_await_relays, None if the ranks
+        are invalid."""
         if not (1 <= src_worker < self.size and 1 <= dst_worker < self.size):
             print("Error: Invalid worker ranks")
-            return
+            return None
         
         if src_worker == dst_worker:
             print("Error: Cannot send file to self")
-            return
+            return None
         
-        print(f"\n[Master] Initiating transfer: Worker {src_worker} -> Worker {dst_worker}")
-        print(f"File: {filename}")
+        if not quiet:
+            print(f"\n[Master] Initiating transfer: Worker {src_worker} -> Worker {dst_worker}")
+            print(f"File: {filename}")
         
         # Tell source worker to send file
         self.comm.send(WORKER_SEND, dest=src_worker, tag=CONTROL_TAG)
-        self.comm.send({'to': dst_worker, 'filename': filename}, dest=src_worker, tag=METADATA_TAG)
+        key = (src_worker, dst_worker, filename)
+        self.relaying[key] = None
+        self.comm.send({'to': dst_worker, 'filename': filename, 'delta': self.delta},
+                       dest=src_worker, tag=METADATA_TAG)
+        return key
+    
+    def master_await_relays(self, keys, timeout=RELAY_TIMEOUT):
+        """Wait until the source workers report the transfers keys.
+        
+        Shutting down earlier would stop workers with flows in flight.
+        Returns True if every transfer verified."""
+        start = time.monotonic()
+        self.dispatcher.run(lambda: any(self.relaying[key] is None for key in keys)
+                            and time.monotonic() - start < timeout)
+        results = {key: self.relaying.pop(key) or f"no reply in {timeout:g}s" for key in keys}
+        failed = {key: result for key, result in results.items() if result != "ok"}
+        print(f"[Master] {len(keys) - len(failed)}/{len(keys)} worker transfers done "
+              f"in {time.monotonic() - start:.2f}s")
+        for (src, dst, filename), result in failed.items():
+            print(f"  Worker {src} -> Worker {dst} '{filename}': {result}")
+        return not failed
+    
+    def master_shuffle(self, filename):
+        """Every worker sends its copy of filename to every other worker.
+        
+        Returns True if every transfer verified."""
+        workers = range(1, self.size)
+        keys = []
+        for src in workers:
+            for dst in workers:
+                if src != dst:
+                    keys.append(self.master_initiate_worker_transfer(src, dst, filename, quiet=True))
+        print(f"\n[Master] Started {len(keys)} transfers of '{filename}'")
+        return self.master_await_relays(keys)
+    
+    def master_bcast_file(self, filepath):
+        """Master sends a file to every worker with a collective broadcast.
+        
+        Returns True if every worker verified its copy."""
+        if not os.path.exists(filepath):
+            print(f"Error: File '{filepath}' not found")
+            return False
+        
+        info = self.get_file_info(filepath)
+        print(f"\n[Master] Broadcasting '{info['name']}' to {self.size-1} workers")
+        start = time.time()
+        
+        for i in range(1, self.size):
+            self.comm.send(BCAST_FILE, dest=i, tag=CONTROL_TAG)
+        self.comm.bcast(info, root=0)
+        with open(filepath, 'rb') as f:
+            digests = self.broadcaster.bcast_file(f, info['size'], root=0,
+                                                  digest=hashing.digester(info['hash']))
+        # Every rank hashed the chunks as they passed; workers compare roots
+        self.comm.bcast(hashing.root(info['hash'], digests), root=0)
+        
+        results = self.comm.gather(None, root=0)
+        elapsed = time.time() - start
+        for i in range(1, self.size):
+            print(f"  Worker {i}: {results[i]}")
+        print(f"[Master] Broadcast complete in {elapsed:.2f}s "
+              f"({info['size'] / max(elapsed, 1e-9) / 1e6:.1f} MB/s per worker)")
+        return all(result == "ok" for result in results[1:])
+    
+    def stripe_name(self, name):
+        return f"stripe{self.rank}_{name}"
+    
+    def master_scatter_file(self, filepath):
+        """Workers read disjoint stripes of a shared file with collective MPI-IO"""
+        if not os.path.exists(filepath):
+            print(f"Error: File '{filepath}' not found")
+            return
+        
+        size = os.path.getsize(filepath)
+        print(f"\n[Master] Scattering '{filepath}' ({size:,} bytes) across {self.size-1} workers")
+        start = time.time()
+        
+        for i in range(1, self.size):
+            self.comm.send(SCATTER_FILE, dest=i, tag=CONTROL_TAG)
+        # Workers open the path themselves, so it must be on a shared filesystem
+        path = os.path.abspath(filepath)
+        self.comm.bcast({'path': path, 'size': size}, root=0)
+        # The master takes part in the collective calls with an empty stripe
+        self.striped.scatter(path, 0, 0, None)
+        
+        results = self.comm.gather(None, root=0)
+        elapsed = time.time() - start
+        for i in range(1, self.size):
+            print(f"  Worker {i}: {results[i]}")
+        print(f"[Master] Scatter complete in {elapsed:.2f}s "
+              f"({size / max(elapsed, 1e-9) / 1e6:.1f} MB/s aggregate)")
+    
+    def master_gather_file(self, filename):
+        """Workers write their stripes back into one file with collective MPI-IO.
+        
+        Returns False if a stripe was missing or the result differs from
+        a local copy of filename."""
+        name = os.path.basename(filename)
+        target = f"gathered_{name}"
+        print(f"\n[Master] Gathering stripes of '{name}' into '{target}'")
+        start = time.time()
+        
+        for i in range(1, self.size):
+            self.comm.send(GATHER_FILE, dest=i, tag=CONTROL_TAG)
+        self.comm.bcast({'name': name, 'path': os.path.abspath(target)}, root=0)
+        
+        # Nobody writes unless every worker has its stripe
+        missing = [i for i, ok in enumerate(self.comm.allgather(True)) if not ok]
+        if missing:
+            print(f"[Master] Gather aborted: no stripe on workers {missing}")
+            return False
+        total = self.striped.gather(os.path.abspath(target), 0, None)
+        
+        elapsed = time.time() - start
+        print(f"[Master] Gather complete: {target} ({total:,} bytes) in {elapsed:.2f}s "
+              f"({total / max(elapsed, 1e-9) / 1e6:.1f} MB/s aggregate)")
+        if os.path.exists(filename):
+            same = self.checksum(filename) == self.checksum(target)
+            print(f"[Master] Checksum vs '{filename}': {'match' if same else 'MISMATCH'}")
+            return same
+        return True
     
     def master_broadcast(self, message):
         """Master broadcasts message to all workers"""
@@ -199,11 +558,35 @@ class FileTransfer:
         self.comm.send(f"Master (private): {message}", dest=worker_rank, tag=MESSAGE_TAG)
         print(f"[Master] Message sent to Worker {worker_rank}")
     
+    def master_metrics(self, path):
+        """Collect a metrics snapshot from every rank and save them together"""
+        for i in range(1, self.size):
+            self.comm.send(METRICS, dest=i, tag=CONTROL_TAG)
+        snapshots = self.comm.gather(self.metrics.snapshot(), root=0)
+        if path.endswith(".json"):
+            metrics.write_file(path, json.dumps({f"rank{r}": snap for r, snap in enumerate(snapshots)}, indent=1))
+        else:
+            metrics.write_file(path, metrics.prometheus_text(
+                [({'rank': r}, snap) for r, snap in enumerate(snapshots)]))
+        
+        print(f"\n[Master] Metrics of {len(snapshots)} ranks saved to {path}")
+        print(f"  Rank   In MB  Out MB  Chunk p50 ms  p99 ms")
+        for r, snap in enumerate(snapshots):
+            m = snap['metrics']
+            moved = {v['labels']['direction']: v['value'] for v in m.get('mpi_bytes_total', {}).get('values', [])}
+            chunks = [v for v in m.get('mpi_chunk_seconds', {}).get('values', [])]
+            p50 = max((v['p50'] for v in chunks if v['p50'] != "+Inf"), default=0)
+            p99 = max((v['p99'] for v in chunks if v['p99'] != "+Inf"), default=0)
+            print(f"  {r:4} {moved.get('in', 0) / 1e6:7.1f} {moved.get('out', 0) / 1e6:7.1f} "
+                  f"{p50 * 1000:13.2f} {p99 * 1000:7.2f}")
+    
     def master_show_status(self):
         print(f"\n[Master] System Status:")
         print(f"  Total Processes: {self.size}")
         print(f"  Active Workers: {self.size - 1}")
-        print(f"  Chunk Size: {CHUNK_SIZE:,} bytes")
+        print(f"  Chunk Size: {self.chunk_size:,} bytes")
+        print(f"  Checksum: {self.hash_algo}")
+        print(f"  Transfers: {self.scheduler.summary()}")
         print(f"  Master Rank: {self.rank}")
     
     def master_show_workers(self):
@@ -224,6 +607,21 @@ class FileTransfer:
             else:
                 print(f"  {i:6}  -      No log file")
     
+    def master_batch(self, path, prefetch):
+        """Run a job file to completion, then shut everything down; returns the failed job count"""
+        failed = 1
+        try:
+            jobs = parse_jobs(path, range(1, self.size))
+            runner = BatchRunner(self, jobs, prefetch)
+            runner.run()
+            failed = len(runner.failed)
+        except (OSError, ValueError) as e:
+            print(f"[Master] Error: {e}")
+        finally:
+            # Workers wait for TERMINATE whatever went wrong here
+            self.master_shutdown()
+        return failed
+    
     def master_shutdown(self):
         """Shutdown all workers"""
         print(f"\n[Master] Shutting down workers...")
@@ -232,173 +630,144 @@ class FileTransfer:
         self.running = False
         print("[Master] System shutdown complete")
         
-    def worker_message_listener(self):
-        """Background thread to listen for messages from other workers"""
-        while self.running:
-            try:
-                for src in range(1, self.size):
-                    if src != self.rank and self.comm.Iprobe(source=src, tag=MESSAGE_TAG):
-                        msg = self.comm.recv(source=src, tag=MESSAGE_TAG)
-                        self.messages.append((src, msg))
-                        self.worker_log(f"Message from Worker {src}: {msg}")
-                time.sleep(0.1)
-            except:
-                pass
+    def worker_on_control(self, src, msg):
+        """Control signal from the master"""
+        sig = msg.recv()
+        
+        if sig == TERMINATE:
+            self.worker_log("Received shutdown signal from Master")
+            self.running = False
+        
+        elif sig == TRANSFER:
+            self.worker_handle_request()
+        
+        elif sig == WORKER_SEND:
+            self.worker_handle_master_initiated_send()
+        
+        elif sig == BCAST_FILE:
+            self.worker_receive_bcast_file()
+        
+        elif sig == SCATTER_FILE:
+            self.worker_scatter_file()
+        
+        elif sig == GATHER_FILE:
+            self.worker_gather_file()
+        
+        elif sig == METRICS:
+            self.comm.gather(self.metrics.snapshot(), root=0)
+        
+        elif sig == BROADCAST:
+            msg = self.comm.recv(source=0, tag=MESSAGE_TAG)
+            self.worker_log(f"Broadcast from Master: {msg}")
+    
+    def worker_on_message(self, src, msg):
+        """Chat message from another worker"""
+        text = msg.recv()
+        self.messages.append((src, text))
+        self.worker_log(f"Message from Worker {src}: {text}")
+    
+    def worker_on_input(self, line):
+        cmd = line.strip()
+        if cmd:
+            self.process_worker_command(cmd)
     
     def worker_log(self, message):
         """Log message to worker file"""
-        log_file = f"worker_{self.rank}.log"
-        with open(log_file, 'a') as f:
-            f.write(f"{message}\n")
+        if self.log_file is None:
+            # Opened once and line buffered, not reopened for every line
+            self.log_file = open(f"worker_{self.rank}.log", 'w', buffering=1)
+            self.log_file.write(f"Worker {self.rank} started\n")
+        self.log_file.write(f"{message}\n")
         print(f"[Worker {self.rank}] {message}")
     
     def worker_interface(self):
         """Enhanced worker interface with communication capabilities"""
-        # Create initial log file
-        log_file = f"worker_{self.rank}.log"
-        with open(log_file, 'w') as f:
-            f.write(f"Worker {self.rank} started\n")
-        
         self.worker_log(f"Started - Type commands:")
         self.worker_log("  send <worker> <file>   - Send file to another worker")
         self.worker_log("  msg <worker> <message> - Send message to worker")
         self.worker_log("  messages               - Show recent messages")
         self.worker_log("  files                  - List local files")
         self.worker_log("  status                 - Show worker status")
+        self.worker_log("  metrics                - Save this worker's metrics")
         self.worker_log("  help                   - Show commands")
         self.worker_log("  exit                   - Exit (only this worker)")
         
+        # One loop serves control, message, transfer and console input;
+        # metadata is received inside the handlers that expect it
+        dispatcher = self.dispatcher
+        dispatcher.on(CONTROL_TAG, self.worker_on_control)
+        dispatcher.on(MESSAGE_TAG, self.worker_on_message)
+        dispatcher.on_other(lambda src, tag: self.worker_log(f"Dropped stray message (tag {tag}) from rank {src}"))
+        dispatcher.on_input(sys.stdin, self.worker_on_input)
+        self.jobs = WorkerJobs(self)
+        
         while self.running:
             try:
-                # Check for incoming transfers/messages from master
-                if self.comm.Iprobe(source=0, tag=CONTROL_TAG):
-                    sig = self.comm.recv(source=0, tag=CONTROL_TAG)
-                    
-                    if sig == TERMINATE:
-                        self.worker_log("Received shutdown signal from Master")
-                        self.running = False
-                        break
-                    
-                    elif sig == TRANSFER:
-                        self.worker_receive_from_master()
-                    
-                    elif sig == WORKER_SEND:
-                        self.worker_handle_master_initiated_send()
-                    
-                    elif sig == BROADCAST:
-                        msg = self.comm.recv(source=0, tag=MESSAGE_TAG)
-                        self.worker_log(f"Broadcast from Master: {msg}")
-                
-                # Check for incoming file transfers from other workers
-                for src in range(1, self.size):
-                    if src != self.rank and self.comm.Iprobe(source=src, tag=CONTROL_TAG):
-                        sig = self.comm.recv(source=src, tag=CONTROL_TAG)
-                        if sig == TRANSFER:
-                            self.worker_receive_from_worker(src)
-                
-                # Check for user input (non-blocking)
-                try:
-                    import select
-                    if select.select([sys.stdin], [], [], 0.1)[0]:
-                        cmd = sys.stdin.readline().strip()
-                        if cmd:
-                            self.process_worker_command(cmd)
-                except:
-                    # Simple input fallback
-                    pass
-                
-                time.sleep(0.1)
-                    
+                dispatcher.run(lambda: self.running)
             except KeyboardInterrupt:
                 self.worker_log("Exiting...")
                 self.running = False
             except Exception as e:
                 self.worker_log(f"Error: {e}")
     
-    def worker_receive_from_master(self):
-        """Worker receives file from master"""
-        try:
-            data = self.comm.recv(source=0, tag=METADATA_TAG)
-            
-            if data.get('request'):
-                filename = data['filename']
-                if os.path.exists(filename):
-                    self.worker_log(f"Master requested file: {filename}")
-                    self.worker_send_to_master(filename)
-                else:
-                    self.worker_log(f"Error: File '{filename}' not found")
-                return
-            
-            info = data['info']
-            self.worker_log(f"Receiving '{info['name']}' from Master")
-            
-            filename = f"from_master_{info['name']}"
-            total = 0
-            
-            with open(filename, 'wb') as f:
-                while True:
-                    if self.comm.Iprobe(source=0, tag=CONTROL_TAG):
-                        sig = self.comm.recv(source=0, tag=CONTROL_TAG)
-                        if sig == COMPLETE:
-                            break
-                    
-                    if self.comm.Iprobe(source=0, tag=DATA_TAG):
-                        chunk = self.comm.recv(source=0, tag=DATA_TAG)
-                        f.write(chunk)
-                        total += len(chunk)
-                        progress = (total / info['size']) * 100
-                        if int(progress) % 20 == 0:
-                            self.worker_log(f"  Progress: {progress:.0f}%")
-            
-            # Verify
-            if os.path.getsize(filename) == info['size']:
-                if self.checksum(filename) == info['checksum']:
-                    self.worker_log(f"Saved: {filename} ")
-                else:
-                    self.worker_log(f"Saved: {filename} (checksum mismatch)")
-            else:
-                self.worker_log("Size mismatch!")
-                
-        except Exception as e:
-            self.worker_log(f"Receive error: {e}")
+    def worker_handle_request(self):
+        """Worker answers a master request for one of its files"""
+        data = self.comm.recv(source=0, tag=METADATA_TAG)
+        filename = data['filename']
+        if os.path.exists(filename):
+            self.worker_log(f"Master requested file: {filename}")
+            self.worker_send_to_master(filename, data.get('delta', False))
+        else:
+            self.worker_log(f"Error: File '{filename}' not found")
+            self.comm.send({'missing': filename}, dest=0, tag=CONTROL_TAG)
     
-    def worker_receive_from_worker(self, src_rank):
-        """Worker receives file from another worker"""
-        try:
-            data = self.comm.recv(source=src_rank, tag=METADATA_TAG)
-            info = data['info']
-            
-            self.worker_log(f"Receiving '{info['name']}' from Worker {src_rank}")
-            
-            filename = f"from_worker{src_rank}_{info['name']}"
-            total = 0
-            
-            with open(filename, 'wb') as f:
-                while True:
-                    if self.comm.Iprobe(source=src_rank, tag=CONTROL_TAG):
-                        sig = self.comm.recv(source=src_rank, tag=CONTROL_TAG)
-                        if sig == COMPLETE:
-                            break
-                    
-                    if self.comm.Iprobe(source=src_rank, tag=DATA_TAG):
-                        chunk = self.comm.recv(source=src_rank, tag=DATA_TAG)
-                        f.write(chunk)
-                        total += len(chunk)
-                        progress = (total / info['size']) * 100
-                        if int(progress) % 25 == 0:
-                            self.worker_log(f"  Progress: {progress:.0f}%")
-            
-            # Verify
-            if os.path.getsize(filename) == info['size']:
-                if self.checksum(filename) == info['checksum']:
-                    self.worker_log(f"Saved: {filename}")
-                else:
-                    self.worker_log(f"Saved: {filename} (checksum mismatch)")
-            else:
-                self.worker_log("Size mismatch!")
-                
-        except Exception as e:
-            self.worker_log(f"Receive error: {e}")
+    def worker_receive_bcast_file(self):
+        """Worker takes part in a master file broadcast"""
+        info = self.comm.bcast(None, root=0)
+        filename = f"from_master_{info['name']}"
+        self.worker_log(f"Receiving broadcast of '{info['name']}'")
+        
+        with open(filename, 'wb') as f:
+            digests = self.broadcaster.bcast_file(f, info['size'], root=0,
+                                                  digest=hashing.digester(info['hash']))
+            written = f.tell()
+        checksum = self.comm.bcast(None, root=0)
+        
+        if written != info['size']:
+            result = "size mismatch"
+        elif hashing.root(info['hash'], digests) != checksum:
+            result = "checksum mismatch"
+        else:
+            result = "ok"
+        self.worker_log(f"Saved: {filename} ({result})")
+        self.comm.gather(result, root=0)
+    
+    def worker_scatter_file(self):
+        """Worker reads its stripe of a shared file during scatterfile"""
+        data = self.comm.bcast(None, root=0)
+        offset, length = stripe_range(data['size'], self.rank - 1, self.size - 1)
+        filename = self.stripe_name(os.path.basename(data['path']))
+        self.worker_log(f"Reading stripe [{offset:,}, {offset + length:,}) into {filename}")
+        
+        with open(filename, 'wb') as f:
+            self.striped.scatter(data['path'], offset, length, f)
+        result = f"{filename} ({length:,} bytes, {self.hash_algo} {self.checksum(filename)[:16]})"
+        self.worker_log(f"Stripe saved: {result}")
+        self.comm.gather(result, root=0)
+    
+    def worker_gather_file(self):
+        """Worker writes its stripe back into the shared file during gatherfile"""
+        data = self.comm.bcast(None, root=0)
+        filename = self.stripe_name(data['name'])
+        have = os.path.exists(filename)
+        if not all(self.comm.allgather(have)):
+            self.worker_log(f"Gather aborted: a stripe of '{data['name']}' is missing")
+            return
+        
+        length = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            self.striped.gather(data['path'], length, f)
+        self.worker_log(f"Stripe written: {filename} ({length:,} bytes)")
     
     def worker_handle_master_initiated_send(self):
         """Handle master-initiated worker-to-worker transfer"""
@@ -406,34 +775,35 @@ class FileTransfer:
         dst_worker = data['to']
         filename = data['filename']
         
+        reply = {'relayed': filename, 'to': dst_worker}
+        flow = None
         if os.path.exists(filename):
             self.worker_log(f"Master requested to send '{filename}' to Worker {dst_worker}")
-            self.worker_send_to_worker(filename, dst_worker)
+            flow = self.worker_send_to_worker(filename, dst_worker, data.get('delta', False))
         else:
             self.worker_log(f"Error: File '{filename}' not found")
+        if flow is None:
+            self.comm.send({**reply, 'result': "not found"}, dest=0, tag=CONTROL_TAG)
+            return
+        
+        def report(flow):
+            result = "ok" if flow.ok else flow.error or "verification failed"
+            self.comm.send({**reply, 'result': result}, dest=0, tag=CONTROL_TAG)
+        self.flow_callbacks[flow] = report
     
-    def worker_send_to_master(self, filename):
+    def worker_send_to_master(self, filename, delta=False):
         """Worker sends file to master"""
         if not os.path.exists(filename):
             self.worker_log(f"Error: File '{filename}' not found")
             return
         
-        info = self.get_file_info(filename)
+        info = self.get_file_info(filename, delta)
         self.worker_log(f"Sending '{info['name']}' to Master")
         
-        self.comm.send(TRANSFER, dest=0, tag=CONTROL_TAG)
-        self.comm.send({'from': self.rank, 'info': info}, dest=0, tag=METADATA_TAG)
-        
-        with open(filename, 'rb') as f:
-            for i in range(info['chunks']):
-                chunk_size = info['last'] if i == info['chunks']-1 else CHUNK_SIZE
-                self.comm.send(f.read(chunk_size), dest=0, tag=DATA_TAG)
-        
-        self.comm.send(COMPLETE, dest=0, tag=CONTROL_TAG)
-        self.worker_log("File sent to Master")
+        self.scheduler.send(filename, info, 0)
     
-    def worker_send_to_worker(self, filename, dst_worker):
-        """Worker sends file to another worker"""
+    def worker_send_to_worker(self, filename, dst_worker, delta=False):
+        """Worker sends file to another worker; returns the flow, None if it could not start"""
         if not os.path.exists(filename):
             self.worker_log(f"Error: File '{filename}' not found")
             return
@@ -446,21 +816,10 @@ class FileTransfer:
             self.worker_log(f"Error: Invalid destination worker")
             return
         
-        info = self.get_file_info(filename)
+        info = self.get_file_info(filename, delta)
         self.worker_log(f"Sending '{info['name']}' to Worker {dst_worker}")
         
-        # Send start signal
-        self.comm.send(TRANSFER, dest=dst_worker, tag=CONTROL_TAG)
-        self.comm.send({'from': self.rank, 'info': info}, dest=dst_worker, tag=METADATA_TAG)
-        
-        # Send file
-        with open(filename, 'rb') as f:
-            for i in range(info['chunks']):
-                chunk_size = info['last'] if i == info['chunks']-1 else CHUNK_SIZE
-                self.comm.send(f.read(chunk_size), dest=dst_worker, tag=DATA_TAG)
-        
-        self.comm.send(COMPLETE, dest=dst_worker, tag=CONTROL_TAG)
-        self.worker_log(f"File sent to Worker {dst_worker}")
+        return self.scheduler.send(filename, info, dst_worker)
     
     def worker_send_message(self, dst_worker, message):
         """Worker sends message to another worker"""
@@ -523,8 +882,14 @@ class FileTransfer:
             self.worker_log(f"  Rank: {self.rank}")
             self.worker_log(f"  Total Workers: {self.size - 1}")
             self.worker_log(f"  Messages received: {len(self.messages)}")
+            self.worker_log(f"  Transfers: {self.scheduler.summary()}")
             self.worker_log(f"  Running: {'Yes' if self.running else 'No'}")
         
+        elif action == "metrics":
+            path = f"metrics_rank{self.rank}.prom"
+            self.metrics.write(path)
+            self.worker_log(f"Metrics saved to {path}")
+        
         elif action == "help":
             self.worker_log(f"Commands:")
             self.worker_log("  send <worker> <file>   - Send file to another worker")
@@ -532,6 +897,7 @@ class FileTransfer:
             self.worker_log("  messages               - Show recent messages")
             self.worker_log("  files                  - List local files")
             self.worker_log("  status                 - Show worker status")
+            self.worker_log("  metrics                - Save this worker's metrics")
             self.worker_log("  help                   - Show commands")
             self.worker_log("  exit                   - Exit (only this worker)")
         
@@ -542,13 +908,48 @@ class FileTransfer:
         else:
             self.worker_log("Unknown command. Type 'help' for commands")
         
-    def run(self):
+    def run(self, batch=None, prefetch=DEFAULT_PREFETCH, commands=None):
+        """Serve until shutdown; returns how many scripted commands failed"""
+        failed = 0
         if self.is_master:
-            self.master_interface()
+            if batch:
+                failed = self.master_batch(batch, prefetch)
+            elif commands:
+                failed = self.master_script(commands)
+            else:
+                self.master_interface()
         else:
             self.worker_interface()
+            if self.log_file:
+                self.log_file.close()
+        self.metrics.write(f"metrics_rank{self.rank}.prom")
+        self.events.close()
+        return failed
 
 def main():
+    parser = argparse.ArgumentParser(description="MPI file transfer system")
+    parser.add_argument("command", nargs="*",
+                        help="console command to run instead of the prompt, e.g. 'send data.bin 1', "
+                             "or 'batch' with --manifest")
+    parser.add_argument("--script", metavar="FILE", help="run the console commands in FILE, one per line")
+    parser.add_argument("--batch", "--manifest", metavar="JOBFILE",
+                        help="run the jobs in JOBFILE instead of the console")
+    parser.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH,
+                        help="jobs queued on each worker in batch mode")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="bytes per point-to-point chunk (same on every rank)")
+    parser.add_argument("--json", action="store_true",
+                        help="print progress as JSON lines; other output goes to stderr")
+    args = parser.parse_intermixed_args()
+    
+    commands = [args.command] if args.command else []
+    if args.script:
+        commands += cli.read_manifest(args.script)
+    if commands and commands[0] == ["batch"]:
+        if not args.batch:
+            parser.error("batch needs --manifest")
+        commands = []
+    
     comm = MPI.COMM_WORLD
     rank, size = comm.Get_rank(), comm.Get_size()
     
@@ -557,8 +958,13 @@ def main():
             print("Need at least 2 processes: mpiexec -n 4 python file_transfer_mpi.py")
         return
     
-    system = FileTransfer()
-    system.run()
+    system = FileTransfer(args.chunk_size)
+    if commands or args.batch:
+        system.reporter = cli.Reporter(args.json)
+    # Events own stdout; with --json every rank's own output moves to stderr
+    with redirect_stdout(sys.stderr if args.json else sys.stdout):
+        failed = system.run(args.batch, args.prefetch, commands)
+    return 1 if failed else 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""Selectable chunk hashing for FileTransfer.
+
+A file's checksum is a two-level tree hash: every CHUNK_SIZE leaf is
+hashed on its own and the root is the hash of the concatenated leaf
+digests.  Senders and receivers can therefore hash each chunk while it
+is already in memory for the transfer, compare chunks one by one to find
+the corrupt ones, and get the root without reading the file again.
+Hashing a file from disk spreads the leaves over a thread pool; hashlib
+and zlib release the GIL on large buffers, so the threads run in parallel.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import zlib
+
+ALGORITHMS = ("blake2b", "sha256", "crc32")
+DEFAULT = "blake2b"
+
+
+class Crc32:
+    """zlib.crc32 behind the hashlib update/digest interface"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+def new(algo):
+    if algo == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    if algo == "sha256":
+        return hashlib.sha256()
+    if algo == "crc32":
+        return Crc32()
+    raise ValueError(f"unknown hash {algo!r}, choose from {', '.join(ALGORITHMS)}")
+
+
+def digester(algo):
+    """Function returning the digest of one chunk"""
+    new(algo)
+    def digest(data):
+        h = new(algo)
+        h.update(data)
+        return h.digest()
+    return digest
+
+
+def root(algo, digests):
+    """Whole-file checksum from the ordered leaf digests"""
+    h = new(algo)
+    for d in digests:
+        h.update(d)
+    return h.hexdigest()
+
+
+def _hash_leaves(fd, algo, leaf_size, first, last):
+    digest = digester(algo)
+    return [digest(os.pread(fd, leaf_size, seq * leaf_size)) for seq in range(first, last)]
+
+
+def tree_hash(path, algo=DEFAULT, leaf_size=65536, workers=None):
+    """(root checksum, leaf digests) of the file at path.
+
+    Each thread hashes one contiguous run of leaves so reads stay sequential."""
+    size = os.path.getsize(path)
+    leaves = -(-size // leaf_size)
+    workers = max(1, min(workers or os.cpu_count() or 1, leaves))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        bounds = [leaves * i // workers for i in range(workers + 1)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(lambda i: _hash_leaves(fd, algo, leaf_size, bounds[i], bounds[i + 1]),
+                             range(workers))
+            digests = [d for part in parts for d in part]
+    finally:
+        os.close(fd)
+    return root(algo, digests), digests
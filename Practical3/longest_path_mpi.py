@@ -0,0 +1,125 @@
+"""Parallel longest-path finder, the MPI counterpart of Practical5.
+
+    mpiexec -n 4 python longest_path_mpi.py paths1.txt paths2.txt --top 10
+
+Input files are cut into byte-range splits (see mapreduce_mpi) that
+every rank takes in turn, so one huge dump is shared as evenly as many
+small ones.  A split owns the lines that start inside it.  Ranks stream
+their splits through mmap in BLOCK_SIZE pieces, keep every line of the
+longest length seen (as longest_path.c prints them all) plus a top-K by
+length, and one reduce merges the per-rank results.  Lengths are in
+bytes after trimming the line ending, like strlen() in the C version.
+"""
+from mpi4py import MPI
+import argparse
+import heapq
+import mmap
+import os
+import time
+from mapreduce_mpi import make_splits
+
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class LongestLines:
+    """All lines of the maximum length, and the top k lines by length"""
+
+    def __init__(self, k):
+        self.k = k
+        self.length = 0
+        self.longest = []
+        self.top = []
+
+    def add_block(self, lines):
+        if not lines:
+            return
+        n = max(map(len, lines))
+        if n > self.length:
+            self.length = n
+            self.longest = [line for line in lines if len(line) == n]
+        elif n == self.length and n:
+            self.longest.extend(line for line in lines if len(line) == n)
+        self.top = heapq.nlargest(self.k, self.top + heapq.nlargest(self.k, lines, key=len), key=len)
+
+    def merge(self, other):
+        if other.length > self.length:
+            self.length, self.longest = other.length, other.longest
+        elif other.length == self.length:
+            self.longest = self.longest + other.longest
+        self.top = heapq.nlargest(self.k, self.top + other.top, key=len)
+        return self
+
+
+def _merge(a, b, datatype=None):
+    return a.merge(b)
+
+
+MERGE = MPI.Op.Create(_merge, commute=True)
+
+
+def _line_start(mm, pos):
+    """First line start at or after pos"""
+    if pos == 0 or mm[pos - 1] == ord("\n"):
+        return pos
+    nl = mm.find(b"\n", pos)
+    return len(mm) if nl < 0 else nl + 1
+
+
+def scan_split(path, start, end, result):
+    """Feed the lines that start in [start, end) of path into result"""
+    if start >= end:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = _line_start(mm, start)
+        end = _line_start(mm, end)
+        while pos < end:
+            stop = min(_line_start(mm, min(pos + BLOCK_SIZE, end)), end)
+            block = mm[pos:stop]
+            if b"\r" in block:
+                block = block.replace(b"\r", b"")
+            result.add_block([line for line in block.split(b"\n") if line])
+            pos = stop
+
+
+def longest_paths(comm, paths, k):
+    """Run on every rank; rank 0 gets the merged LongestLines, others None"""
+    splits = make_splits(paths, comm.size) if comm.rank == 0 else None
+    splits = comm.bcast(splits, root=0)
+    result = LongestLines(k)
+    for path, start, end in splits[comm.rank::comm.size]:
+        scan_split(path, start, end, result)
+    return comm.reduce(result, op=MERGE, root=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel longest path finder over MPI")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--top", type=int, default=10, help="also list the K longest paths")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    files = [p for p in args.files if os.path.isfile(p)]
+    if comm.rank == 0:
+        for p in sorted(set(args.files) - set(files)):
+            print(f"{p}: No such file")
+
+    start = time.perf_counter()
+    result = longest_paths(comm, files, args.top)
+    if comm.rank != 0:
+        return
+
+    if not result.longest:
+        print("No paths found.")
+        return
+    print("\nLONGEST PATH(S)")
+    for line in result.longest:
+        print(line.decode(errors='replace'))
+    print(f"\nLongest Length = {result.length} characters")
+    print(f"\nTOP {len(result.top)} BY LENGTH")
+    for line in result.top:
+        print(f"{len(line):6}  {line.decode(errors='replace')}")
+    print(f"\n[{comm.size} ranks, {time.perf_counter() - start:.3f}s]")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Distributed word count over MPI, the Python counterpart of Practical4.
+
+    mpiexec -n 4 python mapreduce_mpi.py book1.txt book2.txt --top 20
+
+Input files are cut into byte-range splits.  A split owns the words that
+start inside it: it skips a word cut by its start and reads on past its
+end to finish its last word, so no word is counted twice or lost.  Every
+rank maps its splits with a Counter (the combiner), the counts are
+partitioned by a hash of the word and exchanged with one alltoallv, and
+each rank reduces its own partition.  Words are split and lowercased the
+same way as MapReduce.c.
+"""
+from collections import Counter
+from mpi4py import MPI
+import argparse
+import mmap
+import os
+import pickle
+import re
+import time
+import zlib
+
+DELIMITERS = b" ,.-!?;:\n\t\"()"
+MIN_SPLIT = 1024 * 1024
+MAX_SPLIT = 64 * 1024 * 1024
+SPLITS_PER_RANK = 4
+
+_DELIMITER = re.compile(b"[" + re.escape(DELIMITERS) + b"]")
+_TO_SPACE = bytes.maketrans(DELIMITERS, b" " * len(DELIMITERS))
+
+
+def make_splits(paths, ranks):
+    """[(path, start, end), ...] covering every input byte once"""
+    total = sum(os.path.getsize(p) for p in paths)
+    target = min(max(total // max(ranks * SPLITS_PER_RANK, 1), MIN_SPLIT), MAX_SPLIT)
+    splits = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, target):
+            splits.append((path, start, min(start + target, size)))
+    return splits
+
+
+def _next_delimiter(buf, pos):
+    m = _DELIMITER.search(buf, pos)
+    return m.start() if m else len(buf)
+
+
+def read_split(path, start, end):
+    """Bytes of the words that start in [start, end) of path"""
+    if start >= end:
+        return b""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if start > 0 and mm[start - 1] not in DELIMITERS:
+            start = _next_delimiter(mm, start)
+        if end < len(mm) and mm[end - 1] not in DELIMITERS:
+            end = _next_delimiter(mm, end)
+        return mm[start:end] if start < end else b""
+
+
+def map_split(data, counts):
+    """Add the words of data to the Counter counts (the combiner)"""
+    counts.update(data.translate(_TO_SPACE).lower().split())
+
+
+def partition(word, parts):
+    # crc32, not hash(): str/bytes hashes differ between processes
+    return zlib.crc32(word) % parts
+
+
+def shuffle(comm, counts):
+    """Send every word's count to the rank that owns its partition"""
+    parts = [{} for _ in range(comm.size)]
+    for word, n in counts.items():
+        parts[partition(word, comm.size)][word] = n
+    payloads = [pickle.dumps(p, pickle.HIGHEST_PROTOCOL) for p in parts]
+    send_counts = [len(p) for p in payloads]
+    recv_counts = comm.alltoall(send_counts)
+    send_buf = b"".join(payloads)
+    recv_buf = bytearray(sum(recv_counts))
+    send_displs = [sum(send_counts[:i]) for i in range(comm.size)]
+    recv_displs = [sum(recv_counts[:i]) for i in range(comm.size)]
+    comm.Alltoallv([send_buf, (send_counts, send_displs), MPI.BYTE],
+                   [recv_buf, (recv_counts, recv_displs), MPI.BYTE])
+    view = memoryview(recv_buf)
+    return [pickle.loads(view[d:d + n]) for d, n in zip(recv_displs, recv_counts)]
+
+
+def reduce_partition(received):
+    result = Counter()
+    for part in received:
+        for word, n in part.items():
+            result[word] += n
+    return result
+
+
+def word_count(comm, paths):
+    """Run the job on every rank; returns (this rank's Counter, phase timings)"""
+    timings = {}
+    start = time.perf_counter()
+    splits = make_splits(paths, comm.size) if comm.rank == 0 else None
+    splits = comm.bcast(splits, root=0)
+
+    counts = Counter()
+    for path, first, last in splits[comm.rank::comm.size]:
+        map_split(read_split(path, first, last), counts)
+    timings['map'] = time.perf_counter() - start
+
+    mark = time.perf_counter()
+    received = shuffle(comm, counts)
+    timings['shuffle'] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+    result = reduce_partition(received)
+    timings['reduce'] = time.perf_counter() - mark
+    comm.Barrier()
+    timings['total'] = time.perf_counter() - start
+    return result, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed word count over MPI")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--top", type=int, default=20, help="most frequent words to print")
+    parser.add_argument("--output", help="write every 'word : count' line to this file")
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    missing = [p for p in args.files if not os.path.isfile(p)]
+    if missing:
+        if comm.rank == 0:
+            print(f"Error: File not found: {', '.join(missing)}")
+        return
+
+    result, timings = word_count(comm, args.files)
+    words = comm.reduce(sum(result.values()), op=MPI.SUM, root=0)
+    distinct = comm.reduce(len(result), op=MPI.SUM, root=0)
+    top = comm.gather(result.most_common(args.top), root=0)
+    everything = comm.gather(result, root=0) if args.output else None
+
+    if comm.rank == 0:
+        print("\n===== WORD COUNT RESULT =====")
+        print(f"Ranks: {comm.size}, words: {words:,}, distinct: {distinct:,}")
+        print(f"Time: map {timings['map']:.3f}s, shuffle {timings['shuffle']:.3f}s, "
+              f"reduce {timings['reduce']:.3f}s, total {timings['total']:.3f}s")
+        merged = sorted((pair for part in top for pair in part), key=lambda p: (-p[1], p[0]))
+        for word, n in merged[:args.top]:
+            print(f"{word.decode(errors='replace')} : {n}")
+        if args.output:
+            # Partitions are disjoint, so merging them is a plain union
+            merged = {word: n for part in everything for word, n in part.items()}
+            with open(args.output, 'w') as f:
+                for word, n in sorted(merged.items(), key=lambda p: (-p[1], p[0])):
+                    f.write(f"{word.decode(errors='replace')} : {n}\n")
+            print(f"Saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+"""Concurrent point-to-point file transfers between ranks.
+
+Each transfer (a flow) gets an id from its sender and its chunks travel
+on tag DATA_TAG_BASE + id, so a rank can receive from several peers and
+send to several peers at once without their chunks mixing.  The flow's
+control messages share FLOW_TAG and carry the id:
+
+    sender                          receiver
+    offer(info)  ------------------>  admitted when a slot is free
+                 <------------------  accept
+    chunks on DATA_TAG_BASE + id -->  hashed and pwritten as they land
+    digests      ------------------>
+                 <------------------  resend(seqs) ... or done
+
+Either side can end a flow early.  A sender that cannot read its file
+sends abort(error) instead of the rest of the data; the receiver drops
+any chunks still in flight as strays.  A receiver that cannot open the
+file answers done(ok=False, error) to the offer.  One that cannot write
+it answers done(ok=False, error, drain=True) and keeps discarding the
+flow's chunks until the sender, once its last Isend has completed,
+replies closed.  Either way both ends report the flow as failed, and
+neither reports it while its own side of the transfer is still moving.
+
+A flow offered with info['delta'] to a rank that already holds a copy
+under the target name becomes a delta flow (see common/delta.py): the
+accept carries the signature of the old copy, the sender streams packed
+delta ops on the data tag instead of chunks, and an 'end' message with
+the file's checksum replaces the digests.  The receiver rebuilds the
+file beside the old copy and renames it into place once it verifies.
+Plain flows do the same: each writes a temp file named after its source
+and id, so two flows to the same name cannot corrupt each other, and
+the last one to verify wins.
+
+A rank admits at most max_incoming receiving and max_outgoing sending
+flows; later ones wait in FIFO order.  Active senders take turns posting
+one chunk each, so one large file cannot starve the others.  Nothing
+here blocks: the owner calls on_flow/on_data for matching messages and
+pump() whenever it is idle, normally from a Dispatcher.  Per-chunk
+latency, bytes, flow times and queue depths go to a metrics.Registry.
+"""
+from collections import deque
+from pathlib import Path
+from mpi4py import MPI
+import os
+import sys
+import time
+import hashing
+from transfer_engine import SEQ, DEFAULT_WINDOW
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import delta, metrics
+
+FLOW_TAG = 4
+DATA_TAG_BASE = 16
+MAX_RESENDS = 3
+MAX_INCOMING = 4
+MAX_OUTGOING = 4
+
+
+class OutgoingFlow:
+    def __init__(self, tid, dest, path, info, chunk_size, window, progress):
+        self.tid = tid
+        self.dest = dest
+        self.info = info
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.f = open(path, 'rb')
+        self.digest = hashing.digester(info['hash'])
+        self.digests = [None] * info['chunks']
+        self.pending = deque(range(info['chunks']))
+        self.bufs = [bytearray(SEQ.size + chunk_size) for _ in range(window)]
+        self.requests = [MPI.REQUEST_NULL] * window
+        self.slot = 0
+        self.sent = 0
+        self.state = "queued"       # -> offered -> streaming -> verifying
+        self.trailer_sent = False
+        self.finished = False
+        self.ok = None              # receiver's verdict, set on 'done'
+        self.error = None           # why the receiver refused the flow, if it did
+        self.encoder = None         # delta.Encoder of a delta flow
+
+    def start_delta(self, signature):
+        """Send delta ops against the receiver's old copy instead of chunks"""
+        self.hasher = hashing.new(self.info['hash'])
+        self.encoder = delta.Encoder(signature, self.f, self.hasher)
+        self.batches = iter(self.encoder)
+        self.bufs = [None] * len(self.bufs)
+
+    def pump(self, comm, post):
+        """Post at most one chunk; returns True if anything was done"""
+        if self.state != "streaming":
+            return False
+        if self.encoder:
+            return self._pump_delta(comm, post)
+        if self.pending:
+            # Reuse a buffer only after its previous Isend finished
+            if not self.requests[self.slot].Test():
+                return False
+            seq = self.pending.popleft()
+            view = memoryview(self.bufs[self.slot])
+            SEQ.pack_into(view, 0, seq)
+            self.f.seek(seq * self.chunk_size)
+            n = self.f.readinto(view[SEQ.size:])
+            self.requests[self.slot] = comm.Isend([view[:SEQ.size + n], MPI.BYTE],
+                                                  dest=self.dest, tag=DATA_TAG_BASE + self.tid)
+            if self.digests[seq] is None:
+                self.digests[seq] = self.digest(view[SEQ.size:SEQ.size + n])
+            self.slot = (self.slot + 1) % len(self.bufs)
+            self.sent += 1
+            if self.progress:
+                self.progress(self.sent, self.info['chunks'])
+            return True
+        if not MPI.Request.Testall(self.requests):
+            return False
+        if not self.trailer_sent:
+            post({'op': 'digests', 'tid': self.tid, 'digests': self.digests,
+                  'checksum': hashing.root(self.info['hash'], self.digests)}, self.dest)
+            self.trailer_sent = True
+        self.state = "verifying"
+        return True
+
+    def _pump_delta(self, comm, post):
+        """Post the next batch of delta ops, or the end message"""
+        if not self.requests[self.slot].Test():
+            return False
+        batch = next(self.batches, None)
+        if batch is None:
+            post({'op': 'end', 'tid': self.tid, 'batches': self.sent,
+                  'checksum': self.hasher.hexdigest()}, self.dest)
+            self.state = "verifying"
+            return True
+        # The batch must stay alive until its Isend completes
+        self.bufs[self.slot] = batch
+        self.requests[self.slot] = comm.Isend([batch, MPI.BYTE], dest=self.dest,
+                                              tag=DATA_TAG_BASE + self.tid)
+        self.slot = (self.slot + 1) % len(self.bufs)
+        self.sent += 1
+        return True
+
+    def close(self):
+        self.f.close()
+        self.finished = True
+
+
+def partial_name(filename, source, tid):
+    """Temp file one flow writes before its copy verifies"""
+    return f"{filename}.{source}-{tid}.part"
+
+
+class IncomingFlow:
+    def __init__(self, tid, source, filename, info):
+        self.tid = tid
+        self.source = source
+        self.filename = filename
+        self.info = info
+        self.partial = partial_name(filename, source, tid)
+        self.f = open(self.partial, 'wb')
+        self.digest = hashing.digester(info['hash'])
+        self.buf = bytearray(SEQ.size + info['chunk_size'])
+        self.status = MPI.Status()
+        self.digests = {}
+        self.outstanding = info['chunks']
+        self.expected = None
+        self.attempts = 0
+        self.result = None
+
+    def on_chunk(self, msg):
+        msg.Recv([self.buf, MPI.BYTE], status=self.status)
+        view = memoryview(self.buf)
+        n = self.status.Get_count(MPI.BYTE) - SEQ.size
+        (seq,) = SEQ.unpack_from(view)
+        self.digests[seq] = self.digest(view[SEQ.size:SEQ.size + n])
+        offset = seq * self.info['chunk_size']
+        written = 0
+        while written < n:
+            written += os.pwrite(self.f.fileno(), view[SEQ.size + written:SEQ.size + n], offset + written)
+        self.outstanding -= 1
+
+    def bad_chunks(self):
+        return [seq for seq, d in enumerate(self.expected['digests']) if self.digests.get(seq) != d]
+
+    def close(self):
+        """Close the file, move it into place if it verifies, and return the result"""
+        size = os.fstat(self.f.fileno()).st_size
+        self.f.close()
+        checksum = hashing.root(self.info['hash'],
+                                [self.digests.get(seq, b"") for seq in range(self.info['chunks'])])
+        if size != self.info['size']:
+            self.result = "size mismatch"
+        elif checksum != self.expected['checksum']:
+            self.result = "checksum mismatch"
+        else:
+            try:
+                os.replace(self.partial, self.filename)
+                self.result = f"ok, {self.info['hash']} {checksum[:16]}"
+            except OSError as e:
+                self.result = f"write failed: {e}"
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        return self.result
+
+    def abort(self, reason):
+        self.f.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        self.result = reason
+
+
+class RefusedFlow:
+    """Stands in for an offered flow that failed before it was admitted"""
+
+    def __init__(self, tid, source, filename, info, result):
+        self.tid = tid
+        self.source = source
+        self.filename = filename
+        self.info = info
+        self.result = result
+        self.started = time.perf_counter()
+        self.wire_bytes = 0
+
+
+class DeltaIncomingFlow:
+    """Rebuilds filename from its old copy and the sender's delta ops"""
+
+    def __init__(self, tid, source, filename, info, block_size):
+        self.tid = tid
+        self.source = source
+        self.filename = filename
+        self.info = info
+        self.partial = partial_name(filename, source, tid)
+        self.basis = open(filename, 'rb')
+        try:
+            self.f = open(self.partial, 'wb')
+        except OSError:
+            self.basis.close()
+            raise
+        self.hasher = hashing.new(info['hash'])
+        self.patcher = delta.Patcher(self.basis, self.f, block_size, self.hasher)
+        self.buf = bytearray(delta.MAX_BATCH)
+        self.status = MPI.Status()
+        self.received = 0
+        self.error = None
+        self.expected = None
+        self.attempts = 0
+        self.result = None
+
+    @property
+    def outstanding(self):
+        return self.expected['batches'] - self.received if self.expected else 0
+
+    def on_chunk(self, msg):
+        msg.Recv([self.buf, MPI.BYTE], status=self.status)
+        self.received += 1
+        if self.error is None:
+            try:
+                self.patcher.feed(memoryview(self.buf)[:self.status.Get_count(MPI.BYTE)])
+            except ValueError as e:
+                self.error = e
+
+    def bad_chunks(self):
+        # Nothing to resend piecewise: a bad update fails as a whole
+        return []
+
+    def close(self):
+        """Close the files, keep the new copy if it verifies, and return the result"""
+        self.f.close()
+        self.basis.close()
+        checksum = self.hasher.hexdigest()
+        if self.error is not None:
+            self.result = f"delta failed: {self.error}"
+        elif self.patcher.written != self.info['size']:
+            self.result = "size mismatch"
+        elif checksum != self.expected['checksum']:
+            self.result = "checksum mismatch"
+        else:
+            try:
+                os.replace(self.partial, self.filename)
+                self.result = (f"ok, delta sent {self.patcher.literal:,} of {self.info['size']:,} bytes, "
+                               f"{self.info['hash']} {checksum[:16]}")
+            except OSError as e:
+                self.result = f"write failed: {e}"
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        return self.result
+
+    def abort(self, reason):
+        self.f.close()
+        self.basis.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        self.result = reason
+
+
+class TransferScheduler:
+    """Admission control and round-robin progress for one rank's flows.
+
+    incoming_name(source, info) picks the file name for a received file;
+    on_received(flow) and on_sent(flow) are called when a flow finishes,
+    with flow.started and flow.wire_bytes set."""
+
+    def __init__(self, comm, chunk_size, incoming_name, on_received, on_sent,
+                 max_incoming=MAX_INCOMING, max_outgoing=MAX_OUTGOING, window=DEFAULT_WINDOW,
+                 registry=None):
+        self.comm = comm
+        self.chunk_size = chunk_size
+        self.incoming_name = incoming_name
+        self.on_received = on_received
+        self.on_sent = on_sent
+        self.max_incoming = max_incoming
+        self.max_outgoing = max_outgoing
+        self.window = window
+        self.outgoing = {}          # (dest, tid) -> OutgoingFlow
+        self.incoming = {}          # (source, tid) -> IncomingFlow
+        self.waiting_out = deque()
+        self.waiting_in = deque()
+        self.posted = []            # isend requests of flow messages
+        self.next_tid = 0
+        self.last_activity = time.monotonic()   # of the last flow message or chunk
+        self.tid_limit = comm.Get_attr(MPI.TAG_UB) - DATA_TAG_BASE
+        registry = registry or metrics.Registry()
+        self.chunk_seconds = registry.histogram("mpi_chunk_seconds", "Time to post or land one chunk")
+        self.flow_seconds = registry.histogram("mpi_transfer_seconds", "Admission to verified, per file")
+        self.bytes = registry.counter("mpi_bytes_total", "Bytes sent as chunks or delta ops")
+        self.flows = registry.gauge("mpi_flows", "Transfers by direction and state")
+        self.checksum_seconds = registry.histogram("mpi_checksum_seconds", "Time spent hashing files")
+
+    def send(self, path, info, dest, progress=None):
+        """Queue path for dest; returns the flow"""
+        tid = self.next_tid
+        self.next_tid = (self.next_tid + 1) % self.tid_limit
+        flow = OutgoingFlow(tid, dest, path, info, self.chunk_size, self.window, progress)
+        self.waiting_out.append(flow)
+        self._admit_outgoing()
+        return flow
+
+    def _post(self, message, dest):
+        # Never a blocking send: two ranks sending each other a large
+        # digests message at the same time would deadlock
+        self.posted.append(self.comm.isend(message, dest=dest, tag=FLOW_TAG))
+
+    def _admit_outgoing(self):
+        while self.waiting_out and len(self.outgoing) < self.max_outgoing:
+            flow = self.waiting_out.popleft()
+            self.outgoing[(flow.dest, flow.tid)] = flow
+            flow.state = "offered"
+            flow.started = time.perf_counter()
+            self._post({'op': 'offer', 'tid': flow.tid, 'info': flow.info}, flow.dest)
+        self.flows.set(len(self.outgoing), direction="out", state="active")
+        self.flows.set(len(self.waiting_out), direction="out", state="queued")
+
+    def _admit_incoming(self):
+        while self.waiting_in and len(self.incoming) < self.max_incoming:
+            source, tid, info = self.waiting_in.popleft()
+            filename = self.incoming_name(source, info)
+            accept = {'op': 'accept', 'tid': tid}
+            try:
+                if info.get('delta') and os.path.isfile(filename):
+                    with self.checksum_seconds.time(kind="signature"):
+                        signature = delta.Signature.of_file(filename)
+                    flow = DeltaIncomingFlow(tid, source, filename, info, signature.block_size)
+                    accept['signature'] = signature.pack()
+                else:
+                    flow = IncomingFlow(tid, source, filename, info)
+            except OSError as e:
+                # The sender fails the flow as if it had not verified,
+                # so its owner's retry path runs
+                flow = RefusedFlow(tid, source, filename, info, f"refused: {e}")
+                self._post({'op': 'done', 'tid': tid, 'ok': False, 'error': flow.result}, source)
+                self.on_received(flow)
+                continue
+            flow.started = time.perf_counter()
+            self.incoming[(source, tid)] = flow
+            self._post(accept, source)
+        self.flows.set(len(self.incoming), direction="in", state="active")
+        self.flows.set(len(self.waiting_in), direction="in", state="queued")
+
+    def on_flow(self, source, msg):
+        """Handle a FLOW_TAG message matched by the dispatcher"""
+        m = msg.recv()
+        self.last_activity = time.monotonic()
+        op, key = m['op'], (source, m['tid'])
+        if op == 'offer':
+            self.waiting_in.append((source, m['tid'], m['info']))
+            self._admit_incoming()
+        elif op == 'abort':
+            self._abort_incoming(key, f"sender failed: {m['error']}")
+        elif op == 'closed':
+            # The sender has stopped after our write failure; nothing more is coming
+            flow = self.incoming.pop(key, None)
+            if flow is not None:
+                flow.wire_bytes = 0
+                self.on_received(flow)
+                self._admit_incoming()
+        elif key not in (self.outgoing if op in ('accept', 'resend', 'done') else self.incoming):
+            # A flow this side has already failed; the peer learns from our message
+            return
+        elif op == 'accept':
+            flow = self.outgoing[key]
+            if 'signature' in m:
+                flow.start_delta(delta.Signature.unpack(m['signature']))
+            flow.state = "streaming"
+        elif op == 'resend':
+            flow = self.outgoing[key]
+            flow.pending.extend(m['seqs'])
+            flow.state = "streaming"
+        elif op == 'done':
+            flow = self.outgoing[key]
+            if flow.state == "closing":
+                return          # already failed here; the receiver learns from our abort
+            flow.ok = m['ok']
+            flow.error = m.get('error')
+            if m.get('drain'):
+                self._close_outgoing(flow, {'op': 'closed', 'tid': flow.tid})
+                return
+            del self.outgoing[key]
+            refused = flow.state == "offered"
+            flow.close()
+            if refused:
+                flow.wire_bytes = 0
+            else:
+                flow.wire_bytes = flow.encoder.literal if flow.encoder else flow.info['size']
+            self.bytes.inc(flow.wire_bytes, direction="out")
+            self.flow_seconds.observe(time.perf_counter() - flow.started, direction="out")
+            self.on_sent(flow)
+            self._admit_outgoing()
+        elif op in ('digests', 'end'):
+            flow = self.incoming[key]
+            if flow.result is not None:
+                return          # failed and draining until the sender's closed
+            flow.expected = m
+            self._check(flow)
+
+    def on_data(self, source, tag, msg):
+        """Handle a chunk on a flow's data tag; False if no such flow"""
+        flow = self.incoming.get((source, tag - DATA_TAG_BASE))
+        if flow is None:
+            return False
+        self.last_activity = time.monotonic()
+        if flow.result is not None:
+            msg.Recv([flow.buf, MPI.BYTE])
+            return True
+        try:
+            with self.chunk_seconds.time(direction="in"):
+                flow.on_chunk(msg)
+        except OSError as e:
+            flow.abort(f"write failed: {e}")
+            self._post({'op': 'done', 'tid': flow.tid, 'ok': False, 'error': flow.result,
+                        'drain': True}, source)
+            return True
+        self._check(flow)
+        return True
+
+    def _abort_incoming(self, key, reason):
+        """End an incoming flow as failed, whether it was admitted yet or not"""
+        flow = self.incoming.pop(key, None)
+        if flow is None:
+            for waiting in self.waiting_in:
+                if waiting[:2] == key:
+                    self.waiting_in.remove(waiting)
+                    source, tid, info = waiting
+                    self.on_received(RefusedFlow(tid, source, self.incoming_name(source, info), info, reason))
+                    break
+            return
+        if flow.result is None:
+            flow.abort(reason)
+        flow.wire_bytes = 0
+        self.on_received(flow)
+        self._admit_incoming()
+
+    def _abort_outgoing(self, flow, error):
+        """Fail an outgoing flow that cannot go on and tell its receiver"""
+        self._post({'op': 'abort', 'tid': flow.tid, 'error': str(error)}, flow.dest)
+        flow.ok = False
+        flow.error = f"send failed: {error}"
+        self._close_outgoing(flow, None)
+
+    def _close_outgoing(self, flow, message):
+        """Stop sending; pump() ends the flow, posting message, once its Isends complete"""
+        flow.pending.clear()
+        flow.state = "closing"
+        flow.closing_message = message
+        flow.wire_bytes = 0
+
+    def _end_outgoing(self, flow):
+        del self.outgoing[(flow.dest, flow.tid)]
+        flow.close()
+        if flow.closing_message:
+            self._post(flow.closing_message, flow.dest)
+        self.on_sent(flow)
+        self._admit_outgoing()
+
+    def _check(self, flow):
+        """Finish, or ask for the bad chunks, once all data and the digests are in"""
+        if flow.outstanding or flow.expected is None:
+            return
+        bad = flow.bad_chunks()
+        if bad and flow.attempts < MAX_RESENDS:
+            flow.attempts += 1
+            flow.outstanding = len(bad)
+            self._post({'op': 'resend', 'tid': flow.tid, 'seqs': bad}, flow.source)
+            return
+        del self.incoming[(flow.source, flow.tid)]
+        ok = flow.close().startswith("ok")
+        self._post({'op': 'done', 'tid': flow.tid, 'ok': ok, 'error': None if ok else flow.result},
+                   flow.source)
+        flow.wire_bytes = flow.patcher.literal if isinstance(flow, DeltaIncomingFlow) else flow.info['size']
+        self.bytes.inc(flow.wire_bytes, direction="in")
+        self.flow_seconds.observe(time.perf_counter() - flow.started, direction="in")
+        self.on_received(flow)
+        self._admit_incoming()
+
+    def pump(self):
+        """Give every active outgoing flow one turn; True if any made progress"""
+        progressed = False
+        for flow in list(self.outgoing.values()):
+            if flow.state == "closing":
+                # The buffers must stay alive until their Isends complete
+                if MPI.Request.Testall(flow.requests):
+                    self._end_outgoing(flow)
+                    progressed = True
+                continue
+            start = time.perf_counter()
+            try:
+                pumped = flow.pump(self.comm, self._post)
+            except (OSError, ValueError) as e:
+                self._abort_outgoing(flow, e)
+                progressed = True
+                continue
+            if pumped:
+                self.chunk_seconds.observe(time.perf_counter() - start, direction="out")
+                progressed = True
+        if self.posted:
+            self.posted = [req for req in self.posted if not req.Test()]
+        return progressed
+
+    def busy(self):
+        return bool(self.outgoing or self.incoming or self.waiting_out or self.waiting_in or self.posted)
+
+    def summary(self):
+        return (f"in {len(self.incoming)} active / {len(self.waiting_in)} queued, "
+                f"out {len(self.outgoing)} active / {len(self.waiting_out)} queued")
@@ -0,0 +1,130 @@
+"""Buffer-based chunk transport used by FileTransfer.
+
+Chunks travel straight from and into preallocated bytearrays, so nothing
+is pickled and no bytes object is created per chunk.
+
+Point-to-point chunks (see scheduler.py) are an 8-byte sequence number
+followed by the chunk data; the receiver pwrite()s chunk `seq` at
+`seq * chunk_size`, so the file is correct whatever order they land in.
+ChunkBroadcaster and StripedIO move whole files between all ranks with
+collective broadcasts and collective MPI-IO.
+"""
+from mpi4py import MPI
+import struct
+
+DEFAULT_WINDOW = 8
+BCAST_CHUNK_SIZE = 1024 * 1024
+STRIPE_BLOCK_SIZE = 4 * 1024 * 1024
+SEQ = struct.Struct("<Q")
+
+
+class ChunkBroadcaster:
+    """Broadcasts a file from root to every rank of comm with Ibcast.
+
+    MPI picks a tree or pipelined algorithm for each Ibcast, so the root
+    sends roughly log N copies instead of N.  Two buffers alternate: the
+    root reads chunk i+1 and the other ranks write chunk i-1 while chunk i
+    is being broadcast.  Given a digest function every rank hashes each
+    chunk as it passes, so the copies can be checked without reading the
+    file again.  Every rank of comm must call bcast_file."""
+
+    def __init__(self, comm, chunk_size=BCAST_CHUNK_SIZE):
+        self.comm = comm
+        self.chunk_size = chunk_size
+        self.bufs = [bytearray(chunk_size) for _ in range(2)]
+        self.views = [memoryview(buf) for buf in self.bufs]
+
+    def bcast_file(self, f, size, root, progress=None, digest=None):
+        """Broadcast size bytes: root reads them from f, other ranks write them to f.
+
+        Returns the digest of each chunk in order, or [] without digest."""
+        is_root = self.comm.Get_rank() == root
+        chunks = -(-size // self.chunk_size)
+        requests = [MPI.REQUEST_NULL, MPI.REQUEST_NULL]
+        lengths = [0, 0]
+        digests = []
+
+        def finish(slot):
+            requests[slot].Wait()
+            if not is_root and lengths[slot]:
+                view = self.views[slot][:lengths[slot]]
+                if digest:
+                    digests.append(digest(view))
+                f.write(view)
+
+        for seq in range(chunks):
+            slot = seq % 2
+            if seq >= 2:
+                finish(slot)
+            n = min(self.chunk_size, size - seq * self.chunk_size)
+            view = self.views[slot][:n]
+            if is_root:
+                f.readinto(view)
+                if digest:
+                    digests.append(digest(view))
+            lengths[slot] = n
+            requests[slot] = self.comm.Ibcast([view, MPI.BYTE], root=root)
+            if progress:
+                progress(seq + 1, chunks)
+        for seq in range(max(0, chunks - 2), chunks):
+            finish(seq % 2)
+        return digests
+
+
+def stripe_range(size, index, count):
+    """(offset, length) of stripe index when size bytes are split count ways"""
+    start = size * index // count
+    return start, size * (index + 1) // count - start
+
+
+class StripedIO:
+    """Collective MPI-IO on one shared file, one disjoint stripe per rank.
+
+    Every rank of comm opens the shared file and calls Read_at_all or
+    Write_at_all on its own byte range, so the MPI-IO layer can merge the
+    requests and the ranks use the filesystem in parallel.  Collective
+    calls must match on all ranks: ranks with a short stripe (or none)
+    keep calling with an empty buffer until the longest stripe is done."""
+
+    def __init__(self, comm, block_size=STRIPE_BLOCK_SIZE):
+        self.comm = comm
+        self.block_size = block_size
+        self.buf = bytearray(block_size)
+        self.view = memoryview(self.buf)
+
+    def _rounds(self, length):
+        longest = self.comm.allreduce(length, op=MPI.MAX)
+        return -(-longest // self.block_size)
+
+    def scatter(self, path, offset, length, out):
+        """Read [offset, offset+length) of the shared file at path into out."""
+        fh = MPI.File.Open(self.comm, path, MPI.MODE_RDONLY)
+        try:
+            done = 0
+            for _ in range(self._rounds(length)):
+                n = min(self.block_size, length - done)
+                fh.Read_at_all(offset + done, [self.view[:n], MPI.BYTE])
+                if n:
+                    out.write(self.view[:n])
+                    done += n
+        finally:
+            fh.Close()
+        return done
+
+    def gather(self, path, length, src):
+        """Write length bytes read from src into the shared file at path.
+
+        Stripes are laid out in rank order; returns the total file size."""
+        offset = self.comm.exscan(length) or 0
+        total = self.comm.allreduce(length)
+        fh = MPI.File.Open(self.comm, path, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+        try:
+            fh.Set_size(total)
+            done = 0
+            for _ in range(self._rounds(length)):
+                n = src.readinto(self.view[:min(self.block_size, length - done)]) if done < length else 0
+                fh.Write_at_all(offset + done, [self.view[:n], MPI.BYTE])
+                done += n
+        finally:
+            fh.Close()
+        return total
@@ -0,0 +1,529 @@
+"""Headless benchmark suite for the socket, XML-RPC and MPI transfer paths.
+
+    python bench_suite.py --output baseline.json
+    python bench_suite.py --paths tcp mpi --sizes 1M 1G --ranks 2 4 8 --output new.json
+    python bench_suite.py --suite full --output new.json --compare baseline.json
+    python bench_suite.py --load new.json --compare baseline.json
+
+Every case runs on loopback in its own scratch directory with a freshly
+started server (or mpiexec run), so cases do not disturb each other:
+
+  tcp  Practical1 server.py; `concurrency` clients upload one file each over
+       their own connection, then download it again.  The chunk size is
+       the server's receive buffer.  Every download is checked against
+       its source (size and hash) before the case counts.
+  rpc  Practical2 server.py; clients use stream_upload/stream_download.
+       The chunk size is the bytes moved per call.  Downloads are checked
+       like tcp ones.
+  mpi  Practical3 file_transfer_mpi.py --batch on `ranks` processes; the
+       master puts `concurrency` files at once.  The chunk size is passed
+       as --chunk-size; every rank counts as the server side, and the
+       per-file times come from the master's metrics_rank0.jsonl.  With
+       Open MPI's mpiexec, --oversubscribe (and --allow-run-as-root when
+       running as root) is added; other launchers get the command as is.
+
+A result holds the MB/s of the whole case, p50/p99 of the per-file
+transfer times, the CPU seconds of the server side and of the clients,
+and the peak RSS of the largest server-side process (read from /proc, so
+Linux only; None elsewhere).  Repeats are pooled: median MB/s, all
+latencies together.  With --compare a case regresses when its MB/s drops,
+or its p99 rises, by more than --threshold against the same case in the
+baseline; the exit status is then 1.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import re
+import resource
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xmlrpc.client
+from pathlib import Path
+
+from common.bench import parse_size, percentile
+
+ROOT = Path(__file__).resolve().parent
+SUITES = {
+    'quick': {'sizes': ["1K", "1M", "16M"], 'chunk_sizes': ["64K", "1M"],
+              'concurrency': [1, 4], 'ranks': [2, 4], 'repeat': 3},
+    'full': {'sizes': ["1K", "1M", "64M", "1G", "4G"], 'chunk_sizes': ["16K", "64K", "1M", "4M"],
+             'concurrency': [1, 4, 16], 'ranks': [2, 4, 8], 'repeat': 3},
+}
+# A case whose files add up to more than this is skipped (see --max-bytes)
+MAX_CASE_BYTES = 16 << 30
+SAMPLE_INTERVAL = 0.1
+START_TIMEOUT = 20
+
+
+def format_size(n):
+    for unit, scale in (("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)):
+        if n >= scale and n % scale == 0:
+            return f"{n // scale}{unit}"
+    return str(n)
+
+
+def make_file(path, size):
+    """Random (incompressible) test data; no two blocks alike, so misplaced data shows"""
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            n = min(remaining, 1 << 20)
+            f.write(os.urandom(n))
+            remaining -= n
+
+
+def file_digest(path):
+    """(size, blake2b hex digest) of a file"""
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return os.path.getsize(path), h.hexdigest()
+
+
+def verify_downloads(work, names, prefix="downloaded_"):
+    """Raise unless every downloaded copy matches its source"""
+    expected = {}
+    for name in names:
+        source = os.path.realpath(os.path.join(work, name))
+        if source not in expected:
+            expected[source] = file_digest(source)
+        if file_digest(os.path.join(work, prefix + name)) != expected[source]:
+            raise RuntimeError(f"downloaded copy of {name} differs from the source")
+
+
+def make_inputs(work, size, count):
+    """count names for one test file; hard links, so the disk holds it once"""
+    first = os.path.join(work, "data_0.bin")
+    make_file(first, size)
+    names = ["data_0.bin"]
+    for i in range(1, count):
+        os.link(first, os.path.join(work, f"data_{i}.bin"))
+        names.append(f"data_{i}.bin")
+    return names
+
+
+def load(practical, module):
+    """Import PracticalN/module.py under a unique name, with its directory on the path"""
+    directory = str(ROOT / practical)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{practical.lower()}_{module}",
+                                                      ROOT / practical / f"{module}.py")
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    finally:
+        sys.path.remove(directory)
+    return mod
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc):
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with status {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not listen on port {port}")
+
+
+def _process_tree(root):
+    """root and all its descendants, from the parent links in /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, ()))
+    return tree
+
+
+def _process_usage(pid):
+    """(CPU seconds, peak RSS bytes) of one process, or None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            hwm = next((int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:")), 0)
+    except (OSError, StopIteration):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    return (int(fields[11]) + int(fields[12])) / ticks, hwm
+
+
+class Sampler(threading.Thread):
+    """CPU time and peak RSS of a process tree, sampled every SAMPLE_INTERVAL"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.enabled = os.path.isdir("/proc")
+        self.cpu = {}
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        if not self.enabled:
+            return
+        for pid in _process_tree(self.pid):
+            usage = _process_usage(pid)
+            if usage:
+                self.cpu[pid] = usage[0]
+                self.peak = max(self.peak, usage[1])
+
+    def cpu_seconds(self):
+        return sum(self.cpu.values()) if self.enabled else None
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def finish(self):
+        """Take a last sample and stop; returns (CPU seconds, peak RSS MB)"""
+        self.sample()
+        self.stopped.set()
+        self.join()
+        if not self.enabled:
+            return None, None
+        return self.cpu_seconds(), self.peak / 1e6
+
+
+def run_clients(target, names):
+    """Run target(name) for every name in its own thread; returns per-file seconds"""
+    times, errors = [], []
+
+    def one(name):
+        start = time.perf_counter()
+        try:
+            target(name)
+        except Exception as e:
+            errors.append(e)
+        times.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=one, args=(name,)) for name in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return times
+
+
+def run_phases(server, phases, size, names):
+    """Time each (op, target) phase against a started server process"""
+    sampler = Sampler(server.pid)
+    sampler.start()
+    results = []
+    for op, target in phases:
+        sampler.sample()
+        server_cpu = sampler.cpu_seconds()
+        client_cpu = time.process_time()
+        start = time.perf_counter()
+        times = run_clients(target, names)
+        wall = time.perf_counter() - start
+        sampler.sample()
+        results.append({'op': op, 'wall': wall, 'times': times, 'bytes': size * len(names),
+                        'client_cpu': time.process_time() - client_cpu,
+                        'server_cpu': None if server_cpu is None else sampler.cpu_seconds() - server_cpu})
+    peak = sampler.finish()[1]
+    for r in results:
+        r['peak_rss_mb'] = peak
+    return results
+
+
+def stop_server(proc, sig=signal.SIGTERM):
+    proc.send_signal(sig)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_tcp(args, work, size, chunk, concurrency, ranks):
+    client = load("Practical1", "client")
+    names = make_inputs(work, size, concurrency)
+    port = free_port()
+    server = subprocess.Popen([sys.executable, str(ROOT / "Practical1" / "server.py")], cwd=work,
+                              stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, text=True)
+    # Answers to the prompts: host, port, max connections, buffer KiB
+    server.stdin.write(f"127.0.0.1\n{port}\n{max(16, concurrency)}\n{max(1, chunk // 1024)}\n")
+    server.stdin.close()
+    try:
+        wait_for_port(port, server)
+
+        def upload(name):
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                client.send_upload(sock, os.path.join(work, name))
+                opcode, flags, response = client.recv_reply(sock)
+                if response != b"OK":
+                    raise RuntimeError(f"upload of {name}: {response!r}")
+
+        def download(name):
+            # Each thread needs its own Receiver: they share nothing but the server
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                if not client.download(sock, name, client.transfer.Receiver()):
+                    raise RuntimeError(f"download of {name} failed")
+
+        cwd = os.getcwd()
+        os.chdir(work)          # the client saves downloaded_<name> in the cwd
+        try:
+            results = run_phases(server, [("upload", upload), ("download", download)], size, names)
+        finally:
+            os.chdir(cwd)
+        verify_downloads(work, names)
+        return results
+    finally:
+        stop_server(server)
+
+
+def run_rpc(args, work, size, chunk, concurrency, ranks):
+    client = load("Practical2", "client")
+    names = make_inputs(work, size, concurrency)
+    port = free_port()
+    server = subprocess.Popen([sys.executable, str(ROOT / "Practical2" / "server.py"),
+                               "--host", "127.0.0.1", "--port", str(port),
+                               "--workers", str(max(8, concurrency)),
+                               "--metrics", os.path.join(work, "server_metrics")],
+                              cwd=work, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/RPC2"
+    try:
+        wait_for_port(port, server)
+
+        def upload(name):
+            rpc = xmlrpc.client.ServerProxy(url, allow_none=True)
+            client.stream_upload(rpc, os.path.join(work, name), name, chunk, compress=False)
+
+        def download(name):
+            rpc = xmlrpc.client.ServerProxy(url, allow_none=True)
+            if client.stream_download(rpc, name, os.path.join(work, "downloaded_" + name),
+                                      chunk, compress=False) is None:
+                raise RuntimeError(f"download of {name} failed")
+
+        results = run_phases(server, [("upload", upload), ("download", download)], size, names)
+        verify_downloads(work, names)
+        return results
+    finally:
+        stop_server(server, signal.SIGINT)
+
+
+def is_open_mpi(command):
+    try:
+        out = subprocess.run(command[:1] + ["--version"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return "Open MPI" in out.stdout + out.stderr or "OpenRTE" in out.stdout + out.stderr
+
+
+def mpiexec_command(args):
+    """The launcher; Open MPI also needs leave to run more ranks than cores, and as root"""
+    command = shlex.split(args.mpiexec)
+    if is_open_mpi(command):
+        if "--oversubscribe" not in command:
+            command.append("--oversubscribe")
+        if hasattr(os, "geteuid") and os.geteuid() == 0 and "--allow-run-as-root" not in command:
+            command.append("--allow-run-as-root")
+    return command
+
+
+def run_mpi(args, work, size, chunk, concurrency, ranks):
+    names = make_inputs(work, size, concurrency)
+    with open(os.path.join(work, "jobs.txt"), "w") as f:
+        f.writelines(f"put {name}\n" for name in names)
+    command = mpiexec_command(args) + ["-n", str(ranks), sys.executable, str(ROOT / "Practical3" / "file_transfer_mpi.py"),
+                         "--batch", "jobs.txt", "--chunk-size", str(chunk), "--prefetch", str(concurrency)]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=work, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    sampler = Sampler(proc.pid)
+    sampler.start()
+    output = proc.communicate()[0]
+    wall = time.perf_counter() - start
+    peak = sampler.finish()[1]
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if proc.returncode != 0 or f"Jobs: {len(names)} ok" not in output:
+        raise RuntimeError(f"mpiexec run failed:\n{output[-2000:]}")
+
+    # The master logs every finished put, with its time, in its event log
+    with open(os.path.join(work, "metrics_rank0.jsonl")) as f:
+        times = [e['seconds'] for e in map(json.loads, f) if e['event'] == "sent"]
+    makespan = re.search(r"Makespan: ([\d.]+)s", output)
+    cpu = (after.ru_utime + after.ru_stime) - (before.ru_utime + before.ru_stime)
+    return [{'op': "put", 'wall': float(makespan.group(1)) if makespan else wall, 'times': times,
+             'bytes': size * len(names), 'client_cpu': 0.0, 'server_cpu': cpu, 'peak_rss_mb': peak}]
+
+
+def run_case(args, path, size, chunk, concurrency, ranks):
+    """Run one case args.repeat times; returns one pooled result per op"""
+    runs = {}
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory(prefix="bench_", dir=args.workdir) as work:
+            measured = RUNNERS[path](args, work, size, chunk, concurrency, ranks)
+        for m in measured:
+            runs.setdefault(m['op'], []).append(m)
+
+    results = []
+    for op, samples in runs.items():
+        times = [t for s in samples for t in s['times']]
+        rates = [s['bytes'] / max(s['wall'], 1e-9) / 1e6 for s in samples]
+        server_cpu = [s['server_cpu'] for s in samples if s['server_cpu'] is not None]
+        rss = [s['peak_rss_mb'] for s in samples if s['peak_rss_mb'] is not None]
+        results.append({
+            'path': path, 'op': op, 'size': size, 'chunk_size': chunk,
+            'concurrency': concurrency, 'ranks': ranks, 'runs': len(samples),
+            'mb_s': round(statistics.median(rates), 3),
+            'mb_s_runs': [round(r, 3) for r in rates],
+            'seconds': round(statistics.median(s['wall'] for s in samples), 6),
+            'p50_ms': round(percentile(times, 50) * 1000, 3),
+            'p99_ms': round(percentile(times, 99) * 1000, 3),
+            'server_cpu_s': round(statistics.median(server_cpu), 3) if server_cpu else None,
+            'client_cpu_s': round(statistics.median(s['client_cpu'] for s in samples), 3),
+            'peak_rss_mb': round(max(rss), 1) if rss else None,
+        })
+    return results
+
+
+RUNNERS = {'tcp': run_tcp, 'rpc': run_rpc, 'mpi': run_mpi}
+
+
+def case_name(r):
+    name = f"{r['path']} {r['op']} {format_size(r['size'])} chunk {format_size(r['chunk_size'])} x{r['concurrency']}"
+    return name + (f" n{r['ranks']}" if r['ranks'] else "")
+
+
+def case_key(r):
+    return (r['path'], r['op'], r['size'], r['chunk_size'], r['concurrency'], r['ranks'])
+
+
+def print_result(r):
+    cpu = "-" if r['server_cpu_s'] is None else f"{r['server_cpu_s']:.2f}"
+    rss = "-" if r['peak_rss_mb'] is None else f"{r['peak_rss_mb']:.0f}"
+    print(f"{case_name(r):<42} {r['mb_s']:9.1f} {r['p50_ms']:10.2f} {r['p99_ms']:10.2f} "
+          f"{cpu:>7} {r['client_cpu_s']:7.2f} {rss:>7}", flush=True)
+
+
+def compare(results, baseline, threshold, min_latency_ms):
+    """Print every case against the baseline; returns the regressed cases"""
+    base = {case_key(r): r for r in baseline['results']}
+    regressed = []
+    print(f"\n{'case':<42} {'base MB/s':>10} {'MB/s':>9} {'change':>7} {'base p99':>9} {'p99':>9}")
+    for r in results:
+        old = base.get(case_key(r))
+        if old is None:
+            print(f"{case_name(r):<42} {'-':>10} {r['mb_s']:9.1f}   (not in baseline)")
+            continue
+        change = r['mb_s'] / old['mb_s'] - 1 if old['mb_s'] else 0.0
+        slower = change < -threshold
+        later = (r['p99_ms'] > old['p99_ms'] * (1 + threshold)
+                 and r['p99_ms'] - old['p99_ms'] > min_latency_ms)
+        flag = "  REGRESSION" + (" (throughput)" if slower else "") + (" (p99)" if later else "") \
+            if slower or later else ""
+        print(f"{case_name(r):<42} {old['mb_s']:10.1f} {r['mb_s']:9.1f} {change:+7.1%} "
+              f"{old['p99_ms']:9.2f} {r['p99_ms']:9.2f}{flag}")
+        if flag:
+            regressed.append(r)
+    print(f"\n{len(regressed)} regression(s) at a {threshold:.0%} threshold")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick",
+                        help="default sweep; the options below override parts of it")
+    parser.add_argument("--paths", nargs="+", choices=["tcp", "rpc", "mpi"], default=["tcp", "rpc", "mpi"])
+    parser.add_argument("--sizes", nargs="+")
+    parser.add_argument("--chunk-sizes", nargs="+")
+    parser.add_argument("--concurrency", nargs="+", type=int)
+    parser.add_argument("--ranks", nargs="+", type=int, help="mpi process counts")
+    parser.add_argument("--repeat", type=int)
+    parser.add_argument("--max-bytes", default=format_size(MAX_CASE_BYTES),
+                        help="skip cases whose files add up to more than this")
+    parser.add_argument("--mpiexec", default="mpiexec",
+                        help="launcher command for mpi (Open MPI gets --oversubscribe added)")
+    parser.add_argument("--workdir", help="where scratch directories go (default: system temp)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--load", metavar="RESULTS", help="compare saved results instead of running")
+    parser.add_argument("--compare", metavar="BASELINE", help="flag regressions against this result file")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative change")
+    parser.add_argument("--min-latency-ms", type=float, default=1.0,
+                        help="p99 increases smaller than this are noise")
+    args = parser.parse_args()
+
+    if args.load:
+        with open(args.load) as f:
+            report = json.load(f)
+    else:
+        suite = SUITES[args.suite]
+        sizes = [parse_size(s) for s in args.sizes or suite['sizes']]
+        chunks = [parse_size(s) for s in args.chunk_sizes or suite['chunk_sizes']]
+        concurrency = args.concurrency or suite['concurrency']
+        ranks = args.ranks or suite['ranks']
+        args.repeat = args.repeat or suite['repeat']
+        max_bytes = parse_size(args.max_bytes)
+
+        print(f"{'case':<42} {'MB/s':>9} {'p50 ms':>10} {'p99 ms':>10} {'srv cpu':>7} "
+              f"{'cli cpu':>7} {'rss MB':>7}")
+        results, skipped = [], []
+        for path in args.paths:
+            for size in sizes:
+                for chunk in chunks:
+                    for n in concurrency:
+                        for r in (ranks if path == "mpi" else [None]):
+                            if size * n > max_bytes:
+                                skipped.append(f"{path} {format_size(size)} x{n}")
+                                continue
+                            for result in run_case(args, path, size, chunk, n, r):
+                                print_result(result)
+                                results.append(result)
+        if skipped:
+            print(f"Skipped {len(skipped)} case(s) over --max-bytes: {', '.join(sorted(set(skipped)))}")
+        report = {
+            'meta': {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'host': platform.node(),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpus': os.cpu_count(), 'argv': sys.argv[1:], 'repeat': args.repeat},
+            'results': results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report['results'], baseline, args.threshold, args.min_latency_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Helpers shared by the Practical1, Practical2 and Practical3 programs."""
@@ -0,0 +1,19 @@
+"""Small helpers shared by the benchmark and load-test scripts."""
+
+
+def parse_size(text):
+    """Bytes in a size like '4096', '64K', '1.5M' or '3G' (binary units)"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def percentile(values, pct):
+    """The pct-th percentile of values by nearest rank; 0.0 if there are none"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
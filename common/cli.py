@@ -0,0 +1,139 @@
+"""Helpers for the non-interactive command lines of the three clients.
+
+Reporter writes events either as JSON lines, one object per event for
+scripts, or as short text lines for people:
+
+    {"ts": ..., "event": "start", "op": "upload", "file": "a.bin"}
+    {"ts": ..., "event": "progress", "op": "upload", "file": "a.bin", "bytes": 1048576, "total": 4194304}
+    {"ts": ..., "event": "done", "op": "upload", "file": "a.bin", "seconds": 0.21, "bytes": 4194304}
+    {"ts": ..., "event": "error", "op": "download", "file": "b.bin", "error": "FileNotFoundError: b.bin"}
+    {"ts": ..., "event": "summary", "ops": 2, "failed": 1, "seconds": 0.3}
+
+run_operations() runs many operations on a thread pool, each thread with
+its own connection, and read_manifest() reads the operation list of a
+'batch --manifest' run.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import shlex
+import sys
+import threading
+import time
+
+PROGRESS_INTERVAL = 0.5
+DEFAULT_JOBS = 4
+
+
+class Reporter:
+    """Thread-safe event writer; progress events are rate limited per file"""
+
+    def __init__(self, json_lines=False, stream=None, interval=PROGRESS_INTERVAL):
+        self.json_lines = json_lines
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = {}
+
+    def emit(self, event, **fields):
+        if self.json_lines:
+            line = json.dumps({'ts': round(time.time(), 6), 'event': event, **fields}, default=str)
+        else:
+            line = self._text(event, fields)
+            if line is None:
+                return
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def _text(self, event, fields):
+        what = f"{fields.get('op', '')} {fields.get('file', '')}".strip()
+        if event == "done":
+            seconds = fields.get('seconds')
+            if seconds is None:
+                return f"{what}: ok"
+            extra = ""
+            if fields.get('bytes') is not None:
+                rate = fields['bytes'] / max(seconds, 1e-9) / 1e6
+                extra = f" ({fields['bytes']:,} bytes, {rate:.1f} MB/s)"
+            return f"{what}: ok in {seconds:.3f}s{extra}"
+        if event == "error":
+            return f"{what}: FAILED - {fields['error']}"
+        if event == "summary":
+            return f"{fields['ops'] - fields['failed']}/{fields['ops']} operations ok in {fields['seconds']:.2f}s"
+        if event == "message":
+            return fields['text']
+        return None             # start and progress only go to JSON output
+
+    def progress(self, op, name, done, total):
+        now = time.monotonic()
+        key = (op, name)
+        if done < total and now - self.last.get(key, 0) < self.interval:
+            return
+        self.last[key] = now
+        self.emit("progress", op=op, file=name, bytes=done, total=total)
+
+    def callback(self, op, name):
+        """progress(done, total) function for one file"""
+        return lambda done, total: self.progress(op, name, done, total)
+
+
+def run_operations(operations, reporter, jobs=DEFAULT_JOBS, connect=None):
+    """Run [(op, name, fn), ...] on jobs threads; returns the number that failed.
+
+    connect() makes each thread's connection, passed to fn(conn) as the
+    only argument; fn returns a dict of fields for the 'done' event.  A
+    thread whose operation fails closes its connection, which may be
+    mid-reply, and reconnects before its next operation."""
+    local = threading.local()
+    opened = set()
+    opened_lock = threading.Lock()
+
+    def run(operation):
+        op, name, fn = operation
+        reporter.emit("start", op=op, file=name)
+        start = time.perf_counter()
+        try:
+            if connect and getattr(local, 'conn', None) is None:
+                local.conn = connect()
+                with opened_lock:
+                    opened.add(local.conn)
+            fields = fn(getattr(local, 'conn', None)) or {}
+        except Exception as e:
+            reporter.emit("error", op=op, file=name, error=f"{type(e).__name__}: {e}")
+            conn, local.conn = getattr(local, 'conn', None), None
+            if conn is not None:
+                with opened_lock:
+                    opened.discard(conn)
+                _close(conn)
+            return False
+        reporter.emit("done", op=op, file=name, seconds=round(time.perf_counter() - start, 6), **fields)
+        return True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(run, operations))
+    for conn in opened:
+        _close(conn)
+    failed = results.count(False)
+    reporter.emit("summary", ops=len(results), failed=failed, seconds=round(time.perf_counter() - start, 6))
+    return failed
+
+
+def _close(conn):
+    close = getattr(conn, 'close', None)
+    if close:
+        try:
+            close()
+        except OSError:
+            pass
+
+
+def read_manifest(path):
+    """Operations of a manifest file: one shell-quoted command per line, '#' comments"""
+    operations = []
+    with open(path) as f:
+        for line in f:
+            argv = shlex.split(line, comments=True)
+            if argv:
+                operations.append(argv)
+    return operations
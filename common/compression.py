@@ -0,0 +1,171 @@
+"""Streaming compression shared by the socket and XML-RPC file transfers.
+
+Only stdlib codecs are used (zlib, bz2, lzma).  Peers agree on a codec
+with negotiate(), the sender checks a sample of the data with
+is_compressible() so already-compressed files go out unchanged, and data
+is (de)compressed piece by piece so memory stays bounded whatever the
+file size.
+"""
+from collections import Counter
+import bz2
+import lzma
+import math
+import time
+import zlib
+
+# Our order of preference: zlib is by far the fastest of the three
+PREFERENCE = ("zlib", "lzma", "bz2")
+SAMPLE_SIZE = 64 * 1024
+# Largest piece a Decompressor hands back at once
+MAX_PIECE = 1024 * 1024
+
+# Skip compression above this many bits of entropy per byte ...
+MAX_ENTROPY = 7.5
+# ... or when a quick zlib pass on the sample saves less than this
+MIN_SAVING = 0.10
+
+# Leading bytes of common formats that are compressed already
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",            # gzip
+    b"PK\x03\x04",          # zip, jar, docx, ...
+    b"\xfd7zXZ\x00",        # xz
+    b"BZh",                 # bzip2
+    b"\x28\xb5\x2f\xfd",    # zstd
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x89PNG",
+    b"\xff\xd8\xff",        # jpeg
+    b"GIF8",
+    b"%PDF",
+)
+
+
+def supported():
+    return list(PREFERENCE)
+
+
+def negotiate(offered, preferred=PREFERENCE):
+    """Pick the first codec in our preference that the peer also offered."""
+    for codec in preferred:
+        if codec in offered:
+            return codec
+    return None
+
+
+def entropy(sample):
+    """Shannon entropy of sample in bits per byte."""
+    if not sample:
+        return 0.0
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+
+
+def is_compressible(sample):
+    """Cheap check of whether compressing data that starts with sample pays off."""
+    sample = bytes(sample[:SAMPLE_SIZE])
+    if len(sample) < 64 or sample.startswith(COMPRESSED_MAGIC):
+        return False
+    if entropy(sample) > MAX_ENTROPY:
+        return False
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def choose_codec(sample, offered):
+    """Codec to use for data starting with sample, or None to send it raw."""
+    codec = negotiate(offered)
+    if codec is None or not is_compressible(sample):
+        return None
+    return codec
+
+
+class Compressor:
+    """Incremental compressor: feed pieces with compress(), end with flush()."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "zlib":
+            self.obj = zlib.compressobj(6)
+        elif codec == "bz2":
+            self.obj = bz2.BZ2Compressor(9)
+        elif codec == "lzma":
+            self.obj = lzma.LZMACompressor(preset=1)
+        else:
+            raise ValueError(f"unknown codec {codec!r}")
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+class Decompressor:
+    """Incremental decompressor that never returns more than max_piece bytes at once."""
+
+    def __init__(self, codec, max_piece=MAX_PIECE):
+        self.codec = codec
+        self.max_piece = max_piece
+        if codec == "zlib":
+            self.obj = zlib.decompressobj()
+        elif codec == "bz2":
+            self.obj = bz2.BZ2Decompressor()
+        elif codec == "lzma":
+            self.obj = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f"unknown codec {codec!r}")
+
+    def feed(self, data):
+        """Yield the decompressed pieces of data."""
+        obj = self.obj
+        if self.codec == "zlib":
+            out = obj.decompress(data, self.max_piece)
+            if out:
+                yield out
+            while obj.unconsumed_tail:
+                out = obj.decompress(obj.unconsumed_tail, self.max_piece)
+                if out:
+                    yield out
+        else:
+            out = obj.decompress(data, self.max_piece)
+            if out:
+                yield out
+            while not obj.eof and not obj.needs_input:
+                out = obj.decompress(b"", self.max_piece)
+                if out:
+                    yield out
+
+
+def compress_chunk(codec, data):
+    c = Compressor(codec)
+    return c.compress(data) + c.flush()
+
+
+def decompress_chunk(codec, data, limit):
+    """Decompress a self-contained chunk, refusing to produce more than limit bytes."""
+    out = bytearray()
+    for piece in Decompressor(codec).feed(data):
+        out += piece
+        if len(out) > limit:
+            raise ValueError(f"chunk decompresses to more than {limit} bytes")
+    return bytes(out)
+
+
+class TransferStats:
+    """Raw vs on-the-wire byte counts and throughput for one transfer."""
+
+    def __init__(self, codec=None):
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.start = time.perf_counter()
+
+    def add(self, raw, wire):
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (f"{self.codec or 'none'}: {self.raw_bytes:,} -> {self.wire_bytes:,} bytes "
+                f"(ratio {self.ratio():.2f}x, {self.raw_bytes / elapsed / 1e6:.1f} MB/s)")
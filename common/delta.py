@@ -0,0 +1,260 @@
+"""Rsync-style delta encoding shared by the socket and MPI file transfers.
+
+The receiver of an update cuts its old copy of the file (the basis) into
+fixed-size blocks and sends their Signature: a weak rolling checksum and
+a strong hash per block.  The sender slides a block-sized window over its
+new file.  Where the weak checksum of the window names a block and the
+strong hash agrees, it emits a reference to that block and jumps a whole
+block ahead; elsewhere the window moves one byte and the skipped bytes go
+out as literal data.  The receiver rebuilds the file from its basis and
+the literals, so an update costs about the size of the change plus the
+signature, not the size of the file.
+
+The weak checksum is Adler-32: a window is first hashed by zlib in C, and
+only across changed regions is it rolled forward byte by byte in Python.
+Ops travel packed (see Encoder) so neither side unpickles peer data.
+"""
+import hashlib
+import os
+import struct
+import zlib
+
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 128 * 1024
+# Literal runs are cut at this size so the sender's buffer stays bounded
+MAX_LITERAL = 256 * 1024
+# Packed ops are handed out in batches of about this many bytes
+BATCH_SIZE = 256 * 1024
+READ_SIZE = 1024 * 1024
+COPY_PIECE = 1024 * 1024
+
+STRONG_SIZE = 16
+SIG_HEADER = struct.Struct("!QI")           # basis size, block size
+SIG_BLOCK = struct.Struct(f"!I{STRONG_SIZE}s")
+OP_COPY = struct.Struct("!cQI")             # b"C", first block, block count
+OP_DATA = struct.Struct("!cI")              # b"D", literal length
+ADLER_MOD = 65521
+# Largest batch an Encoder with the default batch_size yields
+MAX_BATCH = BATCH_SIZE + OP_COPY.size + OP_DATA.size + MAX_LITERAL
+
+
+def block_size_for(size):
+    """About sqrt(size), as rsync picks it, in [MIN_BLOCK, MAX_BLOCK]"""
+    block = MIN_BLOCK
+    while block * block < size and block < MAX_BLOCK:
+        block *= 2
+    return block
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
+
+
+class Signature:
+    """Weak and strong checksums of every block of a basis file"""
+
+    def __init__(self, size, block_size, weak, strong):
+        self.size = size
+        self.block_size = block_size
+        self.weak = weak
+        self.strong = strong
+
+    @classmethod
+    def of_file(cls, path, block_size=None):
+        size = os.path.getsize(path)
+        block_size = block_size or block_size_for(size)
+        weak, strong = [], []
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                weak.append(zlib.adler32(block))
+                strong.append(strong_hash(block))
+        return cls(size, block_size, weak, strong)
+
+    def pack(self):
+        return SIG_HEADER.pack(self.size, self.block_size) + b"".join(
+            SIG_BLOCK.pack(w, s) for w, s in zip(self.weak, self.strong))
+
+    @classmethod
+    def unpack(cls, data):
+        size, block_size = SIG_HEADER.unpack_from(data)
+        if not MIN_BLOCK <= block_size <= MAX_BLOCK:
+            raise ValueError(f"bad signature block size {block_size}")
+        weak, strong = [], []
+        for w, s in SIG_BLOCK.iter_unpack(memoryview(data)[SIG_HEADER.size:]):
+            weak.append(w)
+            strong.append(s)
+        return cls(size, block_size, weak, strong)
+
+    def last_length(self):
+        return self.size - (len(self.weak) - 1) * self.block_size if self.weak else 0
+
+
+class Encoder:
+    """Iterate over the packed ops that turn the basis into file f.
+
+    Bytes read from f also go to hasher, if given, so the sender gets the
+    new file's checksum without reading it twice.  literal and matched
+    count the bytes sent as data and as block references."""
+
+    def __init__(self, signature, f, hasher=None, batch_size=BATCH_SIZE):
+        self.sig = signature
+        self.f = f
+        self.hasher = hasher
+        self.batch_size = batch_size
+        self.literal = 0
+        self.matched = 0
+        self.run = None             # [first, count] of a pending copy
+
+    def __iter__(self):
+        out = bytearray()
+        for op in self._ops():
+            out += op
+            if len(out) >= self.batch_size:
+                yield bytes(out)
+                out.clear()
+        if self.run:
+            out += OP_COPY.pack(b"C", *self.run)
+        if out:
+            yield bytes(out)
+
+    def _copy(self, index, length):
+        """Extend the pending copy run, returning the finished one if any"""
+        self.matched += length
+        if self.run and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+            return b""
+        done = OP_COPY.pack(b"C", *self.run) if self.run else b""
+        self.run = [index, 1]
+        return done
+
+    def _data(self, data):
+        self.literal += len(data)
+        done = OP_COPY.pack(b"C", *self.run) if self.run else b""
+        self.run = None
+        return done + OP_DATA.pack(b"D", len(data)) + data
+
+    def _read(self):
+        data = self.f.read(READ_SIZE)
+        if self.hasher and data:
+            self.hasher.update(data)
+        return data
+
+    def _ops(self):
+        sig = self.sig
+        n = sig.block_size
+        table = {}
+        for i, w in enumerate(sig.weak):
+            table.setdefault(w, []).append(i)
+        strong = sig.strong
+        buf = bytearray()
+        start = pos = 0             # first unsent byte, window start
+        eof = False
+        weak = None
+        while True:
+            if len(buf) - pos < n and not eof:
+                del buf[:start]
+                pos -= start
+                start = 0
+                data = self._read()
+                eof = not data
+                buf += data
+                continue
+            if len(buf) - pos < n:
+                break
+            if weak is None:
+                weak = zlib.adler32(buf[pos:pos + n])
+            candidates = table.get(weak)
+            if candidates:
+                digest = strong_hash(buf[pos:pos + n])
+                match = next((i for i in candidates if strong[i] == digest), None)
+                if match is not None:
+                    if pos > start:
+                        yield self._data(bytes(buf[start:pos]))
+                    yield self._copy(match, n)
+                    pos += n
+                    start = pos
+                    weak = None
+                    continue
+            if pos - start >= MAX_LITERAL:
+                yield self._data(bytes(buf[start:pos]))
+                start = pos
+            # Roll the window a byte at a time (drop buf[pos], take
+            # buf[pos + n]) until the weak checksum names some block
+            a, b = weak & 0xFFFF, weak >> 16
+            stop = min(len(buf) - n, start + MAX_LITERAL)
+            pos += 1
+            while pos < stop:
+                old = buf[pos - 1]
+                a = (a - old + buf[pos + n - 1]) % ADLER_MOD
+                b = (b - n * old + a - 1) % ADLER_MOD
+                if (b << 16 | a) in table:
+                    break
+                pos += 1
+            weak = (b << 16 | a) if pos < stop else None
+
+        # The last basis block may be shorter than a window
+        tail = bytes(buf[pos:])
+        last = len(sig.weak) - 1
+        if (tail and len(tail) == sig.last_length() and zlib.adler32(tail) == sig.weak[last]
+                and strong_hash(tail) == strong[last]):
+            if pos > start:
+                yield self._data(bytes(buf[start:pos]))
+            yield self._copy(last, len(tail))
+        elif len(buf) > start:
+            yield self._data(bytes(buf[start:]))
+
+
+class Patcher:
+    """Rebuild a file into out from the basis and packed ops.
+
+    out must not be the basis itself; write to a temporary name and
+    rename it over the basis once the checksum is verified."""
+
+    def __init__(self, basis, out, block_size, hasher=None):
+        self.basis = basis
+        self.out = out
+        self.block_size = block_size
+        self.blocks = -(-os.fstat(basis.fileno()).st_size // block_size)
+        self.hasher = hasher
+        self.written = 0
+        self.literal = 0
+
+    def _write(self, data):
+        self.out.write(data)
+        if self.hasher:
+            self.hasher.update(data)
+        self.written += len(data)
+
+    def feed(self, packed):
+        """Apply one batch; raises ValueError on a malformed batch"""
+        view = memoryview(packed)
+        pos = 0
+        while pos < len(view):
+            kind = bytes(view[pos:pos + 1])
+            if kind == b"C" and pos + OP_COPY.size <= len(view):
+                _, first, count = OP_COPY.unpack_from(view, pos)
+                pos += OP_COPY.size
+                if first + count > self.blocks:
+                    raise ValueError(f"block {first + count - 1} is past the end of the basis")
+                offset = first * self.block_size
+                remaining = count * self.block_size
+                while remaining:
+                    data = os.pread(self.basis.fileno(), min(remaining, COPY_PIECE), offset)
+                    if not data:
+                        break       # the last basis block is short
+                    self._write(data)
+                    offset += len(data)
+                    remaining -= len(data)
+            elif kind == b"D" and pos + OP_DATA.size <= len(view):
+                _, length = OP_DATA.unpack_from(view, pos)
+                pos += OP_DATA.size
+                if pos + length > len(view):
+                    raise ValueError("literal runs past the end of the batch")
+                self._write(view[pos:pos + length])
+                self.literal += length
+                pos += length
+            else:
+                raise ValueError(f"bad delta op at byte {pos}")
@@ -0,0 +1,231 @@
+"""Counters, gauges, histograms and a JSON-lines event log for the servers.
+
+Updating a metric is a dict lookup and an add under the registry's lock,
+cheap enough to do per chunk.  Registry.snapshot() returns the aggregated
+values as plain dicts (histograms with estimated percentiles), and
+prometheus_text() renders one or more snapshots in the Prometheus text
+exposition format; Registry.write() saves either on demand.
+
+EventLog queues events and a background thread appends them to a file
+as JSON lines, a batch per write, so callers never wait on the disk.
+"""
+from bisect import bisect_left
+import json
+import os
+import queue
+import threading
+import time
+
+# Upper bounds in seconds, 50 microseconds to 10 seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PERCENTILES = (50, 95, 99)
+FLUSH_INTERVAL = 1.0
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, lock):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.values = {}
+
+    def inc(self, n=1, **labels):
+        key = _key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def _snapshot(self):
+        return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[_key(labels)] = value
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, lock, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.lock = lock
+        self.buckets = tuple(buckets)
+        self.values = {}            # labels -> [bucket counts + overflow, sum, count]
+
+    def observe(self, value, **labels):
+        i = bisect_left(self.buckets, value)
+        key = _key(labels)
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the time spent inside it"""
+        return _Timer(self, labels)
+
+    def _snapshot(self):
+        result = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative, running = [], 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                running += n
+                cumulative.append([bound, running])
+            entry = {'labels': dict(key), 'count': count, 'sum': total, 'buckets': cumulative}
+            for p in PERCENTILES:
+                # Upper bound of the bucket holding the p-th percentile
+                rank = count * p / 100
+                entry[f'p{p}'] = next(bound for bound, n in cumulative if n >= rank)
+            result.append(entry)
+        return result
+
+
+class Registry:
+    """A named set of metrics, created on first use"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.started = time.time()
+
+    def _get(self, cls, name, help, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, cls(name, help, self.lock, *args))
+        if not isinstance(metric, cls):
+            raise ValueError(f"metric {name} is a {metric.kind}, not a {cls.kind}")
+        return metric
+
+    def counter(self, name, help=""):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help="", buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        """{name: {'type', 'help', 'values': [...]}} plus the uptime, as plain data"""
+        with self.lock:
+            metrics = {m.name: {'type': m.kind, 'help': m.help, 'values': m._snapshot()}
+                       for m in self.metrics.values()}
+        return {'time': time.time(), 'uptime': time.time() - self.started, 'metrics': metrics}
+
+    def write(self, path):
+        """Save a snapshot: Prometheus text for *.prom, JSON otherwise"""
+        snapshot = self.snapshot()
+        if path.endswith(".prom"):
+            write_file(path, prometheus_text([({}, snapshot)]))
+        else:
+            write_file(path, json.dumps(snapshot, indent=1))
+
+
+def write_file(path, text):
+    """Replace path with text so readers never see half a file"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def prometheus_text(snapshots):
+    """Render [(extra labels, snapshot), ...] as one Prometheus text exposition.
+
+    The extra labels (e.g. {'rank': 3}) tell apart snapshots of several
+    processes that share metric names."""
+    names = {}
+    for extra, snapshot in snapshots:
+        for name, metric in snapshot['metrics'].items():
+            names.setdefault(name, (metric, []))[1].extend(
+                (extra, value) for value in metric['values'])
+    lines = []
+    for name, (metric, values) in sorted(names.items()):
+        if metric['help']:
+            lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for extra, value in values:
+            labels = {**value['labels'], **extra}
+            if metric['type'] != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value['value']}")
+                continue
+            for bound, n in value['buckets']:
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {n}")
+            lines.append(f"{name}_sum{_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+class EventLog:
+    """Append events to path as JSON lines from a background thread"""
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self.thread.start()
+
+    def log(self, event, **fields):
+        self.queue.put({'ts': round(time.time(), 6), 'event': event, **fields})
+
+    def _run(self):
+        with open(self.path, 'a') as f:
+            done = False
+            while not done:
+                # Wait for an event, then gather more for up to flush_interval
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while batch[-1] is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                done = batch[-1] is None
+                f.write("".join(json.dumps(e, default=str) + "\n" for e in batch if e is not None))
+                f.flush()
+
+    def close(self):
+        """Write whatever is queued and stop the thread"""
+        self.queue.put(None)
+        self.thread.join()